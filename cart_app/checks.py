@@ -0,0 +1,27 @@
+from django.core.checks import Error, Tags, register
+from django.db import connections
+
+from .sharding import is_sharded, shard_for
+
+
+@register(Tags.database)
+def check_shard_count(databases=None, **kwargs):
+    """Refuse a CART_SHARD_COUNT that sends existing carts' lookups to the wrong shard"""
+    if not is_sharded() or 'default' not in (databases or ()):
+        return []
+    from .models import CartDirectory
+
+    if CartDirectory._meta.db_table not in connections['default'].introspection.table_names():
+        return []
+    stranded = sum(
+        1 for cart_code, shard in CartDirectory.objects.values_list('cart_code', 'shard').iterator(chunk_size=2000)
+        if shard != shard_for(cart_code)
+    )
+    if not stranded:
+        return []
+    return [Error(
+        f'{stranded} cart(s) are stored on a shard other than the one their cart_code hashes to.',
+        hint='CART_SHARD_COUNT changed since they were created; restore the previous value.',
+        obj='CART_SHARD_COUNT',
+        id='cart_app.E001',
+    )]
@@ -0,0 +1,121 @@
+import gzip
+import json
+import time
+from datetime import timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from cart_app.models import Cart, CartDirectory, CartItem
+from cart_app.sharding import cart_databases, is_sharded
+from cart_app.store import get_cart_store
+
+
+class Command(BaseCommand):
+    """
+    Delete unpaid guest carts that have been idle longer than the TTL.
+
+    Carts are removed in bounded chunks, each in its own short transaction,
+    so the purge never holds a long write lock on the cart tables. With
+    sharded carts each shard is purged in turn.
+    Schedule it from cron, e.g. ``python manage.py purge_carts --archive carts.jsonl.gz``
+    """
+    help = 'Purge abandoned guest carts (optionally archiving them to a gzipped JSON-lines file)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.CART_GUEST_TTL_DAYS,
+                            help='Idle time in days after which a guest cart is purged')
+        parser.add_argument('--chunk-size', type=int, default=settings.CART_PURGE_CHUNK_SIZE,
+                            help='Number of carts deleted per transaction')
+        parser.add_argument('--archive', metavar='PATH',
+                            help='Append purged carts to this gzipped JSON-lines file before deleting them')
+        parser.add_argument('--sleep', type=float, default=0.0,
+                            help='Seconds to pause between chunks to let other writers through')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report how many carts would be purged')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        chunk_size = max(1, options['chunk_size'])
+
+        if options['dry_run']:
+            count = 0
+            for using in cart_databases():
+                candidates = self.get_queryset(cutoff, using)
+                if is_sharded():
+                    count += len(self.without_transactions(list(candidates.values_list('pk', flat=True))))
+                else:
+                    count += candidates.count()
+            self.stdout.write(f"{count} guest cart(s) idle since before {cutoff:%Y-%m-%d %H:%M} would be purged")
+            return
+
+        store = get_cart_store()
+        archive = gzip.open(options['archive'], 'at', encoding='utf-8') if options['archive'] else None
+        carts_deleted = 0
+        rows_deleted = 0
+        started = time.monotonic()
+        try:
+            for using in cart_databases():
+                candidates = self.get_queryset(cutoff, using).order_by('pk')
+                last_pk = 0
+                while True:
+                    ids = list(candidates.filter(pk__gt=last_pk).values_list('pk', flat=True)[:chunk_size])
+                    if not ids:
+                        break
+                    last_pk = ids[-1]
+                    if is_sharded():
+                        ids = self.without_transactions(ids)
+                        if not ids:
+                            continue
+
+                    with transaction.atomic(using=using):
+                        if archive:
+                            self.archive_chunk(archive, ids, using)
+                        codes = list(Cart.objects.using(using).filter(pk__in=ids).values_list('cart_code', flat=True))
+                        rows, per_model = Cart.objects.using(using).filter(pk__in=ids).delete()
+                    if is_sharded():
+                        CartDirectory.objects.filter(pk__in=ids).delete()
+                    store.forget(codes)
+
+                    carts_deleted += per_model.get(Cart._meta.label, 0)
+                    rows_deleted += rows
+                    if options['sleep']:
+                        time.sleep(options['sleep'])
+        finally:
+            if archive:
+                archive.close()
+
+        elapsed = time.monotonic() - started
+        rate = rows_deleted / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f"Purged {carts_deleted} cart(s), {rows_deleted} row(s) in {elapsed:.2f}s ({rate:.0f} rows/s)"
+        ))
+
+    def get_queryset(self, cutoff, using='default'):
+        """Unpaid guest carts with no activity since cutoff and no payment attempts"""
+        idle = (
+            Q(modified_at__lt=cutoff)
+            | Q(modified_at__isnull=True, created_at__lt=cutoff)
+            | Q(modified_at__isnull=True, created_at__isnull=True)
+        )
+        return Cart.objects.using(using).filter(idle, user__isnull=True, paid=False, transaction__isnull=True)
+
+    def without_transactions(self, ids):
+        """Drop carts with payment attempts; transactions stay on the default database when sharded"""
+        Transaction = apps.get_model('core', 'Transaction')
+        paid_for = set(Transaction.objects.filter(cart_id__in=ids).values_list('cart_id', flat=True))
+        return [pk for pk in ids if pk not in paid_for]
+
+    def archive_chunk(self, archive, ids, using='default'):
+        """Write one JSON line per cart, with its items, to the archive file"""
+        items_by_cart = {}
+        for item in CartItem.objects.using(using).filter(cart_id__in=ids).values('cart_id', 'product_id', 'quantity', 'unit_price'):
+            items_by_cart.setdefault(item.pop('cart_id'), []).append(item)
+
+        for cart in Cart.objects.using(using).filter(pk__in=ids).values('id', 'cart_code', 'created_at', 'modified_at'):
+            cart['items'] = items_by_cart.get(cart['id'], [])
+            archive.write(json.dumps(cart, default=str) + '\n')
@@ -0,0 +1,68 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from cart_app.models import Cart, CartDirectory, CartItem
+from cart_app.sharding import is_sharded, shard_for
+from cart_app.store import get_cart_store
+
+
+class Command(BaseCommand):
+    """
+    Move carts still stored in the default database onto their shards.
+
+    Run once after enabling CART_SHARD_COUNT (and migrating every
+    ``cart_shard_<i>`` database). Cart ids are kept, so transactions keep
+    pointing at the right cart (on PostgreSQL, reset the CartDirectory id
+    sequence afterwards with ``sqlsequencereset``). Safe to re-run: moved
+    carts are gone from the default database.
+    """
+    help = 'Move carts from the default database to their shards'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Number of carts moved per transaction')
+
+    def handle(self, *args, **options):
+        if not is_sharded():
+            raise CommandError('Cart sharding is not enabled (set CART_SHARD_COUNT > 1)')
+
+        chunk_size = max(1, options['chunk_size'])
+        store = get_cart_store()
+        moved = 0
+        while True:
+            carts = list(Cart.objects.using('default').order_by('pk')[:chunk_size])
+            if not carts:
+                break
+            codes = [cart.cart_code for cart in carts]
+            for code in codes:
+                store.flush(code)
+            items = list(CartItem.objects.using('default').filter(cart_id__in=[cart.pk for cart in carts]))
+
+            by_shard = {}
+            for cart in carts:
+                by_shard.setdefault(shard_for(cart.cart_code), []).append(cart)
+            shard_of = {cart.pk: shard_for(cart.cart_code) for cart in carts}
+
+            CartDirectory.objects.bulk_create([
+                CartDirectory(pk=cart.pk, cart_code=cart.cart_code, shard=shard_of[cart.pk],
+                              user_id=cart.user_id, paid=cart.paid)
+                for cart in carts
+            ], ignore_conflicts=True)
+            for using, shard_carts in by_shard.items():
+                ids = {cart.pk for cart in shard_carts}
+                with transaction.atomic(using=using):
+                    # bulk_create skips save(), so the directory ids above are kept as-is
+                    Cart.objects.using(using).bulk_create(shard_carts, ignore_conflicts=True)
+                    CartItem.objects.using(using).bulk_create(
+                        [item for item in items if item.cart_id in ids], ignore_conflicts=True
+                    )
+
+            with transaction.atomic(using='default'):
+                ids = [cart.pk for cart in carts]
+                CartItem.objects.using('default').filter(cart_id__in=ids).delete()
+                # A raw delete: the regular one would cascade to the carts' transactions
+                Cart.objects.using('default').filter(pk__in=ids)._raw_delete('default')
+            store.forget(codes)
+            moved += len(carts)
+
+        self.stdout.write(self.style.SUCCESS(f"Moved {moved} cart(s) to the shards"))
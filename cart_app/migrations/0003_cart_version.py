@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-19 16:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cart_app', '0002_cartitem_unit_price'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
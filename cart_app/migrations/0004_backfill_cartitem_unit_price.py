@@ -0,0 +1,23 @@
+from django.db import migrations
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_unit_price(apps, schema_editor):
+    """Items added through the old add-to-cart endpoint were stored with unit_price 0"""
+    CartItem = apps.get_model('cart_app', 'CartItem')
+    Product = apps.get_model('shop_app', 'Product')
+    CartItem.objects.filter(unit_price=0, cart__paid=False).update(
+        unit_price=Subquery(Product.objects.filter(pk=OuterRef('product_id')).values('price')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cart_app', '0003_cart_version'),
+        ('shop_app', '0003_alter_product_image'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_unit_price, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 4.2 on 2026-10-19 16:09
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_app', '0004_promotion'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('cart_app', '0004_backfill_cartitem_unit_price'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cart',
+            name='user',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='cartitem',
+            name='product',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='shop_app.product'),
+        ),
+        migrations.CreateModel(
+            name='CartDirectory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cart_code', models.CharField(max_length=11, unique=True)),
+                ('shard', models.CharField(max_length=50)),
+                ('paid', models.BooleanField(default=False)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'cart directory',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='cartdirectory',
+            index=models.Index(fields=['user', 'paid'], name='cart_app_ca_user_id_0d2e3a_idx'),
+        ),
+    ]
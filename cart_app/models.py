@@ -1,24 +1,118 @@
-from django.db import models
+from django.db import models, transaction
 from django.conf import settings
+from django.utils import timezone
+from django.utils.crypto import get_random_string
 
 # Import Product from shop_app
 from shop_app.models import Product
 
+from .sharding import is_sharded, shard_for
+
+
+class CartDirectory(models.Model):
+    """
+    Where each cart lives when carts are sharded. Lives on the default
+    database and hands out the cart ids, so they stay unique across shards.
+    """
+    cart_code = models.CharField(max_length=11, unique=True)
+    shard = models.CharField(max_length=50)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, blank=True, null=True, related_name='+')
+    paid = models.BooleanField(default=False)
+
+    class Meta:
+        verbose_name_plural = 'cart directory'
+        indexes = [models.Index(fields=['user', 'paid'])]
+
+    def __str__(self):
+        return f"{self.cart_code} @ {self.shard}"
+
+
+class CartManager(models.Manager):
+    def for_code(self, cart_code):
+        """Manager bound to the database holding cart_code"""
+        return self.db_manager(shard_for(cart_code))
+
+    def get_or_create_for_user(self, user):
+        """The user's unpaid cart, created (with a fresh cart_code) if missing"""
+        if not is_sharded():
+            return self.get_or_create(user=user, paid=False, defaults={'cart_code': get_random_string(11)})
+        entry = CartDirectory.objects.filter(user=user, paid=False).order_by('pk').first()
+        if entry is not None:
+            cart = self.using(entry.shard).filter(pk=entry.pk).first()
+            if cart is not None:
+                return cart, False
+        cart_code = get_random_string(11)
+        return self.for_code(cart_code).create(cart_code=cart_code, user=user), True
+
+
 # Create your models here.
 class Cart(models.Model):
     cart_code = models.CharField(max_length=11, unique=True)
-    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, blank=True, null=True)
+    # No database-level constraint: with sharding the users table lives in another database
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, blank=True, null=True, db_constraint=False)
     paid = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True, blank=True, null=True)
     modified_at = models.DateTimeField(auto_now=True, blank=True, null=True)
+    version = models.PositiveIntegerField(default=0)
+
+    objects = CartManager()
 
     def __str__(self):
         return self.cart_code
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        cart = super().from_db(db, field_names, values)
+        # What the directory holds for this cart, so saves can tell whether it needs updating
+        cart._directory = (cart.__dict__.get('user_id'), cart.__dict__.get('paid'))
+        return cart
+
+    def save(self, *args, **kwargs):
+        if not is_sharded():
+            return super().save(*args, **kwargs)
+        # The directory (default database) and the cart (its shard) cannot share a transaction. The
+        # directory is written first and rolled back if the shard write fails; a directory row whose
+        # cart never committed is skipped by lookups.
+        with transaction.atomic(using='default'):
+            if self.pk is None:
+                # Take the id from the directory so it is unique across shards
+                self.pk = CartDirectory.objects.create(
+                    cart_code=self.cart_code, shard=kwargs.get('using') or shard_for(self.cart_code),
+                    user_id=self.user_id, paid=self.paid,
+                ).pk
+                kwargs['force_insert'] = True
+            elif (self.user_id, self.paid) != getattr(self, '_directory', None):
+                update_fields = kwargs.get('update_fields')
+                if update_fields is None or {'user', 'user_id', 'paid'} & set(update_fields):
+                    CartDirectory.objects.filter(pk=self.pk).update(user_id=self.user_id, paid=self.paid)
+            super().save(*args, **kwargs)
+        self._directory = (self.user_id, self.paid)
+
+    def delete(self, *args, **kwargs):
+        pk = self.pk
+        result = super().delete(*args, **kwargs)
+        if is_sharded():
+            CartDirectory.objects.filter(pk=pk).delete()
+        return result
+
+    def bump_version(self, expected=None):
+        """
+        Atomically increment the cart version (and record activity).
+        With expected set, only bump if the stored version still matches;
+        returns False on a conflict. self.version is refreshed either way.
+        """
+        carts = Cart.objects.using(self._state.db).filter(pk=self.pk)
+        if expected is not None:
+            carts = carts.filter(version=expected)
+        self.modified_at = timezone.now()
+        bumped = carts.update(version=models.F('version') + 1, modified_at=self.modified_at)
+        self.version = Cart.objects.using(self._state.db).filter(pk=self.pk).values_list('version', flat=True).first()
+        return bumped == 1
+
 
 class CartItem(models.Model):
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='items')
-    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, db_constraint=False)
     quantity = models.PositiveIntegerField(default=1)
     unit_price = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
 
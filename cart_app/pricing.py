@@ -0,0 +1,66 @@
+"""
+Cart pricing: subtotal, promotions, shipping and tax in one place.
+
+Used by CartSerializer and by every payment initiator so the cart page and
+checkout always agree on the amount.
+"""
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.conf import settings
+from django.utils import timezone
+
+from shop_app.promotions import get_index
+
+from .sharding import with_products
+
+CENT = Decimal('0.01')
+
+
+def _money(amount):
+    return amount.quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def price_cart(cart, coupon_code=None):
+    """
+    Price a cart's items. Each line gets the best live product/category
+    promotion (or the coupon, if it targets that line and is better); a
+    cart-wide rule then applies to the discounted subtotal.
+    """
+    index = get_index()
+    now = timezone.now()
+    coupon = index.coupon(coupon_code, now)
+
+    subtotal = Decimal('0')
+    line_discount = Decimal('0')
+    items = cart.items.all()
+    if 'items' not in getattr(cart, '_prefetched_objects_cache', {}):
+        items = with_products(items)
+    for item in items:
+        product = item.product
+        amount = item.unit_price * item.quantity
+        subtotal += amount
+
+        rules = [rule for rule in index.line_rules(product.id, product.category) if rule.is_live(now)]
+        if coupon and (coupon.product_id is not None or coupon.category) and coupon.applies_to(product.id, product.category):
+            rules.append(coupon)
+        if rules:
+            line_discount += max(rule.discount(amount) for rule in rules)
+
+    discounted = subtotal - line_discount
+    cart_rules = [rule for rule in index.cart_wide.values() if rule.is_live(now)]
+    if coupon and coupon.product_id is None and not coupon.category:
+        cart_rules.append(coupon)
+    cart_discount = max((rule.discount(discounted) for rule in cart_rules), default=Decimal('0'))
+
+    discount = _money(line_discount + cart_discount)
+    taxable = _money(subtotal) - discount
+    shipping = settings.CART_SHIPPING_FEE if subtotal else Decimal('0')
+    tax = _money(taxable * settings.CART_TAX_RATE)
+    return {
+        'subtotal': _money(subtotal),
+        'discount': discount,
+        'shipping': shipping,
+        'tax': tax,
+        'total': taxable + shipping + tax,
+        'coupon': coupon.code if coupon else None,
+    }
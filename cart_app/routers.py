@@ -0,0 +1,41 @@
+from .models import Cart, CartDirectory, CartItem
+from .sharding import is_sharded, shard_for
+
+
+class CartShardRouter:
+    """
+    Route Cart/CartItem to their shard and everything else to the default
+    database. Enabled from settings when CART_SHARD_COUNT > 1; every shard
+    carries the full schema so cascades and joins find (empty) tables.
+    """
+    cart_models = (Cart, CartItem)
+
+    def _cart_db(self, model, instance):
+        if instance is None:
+            return None
+        if isinstance(instance, self.cart_models) and instance._state.db:
+            return instance._state.db
+        if isinstance(instance, Cart):
+            return shard_for(instance.cart_code)
+        if isinstance(instance, CartItem) and CartItem.cart.is_cached(instance):
+            return self._cart_db(Cart, instance.cart)
+        # A row on the default database pointing at a cart (e.g. Transaction.cart)
+        cart_id = getattr(instance, 'cart_id', None)
+        if model is Cart and cart_id:
+            return CartDirectory.objects.filter(pk=cart_id).values_list('shard', flat=True).first()
+        return None
+
+    def db_for_read(self, model, **hints):
+        if not is_sharded():
+            return None
+        if model in self.cart_models:
+            return self._cart_db(model, hints.get('instance'))
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        return self.db_for_read(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if isinstance(obj1, self.cart_models) or isinstance(obj2, self.cart_models):
+            return True
+        return None
@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from .models import Cart, CartItem
+from .pricing import price_cart
 from shop_app.models import Product
 from shop_app.serializers import ProductSerializer
 
@@ -20,6 +21,11 @@ class CartSerializer(serializers.ModelSerializer):
     cart_code = serializers.SerializerMethodField()
     total_quantity = serializers.SerializerMethodField()
     total_price = serializers.SerializerMethodField()
+    discount = serializers.SerializerMethodField()
+    shipping = serializers.SerializerMethodField()
+    tax = serializers.SerializerMethodField()
+    grand_total = serializers.SerializerMethodField()
+    coupon = serializers.SerializerMethodField()
 
     def get_cart_mode(self, obj):
         return obj.cart_code
@@ -33,6 +39,35 @@ class CartSerializer(serializers.ModelSerializer):
     def get_total_price(self, obj):
         return sum(item.quantity * item.unit_price for item in obj.items.all())
 
+    def _pricing(self, obj):
+        # Priced once per cart and shared by the fields below
+        if not hasattr(self, '_pricing_cache'):
+            self._pricing_cache = {}
+        cache = self._pricing_cache
+        if obj.pk not in cache:
+            request = self.context.get('request')
+            coupon = None
+            if request is not None:
+                coupon = request.query_params.get('coupon') or request.data.get('coupon')
+            cache[obj.pk] = price_cart(obj, coupon)
+        return cache[obj.pk]
+
+    def get_discount(self, obj):
+        return self._pricing(obj)['discount']
+
+    def get_shipping(self, obj):
+        return self._pricing(obj)['shipping']
+
+    def get_tax(self, obj):
+        return self._pricing(obj)['tax']
+
+    def get_grand_total(self, obj):
+        return self._pricing(obj)['total']
+
+    def get_coupon(self, obj):
+        return self._pricing(obj)['coupon']
+
     class Meta:
         model = Cart
-        fields = ['cart_mode', 'cart_code', 'items', 'total_quantity', 'total_price']
+        fields = ['cart_mode', 'cart_code', 'version', 'items', 'total_quantity', 'total_price',
+                  'discount', 'shipping', 'tax', 'grand_total', 'coupon']
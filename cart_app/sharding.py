@@ -0,0 +1,44 @@
+"""
+Horizontal partitioning of Cart/CartItem.
+
+With ``CART_SHARD_COUNT`` > 1 every cart (and its items) lives in one of N
+databases chosen by a stable hash of its cart_code. A small CartDirectory
+table on the default database allocates globally unique cart ids and maps
+them (and their users) to shards. See ``cart_app.routers.CartShardRouter``.
+
+Queries that look carts up by code must say where to look, e.g.
+``Cart.objects.for_code(code)``; relations from a cart (``cart.items``) and
+to a cart (``transaction.cart``) are routed automatically.
+
+The shard is crc32(cart_code) modulo the number of shards, so changing
+CART_SHARD_COUNT once carts exist strands most of them where lookups no
+longer look. The ``cart_app.E001`` check (run by ``migrate`` and
+``check --database default``) refuses such a configuration.
+"""
+import zlib
+
+from django.conf import settings
+
+
+def is_sharded():
+    return bool(settings.CART_SHARDS)
+
+
+def cart_databases():
+    """Every database alias that can hold carts"""
+    return list(settings.CART_SHARDS) or ['default']
+
+
+def shard_for(cart_code):
+    """The database alias holding cart_code (stable across processes and restarts)"""
+    shards = settings.CART_SHARDS
+    if not shards:
+        return 'default'
+    return shards[zlib.crc32(cart_code.encode()) % len(shards)]
+
+
+def with_products(items):
+    """Load each item's product without a join, which cannot cross databases"""
+    if is_sharded():
+        return items.prefetch_related('product')
+    return items.select_related('product')
@@ -0,0 +1,76 @@
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_init, post_save, pre_delete
+from django.dispatch import receiver
+
+from core.models import CustomUser
+from shop_app.models import Product
+from .models import Cart, CartItem
+from .sharding import cart_databases, is_sharded
+from .store import get_cart_store, publish_cart_event
+
+REPRICE_BATCH = 500  # carts repriced (and locked, with the cache store) at a time
+
+
+@receiver(post_init, sender=Product)
+def remember_price(sender, instance, **kwargs):
+    """Keep the loaded price so saves can tell whether it changed"""
+    instance._original_price = instance.__dict__.get('price')
+
+
+@receiver(post_save, sender=Product)
+def reprice_open_carts(sender, instance, created, **kwargs):
+    """
+    Bring unit_price of the product in every unpaid cart up to date.
+    The writes are set-based UPDATEs, REPRICE_BATCH carts at a time, made
+    through the cart store while it holds those carts' locks, so cached
+    carts are flushed first and reloaded with the new version afterwards.
+    """
+    if created or instance.price == instance._original_price:
+        return
+    instance._original_price = instance.price
+
+    store = get_cart_store()
+    for using in cart_databases():
+        codes = list(_stale_carts(using, instance).values_list('cart_code', flat=True))
+        for start in range(0, len(codes), REPRICE_BATCH):
+            batch = codes[start:start + REPRICE_BATCH]
+            with store.direct_write_many(batch):
+                affected = _reprice_carts(using, instance, batch)
+            for cart_code, version, user_id in affected:
+                publish_cart_event(cart_code, version + 1, user_id)
+
+
+def _stale_items(using, product):
+    return CartItem.objects.using(using).filter(product=product, cart__paid=False).exclude(unit_price=product.price)
+
+
+def _stale_carts(using, product):
+    return Cart.objects.using(using).filter(pk__in=_stale_items(using, product).values('cart_id'))
+
+
+def _reprice_carts(using, product, cart_codes):
+    carts = _stale_carts(using, product).filter(cart_code__in=cart_codes)
+    with transaction.atomic(using=using):
+        affected = list(carts.values_list('cart_code', 'version', 'user_id'))
+        if affected:
+            carts.update(version=F('version') + 1)
+            _stale_items(using, product).filter(cart__cart_code__in=cart_codes).update(unit_price=product.price)
+    return affected
+
+
+@receiver(pre_delete, sender=CustomUser)
+def delete_sharded_carts(sender, instance, **kwargs):
+    """
+    Delete the user's carts on every shard. The cascade from the user only
+    reaches the default database; their directory rows cascade from there.
+    """
+    if not is_sharded():
+        return
+    store = get_cart_store()
+    for using in cart_databases():
+        carts = Cart.objects.using(using).filter(user_id=instance.pk)
+        codes = list(carts.values_list('cart_code', flat=True))
+        if codes:
+            carts.delete()
+            store.forget(codes)
@@ -0,0 +1,587 @@
+"""
+Cart storage used by the cart views.
+
+``DatabaseCartStore`` reads and writes Cart/CartItem rows directly (the
+default). ``CacheCartStore`` keeps active carts in the Django cache as plain
+snapshots and persists quantity changes to the database write-behind, in
+batches, from a background thread. New items and price changes are still
+written through so every item has a real id.
+
+Enable the cache store with ``CART_STORE = 'cache'``. ``CART_STORE_CACHE``
+must be a cache every process shares (Redis, Memcached) and that does not
+evict live keys, since a snapshot may hold changes not yet in the database.
+Local-memory caches are refused unless CART_STORE_ALLOW_LOCAL_CACHE is set
+(single-process development and tests). The list of carts waiting for the
+background flush is kept per process; a cart left dirty by a process that
+died is persisted by the next ``flush()`` of that cart, which checkout
+always calls before reading a cart straight from the database.
+
+Every read-modify-write of a snapshot, and every flush, holds the cart's
+lock; a request that cannot get it within LOCK_TIMEOUT seconds fails with
+``CartBusy`` (HTTP 503) rather than writing unlocked.
+
+Every item change bumps ``Cart.version``. Mutations take an optional
+``expected_version`` (from the ``If-Match`` header) and raise
+``VersionConflict`` (HTTP 412) when the cart moved on in the meantime.
+"""
+import atexit
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db import close_old_connections, transaction
+from django.http import Http404
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from shop_app.models import Product
+from shopp_it.caching import is_shared
+from shopp_it.events import publish
+from .models import Cart, CartItem
+from .sharding import shard_for, with_products
+
+logger = logging.getLogger(__name__)
+
+LOCK_TIMEOUT = 5  # seconds a per-cart lock may be held before it expires, and waited for
+
+
+class VersionConflict(APIException):
+    status_code = status.HTTP_412_PRECONDITION_FAILED
+    default_detail = 'Cart has been modified since it was last fetched.'
+    default_code = 'version_conflict'
+
+    def __init__(self, current_version):
+        super().__init__()
+        self.detail = {'detail': self.detail, 'version': current_version}
+
+
+class CartBusy(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Cart is being updated by another request, try again.'
+    default_code = 'cart_busy'
+    wait = 1  # sent as Retry-After
+
+
+def publish_cart_event(cart_code, version, user_id=None):
+    """Tell subscribed clients (see core.stream_views) that a cart changed, once committed"""
+    event = {'type': 'cart.updated', 'cart_code': cart_code, 'version': version}
+
+    def send():
+        publish(f'cart:{cart_code}', event)
+        if user_id:
+            publish(f'user:{user_id}', event)
+
+    transaction.on_commit(send)
+
+
+class DatabaseCartStore:
+    """Cart operations straight against the database"""
+
+    def get_cart(self, cart_code):
+        return get_object_or_404(Cart.objects.for_code(cart_code), cart_code=cart_code)
+
+    def current(self, cart):
+        """Return the freshest view of a cart loaded from the database"""
+        return cart
+
+    def get_version(self, cart_code):
+        version = Cart.objects.for_code(cart_code).filter(cart_code=cart_code).values_list('version', flat=True).first()
+        if version is None:
+            raise Http404('No Cart matches the given query.')
+        return version
+
+    def _bump(self, cart, expected_version):
+        # The conditional UPDATE is the guard: it runs before the item change in the same transaction
+        if not cart.bump_version(expected_version):
+            raise VersionConflict(cart.version)
+
+    def add_item(self, cart_code, product, quantity, expected_version=None):
+        with transaction.atomic(using=shard_for(cart_code)):
+            # Get or create cart if it doesn't exist
+            cart, created = Cart.objects.for_code(cart_code).get_or_create(cart_code=cart_code)
+            self._bump(cart, expected_version)
+
+            # Get or create cart item
+            cart_item, created = cart.items.get_or_create(
+                product=product,
+                defaults={'quantity': 0, 'unit_price': product.price}
+            )
+
+            # Update unit_price if price changed
+            if cart_item.unit_price != product.price:
+                cart_item.unit_price = product.price
+
+            # Add quantity
+            cart_item.quantity += quantity
+            cart_item.save()
+        publish_cart_event(cart.cart_code, cart.version, cart.user_id)
+        return cart
+
+    def update_item(self, cart_code, item_id, quantity, expected_version=None):
+        with transaction.atomic(using=shard_for(cart_code)):
+            cart = get_object_or_404(Cart.objects.for_code(cart_code), cart_code=cart_code)
+            cart_item = get_object_or_404(cart.items.all(), id=item_id)
+            self._bump(cart, expected_version)
+            cart_item.quantity = quantity
+            cart_item.save()
+        publish_cart_event(cart.cart_code, cart.version, cart.user_id)
+        return cart
+
+    def remove_item(self, cart_code, item_id, expected_version=None):
+        with transaction.atomic(using=shard_for(cart_code)):
+            cart = get_object_or_404(Cart.objects.for_code(cart_code), cart_code=cart_code)
+            cart_item = get_object_or_404(cart.items.all(), id=item_id)
+            self._bump(cart, expected_version)
+            cart_item.delete()
+        publish_cart_event(cart.cart_code, cart.version, cart.user_id)
+        return cart
+
+    def adjust_item(self, cart_code, item_id, delta, expected_version=None):
+        """Change an item's quantity by delta, removing it at zero; returns (cart, removed)"""
+        with transaction.atomic(using=shard_for(cart_code)):
+            cart = get_object_or_404(Cart.objects.for_code(cart_code), cart_code=cart_code)
+            # Bump first: the UPDATE locks the cart row, so the quantity read below is the latest one
+            self._bump(cart, expected_version)
+            cart_item = get_object_or_404(cart.items.select_for_update(), id=item_id)
+            cart_item.quantity += delta
+            removed = cart_item.quantity <= 0
+            if removed:
+                cart_item.delete()
+            else:
+                cart_item.save(update_fields=['quantity'])
+        publish_cart_event(cart.cart_code, cart.version, cart.user_id)
+        return cart, removed
+
+    def flush(self, cart_code):
+        """Persist pending changes for one cart (nothing is ever pending here)"""
+
+    def invalidate(self, cart_code):
+        """Drop any cached copy of a cart after it was changed in the database"""
+
+    def forget(self, cart_codes):
+        """Drop cached copies of carts that no longer exist"""
+
+    @contextmanager
+    def direct_write(self, cart_code):
+        """Wrap code that modifies a cart's rows directly"""
+        yield
+
+    @contextmanager
+    def direct_write_many(self, cart_codes):
+        """Wrap code that modifies several carts' rows directly"""
+        yield
+
+
+class CacheCartStore(DatabaseCartStore):
+    """Hot carts in the cache, persisted to the database write-behind"""
+
+    def __init__(self):
+        if not is_shared(settings.CART_STORE_CACHE) and not settings.CART_STORE_ALLOW_LOCAL_CACHE:
+            raise ImproperlyConfigured(
+                f"CART_STORE = 'cache' needs a cache shared by every process, but CART_STORE_CACHE "
+                f"({settings.CART_STORE_CACHE!r}) is local to each one. Point it at Redis or Memcached, or set "
+                f"CART_STORE_ALLOW_LOCAL_CACHE for a single-process setup."
+            )
+        self.cache = caches[settings.CART_STORE_CACHE]
+        self.timeout = settings.CART_STORE_TIMEOUT
+        self.flush_interval = settings.CART_STORE_FLUSH_INTERVAL
+        self.flush_batch = settings.CART_STORE_FLUSH_BATCH
+        self._dirty = set()
+        self._dirty_lock = threading.Lock()
+        self._flusher = None
+
+    # Snapshots
+
+    def _key(self, cart_code):
+        return f'cart:{cart_code}'
+
+    def _lock_key(self, cart_code):
+        return f'cart-lock:{cart_code}'
+
+    def _acquire(self, cart_code, wait=None):
+        """Take the cart's lock, waiting up to wait (default LOCK_TIMEOUT) seconds; returns the lock token or None"""
+        key = self._lock_key(cart_code)
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + (LOCK_TIMEOUT if wait is None else wait)
+        while not self.cache.add(key, token, LOCK_TIMEOUT):
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(0.005)
+        return token
+
+    def _release(self, cart_code, token):
+        key = self._lock_key(cart_code)
+        # Only delete our own lock, not one taken after ours expired
+        if self.cache.get(key) == token:
+            self.cache.delete(key)
+
+    @contextmanager
+    def _locked(self, cart_code):
+        """Serialize read-modify-write cycles on one cart across processes"""
+        token = self._acquire(cart_code)
+        if token is None:
+            raise CartBusy()
+        try:
+            yield
+        finally:
+            self._release(cart_code, token)
+
+    def _snapshot(self, cart):
+        items = []
+        for item in with_products(cart.items.all()):
+            items.append({
+                'id': item.id,
+                'quantity': item.quantity,
+                'unit_price': item.unit_price,
+                'product': self._product_data(item.product),
+            })
+        return {
+            'id': cart.id,
+            'cart_code': cart.cart_code,
+            'user_id': cart.user_id,
+            'paid': cart.paid,
+            'version': cart.version,
+            'items': items,
+            'removed': [],  # ids of items deleted since the last flush
+            'dirty': False,
+        }
+
+    def _product_data(self, product):
+        return {
+            'id': product.id,
+            'name': product.name,
+            'slug': product.slug,
+            'description': product.description,
+            'price': product.price,
+            'category': product.category,
+            'image': product.image.name,
+        }
+
+    def _load(self, cart_code):
+        snapshot = self.cache.get(self._key(cart_code))
+        if snapshot is None:
+            cart = Cart.objects.for_code(cart_code).filter(cart_code=cart_code).first()
+            if cart is None:
+                return None
+            snapshot = self._snapshot(cart)
+            self.cache.add(self._key(cart_code), snapshot, self.timeout)
+        return snapshot
+
+    def _bump(self, snapshot, expected_version):
+        # Callers hold the cart lock, so compare-and-increment is atomic
+        if expected_version is not None and snapshot['version'] != expected_version:
+            raise VersionConflict(snapshot['version'])
+        snapshot['version'] += 1
+
+    def _store(self, snapshot):
+        snapshot['dirty'] = True
+        self.cache.set(self._key(snapshot['cart_code']), snapshot, self.timeout)
+        with self._dirty_lock:
+            self._dirty.add(snapshot['cart_code'])
+
+    def _schedule_flush(self):
+        # Called outside the cart lock; an interval of 0 means write-through
+        if self.flush_interval <= 0:
+            self.flush_pending()
+        else:
+            self._start_flusher()
+
+    def _as_cart(self, snapshot):
+        """Build unsaved model instances the serializers can render without queries"""
+        cart = Cart(id=snapshot['id'], cart_code=snapshot['cart_code'], user_id=snapshot['user_id'],
+                    paid=snapshot['paid'], version=snapshot['version'])
+        items = [
+            CartItem(id=item['id'], cart=cart, product=Product(**item['product']),
+                     quantity=item['quantity'], unit_price=item['unit_price'])
+            for item in snapshot['items']
+        ]
+        queryset = cart.items.all()
+        queryset._result_cache = items
+        queryset._prefetch_done = True
+        cart._prefetched_objects_cache = {'items': queryset}
+        return cart
+
+    def _find_item(self, snapshot, item_id):
+        for item in snapshot['items']:
+            if str(item['id']) == str(item_id):
+                return item
+        raise Http404('No CartItem matches the given query.')
+
+    # Cart operations
+
+    def get_cart(self, cart_code):
+        snapshot = self._load(cart_code)
+        if snapshot is None:
+            raise Http404('No Cart matches the given query.')
+        return self._as_cart(snapshot)
+
+    def current(self, cart):
+        return self.get_cart(cart.cart_code)
+
+    def get_version(self, cart_code):
+        snapshot = self._load(cart_code)
+        if snapshot is None:
+            raise Http404('No Cart matches the given query.')
+        return snapshot['version']
+
+    def add_item(self, cart_code, product, quantity, expected_version=None):
+        with self._locked(cart_code):
+            snapshot = self._load(cart_code)
+            if snapshot is None:
+                cart, created = Cart.objects.for_code(cart_code).get_or_create(cart_code=cart_code)
+                snapshot = self._snapshot(cart)
+            self._bump(snapshot, expected_version)
+
+            item = next((i for i in snapshot['items'] if i['product']['id'] == product.id), None)
+            if item is None:
+                # New items are written through so they get a real id
+                cart_item = CartItem.objects.using(shard_for(cart_code)).create(
+                    cart_id=snapshot['id'], product=product, quantity=quantity, unit_price=product.price
+                )
+                snapshot['items'].append({
+                    'id': cart_item.id,
+                    'quantity': cart_item.quantity,
+                    'unit_price': cart_item.unit_price,
+                    'product': self._product_data(product),
+                })
+            else:
+                if item['unit_price'] != product.price:
+                    CartItem.objects.using(shard_for(cart_code)).filter(pk=item['id']).update(unit_price=product.price)
+                    item['unit_price'] = product.price
+                    item['product'] = self._product_data(product)
+                item['quantity'] += quantity
+
+            self._store(snapshot)
+        self._schedule_flush()
+        publish_cart_event(cart_code, snapshot['version'], snapshot['user_id'])
+        return self._as_cart(snapshot)
+
+    def update_item(self, cart_code, item_id, quantity, expected_version=None):
+        with self._locked(cart_code):
+            snapshot = self._load(cart_code)
+            if snapshot is None:
+                raise Http404('No Cart matches the given query.')
+            item = self._find_item(snapshot, item_id)
+            self._bump(snapshot, expected_version)
+            item['quantity'] = quantity
+            self._store(snapshot)
+        self._schedule_flush()
+        publish_cart_event(cart_code, snapshot['version'], snapshot['user_id'])
+        return self._as_cart(snapshot)
+
+    def remove_item(self, cart_code, item_id, expected_version=None):
+        with self._locked(cart_code):
+            snapshot = self._load(cart_code)
+            if snapshot is None:
+                raise Http404('No Cart matches the given query.')
+            item = self._find_item(snapshot, item_id)
+            self._bump(snapshot, expected_version)
+            snapshot['items'].remove(item)
+            snapshot.setdefault('removed', []).append(item['id'])
+            self._store(snapshot)
+        self._schedule_flush()
+        publish_cart_event(cart_code, snapshot['version'], snapshot['user_id'])
+        return self._as_cart(snapshot)
+
+    def adjust_item(self, cart_code, item_id, delta, expected_version=None):
+        with self._locked(cart_code):
+            snapshot = self._load(cart_code)
+            if snapshot is None:
+                raise Http404('No Cart matches the given query.')
+            item = self._find_item(snapshot, item_id)
+            self._bump(snapshot, expected_version)
+            item['quantity'] += delta
+            removed = item['quantity'] <= 0
+            if removed:
+                snapshot['items'].remove(item)
+                snapshot.setdefault('removed', []).append(item['id'])
+            self._store(snapshot)
+        self._schedule_flush()
+        publish_cart_event(cart_code, snapshot['version'], snapshot['user_id'])
+        return self._as_cart(snapshot), removed
+
+    # Persistence
+
+    def _persist(self, snapshots):
+        """
+        Write quantities, removals and versions for a batch of carts (whose
+        locks the caller holds), one transaction per shard. Returns the codes
+        of carts left alone because the database copy moved past the snapshot.
+        """
+        by_shard = {}
+        for snapshot in snapshots:
+            by_shard.setdefault(shard_for(snapshot['cart_code']), []).append(snapshot)
+        stale = set()
+        for using, shard_snapshots in by_shard.items():
+            stale.update(self._persist_shard(using, shard_snapshots))
+        return stale
+
+    def _persist_shard(self, using, snapshots):
+        now = timezone.now()
+        with transaction.atomic(using=using):
+            stored = dict(
+                Cart.objects.using(using).select_for_update()
+                .filter(pk__in=[snapshot['id'] for snapshot in snapshots]).values_list('pk', 'version')
+            )
+            # A cart changed (or deleted) straight in the database after its snapshot was taken is not overwritten
+            fresh = [s for s in snapshots if s['id'] in stored and stored[s['id']] <= s['version']]
+            items = [CartItem(pk=item['id'], quantity=item['quantity']) for s in fresh for item in s['items']]
+            removed = [pk for s in fresh for pk in s.get('removed', [])]
+            carts = [Cart(pk=s['id'], version=s['version'], modified_at=now) for s in fresh]
+            CartItem.objects.using(using).bulk_update(items, ['quantity'], batch_size=500)
+            if removed:
+                CartItem.objects.using(using).filter(cart_id__in=[s['id'] for s in fresh], pk__in=removed).delete()
+            Cart.objects.using(using).bulk_update(carts, ['version', 'modified_at'], batch_size=500)
+        stale = {s['cart_code'] for s in snapshots} - {s['cart_code'] for s in fresh}
+        if stale:
+            logger.warning('Dropped cached cart(s) %s: changed or deleted in the database since cached',
+                           ', '.join(sorted(stale)))
+        return stale
+
+    def _flushed(self, snapshots, stale):
+        """Mark persisted snapshots clean and drop stale ones, so they are reloaded from the database"""
+        for snapshot in snapshots:
+            if snapshot['cart_code'] in stale:
+                self.cache.delete(self._key(snapshot['cart_code']))
+            else:
+                snapshot['dirty'] = False
+                snapshot['removed'] = []
+                self.cache.set(self._key(snapshot['cart_code']), snapshot, self.timeout)
+
+    def _flush_locked(self, cart_code):
+        snapshot = self.cache.get(self._key(cart_code))
+        if snapshot is not None and snapshot['dirty']:
+            self._flushed([snapshot], self._persist([snapshot]))
+        with self._dirty_lock:
+            self._dirty.discard(cart_code)
+
+    def flush(self, cart_code):
+        with self._locked(cart_code):
+            self._flush_locked(cart_code)
+
+    def flush_pending(self):
+        """Persist every cart changed in this process, in batches"""
+        busy = set()
+        try:
+            while True:
+                with self._dirty_lock:
+                    codes = [self._dirty.pop() for _ in range(min(self.flush_batch, len(self._dirty)))]
+                if not codes:
+                    return
+                tokens = {}
+                for code in codes:
+                    token = self._acquire(code, wait=0)
+                    if token is None:
+                        # Being written right now; flushed on the next round
+                        busy.add(code)
+                    else:
+                        tokens[code] = token
+                try:
+                    snapshots = [
+                        snapshot for snapshot in self.cache.get_many([self._key(code) for code in tokens]).values()
+                        if snapshot['dirty']
+                    ]
+                    if snapshots:
+                        try:
+                            stale = self._persist(snapshots)
+                        except Exception:
+                            with self._dirty_lock:
+                                self._dirty.update(tokens)
+                            raise
+                        self._flushed(snapshots, stale)
+                finally:
+                    for code, token in tokens.items():
+                        self._release(code, token)
+        finally:
+            if busy:
+                with self._dirty_lock:
+                    self._dirty.update(busy)
+
+    def _start_flusher(self):
+        if self._flusher is not None:
+            return
+        with self._dirty_lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, name='cart-store-flusher', daemon=True)
+                self._flusher.start()
+                atexit.register(self.flush_pending)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush_pending()
+            except Exception:
+                logger.exception('Cart write-behind flush failed')
+            finally:
+                close_old_connections()
+
+    def invalidate(self, cart_code):
+        with self._locked(cart_code):
+            self._flush_locked(cart_code)
+            self.cache.delete(self._key(cart_code))
+
+    def forget(self, cart_codes):
+        self.cache.delete_many([self._key(code) for code in cart_codes])
+        with self._dirty_lock:
+            self._dirty.difference_update(cart_codes)
+
+    @contextmanager
+    def direct_write(self, cart_code):
+        with self.direct_write_many([cart_code]):
+            yield
+
+    @contextmanager
+    def direct_write_many(self, cart_codes):
+        # The locks are held throughout, so no snapshot write lands between the flush and the database change
+        codes = sorted(set(cart_codes))
+        keys = [self._key(code) for code in codes]
+        tokens = {}
+        try:
+            for code in codes:
+                token = self._acquire(code)
+                if token is None:
+                    raise CartBusy()
+                tokens[code] = token
+            snapshots = [snapshot for snapshot in self.cache.get_many(keys).values() if snapshot['dirty']]
+            if snapshots:
+                self._flushed(snapshots, self._persist(snapshots))
+            with self._dirty_lock:
+                self._dirty.difference_update(codes)
+            try:
+                yield
+            finally:
+                self.cache.delete_many(keys)
+        finally:
+            for code, token in tokens.items():
+                self._release(code, token)
+
+
+_store = None
+
+
+def get_cart_store():
+    """Return the process-wide cart store selected by settings.CART_STORE"""
+    global _store
+    if _store is None:
+        _store = CacheCartStore() if settings.CART_STORE == 'cache' else DatabaseCartStore()
+    return _store
+
+
+def _reset_store(setting, **kwargs):
+    global _store
+    if setting.startswith('CART_STORE') or setting == 'CACHES':
+        if isinstance(_store, CacheCartStore):
+            _store.flush_pending()
+        _store = None
+
+
+setting_changed.connect(_reset_store)
@@ -1,3 +1,430 @@
-from django.test import TestCase
+import gzip
+import json
+import os
+import tempfile
+import threading
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.checks import run_checks
+from django.core.management import call_command
+from django.db import connections
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from core.models import CustomUser, Transaction
+from shop_app.models import Product
+from .models import Cart, CartDirectory, CartItem
+from .routers import CartShardRouter
+from .sharding import cart_databases, shard_for
+from .store import CacheCartStore, CartBusy, get_cart_store
+from .views import MergeCartView
+
+
+class CartTestCase(TestCase):
+    databases = '__all__'  # every cart shard when CART_SHARD_COUNT > 1
+
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.create(name='Shirt', price=2, image='products/a.jpg')
+        self.other = Product.objects.create(name='Socks', price=3, image='products/b.jpg')
+        self.user = CustomUser.objects.create_user(username='u', password='p', email='u@example.com')
+
+    def make_cart(self, cart_code, user=None, quantity=1, idle_days=0):
+        cart = Cart.objects.for_code(cart_code).create(cart_code=cart_code, user=user)
+        cart.items.create(product=self.product, quantity=quantity, unit_price=self.product.price)
+        if idle_days:
+            when = timezone.now() - timedelta(days=idle_days)
+            self.carts(cart_code).update(created_at=when, modified_at=when)
+        return cart
+
+    def carts(self, cart_code):
+        """The cart, queried on whichever database holds it"""
+        return Cart.objects.for_code(cart_code).filter(cart_code=cart_code)
+
+    def items(self, cart_code):
+        return CartItem.objects.using(shard_for(cart_code)).filter(cart__cart_code=cart_code)
+
+    def all_cart_codes(self):
+        return {code for using in cart_databases()
+                for code in Cart.objects.using(using).values_list('cart_code', flat=True)}
+
+    def all_items_count(self):
+        return sum(CartItem.objects.using(using).count() for using in cart_databases())
+
+
+class PurgeCartsTests(CartTestCase):
+    def setUp(self):
+        super().setUp()
+        self.make_cart('idle', idle_days=40)
+        self.make_cart('recent', idle_days=5)
+        self.make_cart('owned', user=self.user, idle_days=40)
+        paying = self.make_cart('paying', idle_days=40)
+        Transaction.objects.create(user=self.user, cart=paying, transaction_id='paying-1', amount=2,
+                                   payment_method='paypal')
+
+    def test_purges_only_idle_guest_carts(self):
+        out = StringIO()
+        call_command('purge_carts', days=30, chunk_size=1, stdout=out)
+        self.assertIn('Purged 1 cart(s), 2 row(s)', out.getvalue())
+        self.assertEqual(self.all_cart_codes(), {'recent', 'owned', 'paying'})
+        self.assertEqual(self.all_items_count(), 3)
+
+    def test_dry_run_deletes_nothing(self):
+        out = StringIO()
+        call_command('purge_carts', days=30, dry_run=True, stdout=out)
+        self.assertIn('1 guest cart(s)', out.getvalue())
+        self.assertEqual(len(self.all_cart_codes()), 4)
+
+    def test_archive(self):
+        path = os.path.join(tempfile.mkdtemp(), 'carts.jsonl.gz')
+        call_command('purge_carts', days=30, archive=path, stdout=StringIO())
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual([row['cart_code'] for row in rows], ['idle'])
+        self.assertEqual(rows[0]['items'][0]['quantity'], 1)
+
+
+class CartFlowMixin:
+    def test_add_update_remove(self):
+        r = self.client.post('/api/add_item/', {'cart_code': 'abc', 'product_id': self.product.id, 'quantity': 2})
+        self.assertEqual(r.status_code, 200, r.content)
+        self.client.post('/api/add_item/', {'cart_code': 'abc', 'product_id': self.other.id})
+        r = self.client.post('/api/add_item/', {'cart_code': 'abc', 'product_id': self.product.id})
+        self.assertEqual(r.json()['total_quantity'], 4)
+        socks = next(i['id'] for i in r.json()['items'] if i['product']['id'] == self.other.id)
+
+        r = self.client.post('/api/update_item/', {'cart_code': 'abc', 'item_id': socks, 'quantity': 5})
+        self.assertEqual(r.json()['total_quantity'], 8)
+        self.assertEqual(self.client.get('/api/cart/?cart_code=abc').json()['total_quantity'], 8)
+        r = self.client.post('/api/delete_item/', {'cart_code': 'abc', 'item_id': socks})
+        self.assertEqual(r.json()['total_quantity'], 3)
+
+        get_cart_store().flush('abc')
+        self.assertEqual(list(self.items('abc').values_list('product_id', 'quantity')), [(self.product.id, 3)])
+        self.assertEqual(self.client.get('/api/cart/?cart_code=zzz').status_code, 404)
+
+
+class DatabaseCartStoreTests(CartFlowMixin, CartTestCase):
+    pass
+
+
+@override_settings(CART_STORE='cache', CART_STORE_FLUSH_INTERVAL=60, CART_STORE_ALLOW_LOCAL_CACHE=True)
+class CacheCartStoreTests(CartFlowMixin, CartTestCase):
+    def add(self, cart_code, product, quantity=1):
+        return get_cart_store().add_item(cart_code, product, quantity)
+
+    def test_writes_are_deferred_until_flush(self):
+        cart = self.add('abc', self.product)
+        item = cart.items.all()[0]
+        get_cart_store().update_item('abc', item.id, 7)
+        self.assertEqual(self.items('abc').get().quantity, 1)
+        get_cart_store().flush_pending()
+        self.assertEqual(self.items('abc').get().quantity, 7)
+        self.assertEqual(self.carts('abc').get().version, 2)
+
+    def test_flush_keeps_items_missing_from_the_snapshot(self):
+        cart = self.add('abc', self.product)
+        item = cart.items.all()[0]
+        # Written through by another process after this snapshot was cached
+        other = CartItem.objects.using(shard_for('abc')).create(cart_id=cart.id, product=self.other, quantity=1,
+                                                                unit_price=3)
+        get_cart_store().update_item('abc', item.id, 4)
+        get_cart_store().flush('abc')
+        self.assertEqual(dict(self.items('abc').values_list('pk', 'quantity')), {item.id: 4, other.id: 1})
+
+    def test_flush_deletes_removed_items(self):
+        self.add('abc', self.product)
+        cart = self.add('abc', self.other)
+        socks = next(i for i in cart.items.all() if i.product.id == self.other.id)
+        get_cart_store().remove_item('abc', socks.id)
+        get_cart_store().flush('abc')
+        self.assertEqual(list(self.items('abc').values_list('product_id', flat=True)), [self.product.id])
+
+    def test_stale_snapshot_is_not_persisted(self):
+        cart = self.add('abc', self.product)
+        get_cart_store().update_item('abc', cart.items.all()[0].id, 9)
+        self.carts('abc').update(version=10)
+        get_cart_store().flush('abc')
+        self.assertEqual(self.items('abc').get().quantity, 1)
+        self.assertEqual(get_cart_store().get_version('abc'), 10)
+
+    def test_locked_cart_is_busy(self):
+        cart = self.add('abc', self.product)
+        store = get_cart_store()
+        token = store._acquire('abc')
+        with mock.patch('cart_app.store.LOCK_TIMEOUT', 0.05):
+            with self.assertRaises(CartBusy):
+                store.update_item('abc', cart.items.all()[0].id, 3)
+            r = self.client.post('/api/update_item/', {'cart_code': 'abc', 'item_id': cart.items.all()[0].id,
+                                                       'quantity': 3})
+        self.assertEqual(r.status_code, 503)
+        self.assertEqual(r['Retry-After'], '1')
+        store._release('abc', token)
+        self.assertEqual(store.get_cart('abc').items.all()[0].quantity, 1)
+
+    def test_flush_pending_retries_busy_carts(self):
+        cart = self.add('abc', self.product)
+        store = get_cart_store()
+        store.update_item('abc', cart.items.all()[0].id, 5)
+        token = store._acquire('abc')
+        store.flush_pending()
+        self.assertEqual(self.items('abc').get().quantity, 1)
+        store._release('abc', token)
+        store.flush_pending()
+        self.assertEqual(self.items('abc').get().quantity, 5)
+
+    def test_merge_locks_in_the_same_order_as_repricing(self):
+        self.add('zzz', self.product, 2)
+        user_cart = self.make_cart('aaa', user=self.user)
+        store = get_cart_store()
+        acquired = []
+        acquire = store._acquire
+
+        def record(cart_code):
+            acquired.append(cart_code)
+            return acquire(cart_code)
+
+        request = APIRequestFactory().post('/api/cart/merge/', {'cart_code': 'zzz'})
+        force_authenticate(request, user=self.user)
+        with mock.patch.object(store, '_acquire', record):
+            r = MergeCartView.as_view()(request)
+        self.assertEqual(r.status_code, 200, r.data)
+        self.assertEqual(acquired, ['aaa', 'zzz'])
+        self.assertEqual(self.items('aaa').get().quantity, 3)
+        self.assertEqual(r.data['cart_code'], user_cart.cart_code)
+
+    @override_settings(CART_STORE_ALLOW_LOCAL_CACHE=False)
+    def test_refuses_a_local_cache(self):
+        with self.assertRaises(ImproperlyConfigured):
+            CacheCartStore()
+
+
+class VersionMixin:
+    def test_conditional_writes(self):
+        r = self.client.post('/api/add_item/', {'cart_code': 'abc', 'product_id': self.product.id})
+        self.assertEqual(r['ETag'], '"1"')
+        item = r.json()['items'][0]['id']
+
+        data = {'cart_code': 'abc', 'item_id': item, 'quantity': 3}
+        r = self.client.post('/api/update_item/', data, HTTP_IF_MATCH='"0"')
+        self.assertEqual(r.status_code, 412)
+        self.assertEqual(r.json()['version'], 1)
+        r = self.client.post('/api/update_item/', data, HTTP_IF_MATCH='"1"')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r['ETag'], '"2"')
+        r = self.client.post('/api/update_item/', data, HTTP_IF_MATCH='not-a-version')
+        self.assertEqual(r.status_code, 400)
+
+        self.assertEqual(self.client.get('/api/cart/?cart_code=abc&version_only=1').json(),
+                         {'cart_code': 'abc', 'version': 2})
+        self.assertEqual(self.client.get('/api/cart/?cart_code=abc', HTTP_IF_NONE_MATCH='"2"').status_code, 304)
+        r = self.client.get('/api/cart/?cart_code=abc', HTTP_IF_NONE_MATCH='"1"')
+        self.assertEqual(r.json()['items'][0]['quantity'], 3)
+
+        get_cart_store().flush('abc')
+        self.assertEqual(self.carts('abc').get().version, 2)
+
+    def test_increment_and_decrement(self):
+        r = self.client.post('/api/add_item/', {'cart_code': 'abc', 'product_id': self.product.id})
+        url = f"/api/cart/abc/item/{r.json()['items'][0]['id']}/"
+        r = self.client.patch(url, {'action': 'increment'}, content_type='application/json', HTTP_IF_MATCH='"1"')
+        self.assertEqual(r.json()['cart']['total_quantity'], 2)
+        self.assertEqual(r['ETag'], '"2"')
+        self.client.patch(url, {'action': 'decrement'}, content_type='application/json')
+        r = self.client.patch(url, {'action': 'decrement'}, content_type='application/json')
+        self.assertEqual(r.json()['message'], 'Item removed from cart')
+        r = self.client.patch(url, {'action': 'increment'}, content_type='application/json')
+        self.assertEqual(r.status_code, 404)
+
+
+class DatabaseCartVersionTests(VersionMixin, CartTestCase):
+    pass
+
+
+@override_settings(CART_STORE='cache', CART_STORE_FLUSH_INTERVAL=60, CART_STORE_ALLOW_LOCAL_CACHE=True)
+class CacheCartVersionTests(VersionMixin, CartTestCase):
+    def test_concurrent_increments_all_count(self):
+        store = get_cart_store()
+        cart = store.add_item('abc', self.product, 1)
+        item_id = cart.items.all()[0].id
+        threads = [threading.Thread(target=store.adjust_item, args=('abc', item_id, 1)) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(store.get_cart('abc').items.all()[0].quantity, 11)
+        self.assertEqual(store.get_version('abc'), 11)
+
+
+class RepriceMixin:
+    def test_price_change_reprices_open_carts(self):
+        store = get_cart_store()
+        cart = store.add_item('open', self.product, 1)
+        store.update_item('open', cart.items.all()[0].id, 4)
+        store.add_item('paid', self.product, 1)
+        store.flush('paid')
+        self.carts('paid').update(paid=True)
+
+        product = Product.objects.get(pk=self.product.pk)
+        product.price = 5
+        product.save()
+
+        r = self.client.get('/api/cart/?cart_code=open')
+        self.assertEqual(r['ETag'], '"3"')
+        self.assertEqual(r.json()['items'][0]['quantity'], 4)
+        self.assertEqual(r.json()['items'][0]['unit_price'], '5.00')
+        store.flush('open')
+        self.assertEqual(self.items('open').get().quantity, 4)
+        self.assertEqual(self.items('open').get().unit_price, 5)
+        self.assertEqual(self.items('paid').get().unit_price, 2)
+
+
+class DatabaseRepriceTests(RepriceMixin, CartTestCase):
+    pass
+
+
+@override_settings(CART_STORE='cache', CART_STORE_FLUSH_INTERVAL=60, CART_STORE_ALLOW_LOCAL_CACHE=True)
+class CacheRepriceTests(RepriceMixin, CartTestCase):
+    pass
+
+
+SHARDS = ['cart_shard_0', 'cart_shard_1', 'cart_shard_2']
+
+
+class ShardingTests(CartTestCase):
+    @override_settings(CART_SHARDS=SHARDS, DATABASE_ROUTERS=['cart_app.routers.CartShardRouter'])
+    def test_routing(self):
+        self.assertEqual(shard_for('abc'), shard_for('abc'))
+        self.assertEqual({shard_for(f'cart-{i}') for i in range(50)}, set(SHARDS))
+
+        router = CartShardRouter()
+        cart = Cart(cart_code='abc')
+        self.assertEqual(router.db_for_read(Cart, instance=cart), shard_for('abc'))
+        self.assertEqual(router.db_for_write(CartItem, instance=CartItem(cart=cart)), shard_for('abc'))
+        self.assertEqual(router.db_for_read(Product), 'default')
+        directory = CartDirectory.objects.create(cart_code='xyz', shard='cart_shard_2')
+        payment = Transaction(cart_id=directory.pk)
+        self.assertEqual(router.db_for_read(Cart, instance=payment), 'cart_shard_2')
+
+    @override_settings(CART_SHARDS=[])
+    def test_unsharded_routing(self):
+        self.assertEqual(shard_for('abc'), 'default')
+        self.assertIsNone(CartShardRouter().db_for_read(Cart, instance=Cart(cart_code='abc')))
+
+    @override_settings(CART_SHARDS=['default'])
+    def test_directory_follows_routed_fields_only(self):
+        cart = Cart.objects.create(cart_code='abc')
+        self.assertEqual(CartDirectory.objects.get().pk, cart.pk)
+        cart = Cart.objects.get(pk=cart.pk)
+        with self.assertNumQueries(3):  # savepoint, cart, release
+            cart.save()
+        cart.user, cart.paid = self.user, True
+        cart.save()
+        self.assertEqual(CartDirectory.objects.values_list('user', 'paid').get(), (self.user.pk, True))
+
+    @override_settings(CART_SHARDS=['default'], CART_STORE='cache', CART_STORE_ALLOW_LOCAL_CACHE=True)
+    def test_deleting_a_user_deletes_their_carts(self):
+        get_cart_store().add_item('abc', self.product, 1)
+        Cart.objects.filter(cart_code='abc').update(user=self.user)
+        CartDirectory.objects.filter(cart_code='abc').update(user=self.user)
+        self.user.delete()
+        self.assertFalse(Cart.objects.exists())
+        self.assertFalse(CartDirectory.objects.exists())
+        self.assertIsNone(cache.get('cart:abc'))
+
+    @override_settings(CART_SHARDS=SHARDS)
+    def test_changed_shard_count_is_refused(self):
+        for i in range(10):
+            CartDirectory.objects.create(cart_code=f'cart-{i}', shard=shard_for(f'cart-{i}'))
+        self.assertEqual(run_checks(databases=['default']), [])
+        with override_settings(CART_SHARDS=SHARDS[:2]):
+            errors = run_checks(databases=['default'])
+        self.assertEqual([error.id for error in errors], ['cart_app.E001'])
+
+
+# Three more SQLite files for MultiShardTests. They are added to DATABASES when this module is
+# imported, before the test runner creates and migrates the test databases.
+SHARD_FILES = ['test_cart_shard_0', 'test_cart_shard_1', 'test_cart_shard_2']
+_shard_dir = tempfile.mkdtemp()
+for _alias in SHARD_FILES:
+    _path = os.path.join(_shard_dir, f'{_alias}.sqlite3')
+    settings.DATABASES[_alias] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': _path,
+                                  'TEST': {'NAME': os.path.join(_shard_dir, f'test_{_alias}.sqlite3')}}
+    connections.settings[_alias] = connections.configure_settings(settings.DATABASES)[_alias]
+
+
+@override_settings(CART_SHARDS=SHARD_FILES, DATABASE_ROUTERS=['cart_app.routers.CartShardRouter'])
+class MultiShardTests(CartTestCase):
+    """Carts spread over three SQLite files, whatever CART_SHARD_COUNT the suite runs with"""
+
+    def setUp(self):
+        super().setUp()
+        # One cart code per shard
+        self.codes = {}
+        for i in range(100):
+            self.codes.setdefault(shard_for(f'cart-{i}'), f'cart-{i}')
+        self.codes = [self.codes[alias] for alias in SHARD_FILES]
+
+    def test_carts_live_on_their_shard(self):
+        for code in self.codes:
+            self.client.post('/api/add_item/', {'cart_code': code, 'product_id': self.product.id})
+        for alias, code in zip(SHARD_FILES, self.codes):
+            self.assertEqual(list(Cart.objects.using(alias).values_list('cart_code', flat=True)), [code])
+            self.assertEqual(CartItem.objects.using(alias).count(), 1)
+        self.assertEqual(dict(CartDirectory.objects.values_list('cart_code', 'shard')),
+                         dict(zip(self.codes, SHARD_FILES)))
+        self.assertFalse(Cart.objects.using('default').exists())
+
+        # Rows on the default database find their cart through the directory
+        cart = self.carts(self.codes[2]).get()
+        payment = Transaction.objects.create(user=self.user, cart=cart, transaction_id='t-1', amount=2,
+                                             payment_method='paypal')
+        self.assertEqual(Transaction.objects.get(pk=payment.pk).cart.cart_code, self.codes[2])
+
+        user_cart = Cart.objects.for_code(self.codes[1]).get()
+        user_cart.user = self.user
+        user_cart.save()
+        self.assertEqual(Cart.objects.get_or_create_for_user(self.user), (user_cart, False))
+
+    def test_merge_across_shards(self):
+        self.make_cart(self.codes[0], quantity=2)
+        user_cart = self.make_cart(self.codes[1], user=self.user)
+        user_cart.items.create(product=self.other, quantity=1, unit_price=self.other.price)
+        # Called directly: /api/cart/merge/ is shadowed by /api/cart/<cart_code>/
+        request = APIRequestFactory().post('/api/cart/merge/', {'cart_code': self.codes[0]})
+        force_authenticate(request, user=self.user)
+        r = MergeCartView.as_view()(request)
+        self.assertEqual(r.status_code, 200, r.data)
+        self.assertEqual(r.data['cart_code'], self.codes[1])
+        self.assertEqual(dict(self.items(self.codes[1]).values_list('product_id', 'quantity')),
+                         {self.product.id: 3, self.other.id: 1})
+        self.assertFalse(Cart.objects.using(SHARD_FILES[0]).exists())
+        self.assertEqual(list(CartDirectory.objects.values_list('cart_code', flat=True)), [self.codes[1]])
+
+    def test_purge_across_shards(self):
+        self.make_cart(self.codes[0], idle_days=40)
+        self.make_cart(self.codes[1], user=self.user, idle_days=40)
+        paying = self.make_cart(self.codes[2], idle_days=40)
+        Transaction.objects.create(user=self.user, cart=paying, transaction_id='t-1', amount=2, payment_method='paypal')
+        self.make_cart('recent', idle_days=5)
+        out = StringIO()
+        call_command('purge_carts', days=30, stdout=out)
+        self.assertIn('Purged 1 cart(s)', out.getvalue())
+        self.assertEqual(self.all_cart_codes(), {self.codes[1], self.codes[2], 'recent'})
+        self.assertEqual(set(CartDirectory.objects.values_list('cart_code', flat=True)),
+                         {self.codes[1], self.codes[2], 'recent'})
+
+    def test_reprice_across_shards(self):
+        for code in self.codes:
+            self.make_cart(code)
+        self.carts(self.codes[2]).update(paid=True)
+        self.product.price = 5
+        self.product.save()
+        self.assertEqual([self.items(code).get().unit_price for code in self.codes], [5, 5, 2])
+        self.assertEqual([self.carts(code).get().version for code in self.codes], [1, 1, 0])
@@ -5,68 +5,78 @@ from rest_framework.views import APIView
 from rest_framework.decorators import api_view
 from rest_framework.permissions import IsAuthenticated
 from rest_framework import status
+from rest_framework.exceptions import ParseError
 from .models import Cart, CartItem
 from .serializers import CartSerializer, CartItemSerializer
+from .store import get_cart_store, publish_cart_event
 from shop_app.models import Product
 from django.db.models import Q
+from django.http import Http404
 from django.utils.crypto import get_random_string
 
 
+def cart_etag(version):
+    return f'"{version}"'
+
+
+def expected_version(request):
+    """Cart version from the If-Match header, or None for an unconditional write"""
+    header = request.headers.get('If-Match', '').strip()
+    if not header or header == '*':
+        return None
+    try:
+        return int(header.removeprefix('W/').strip('"'))
+    except ValueError:
+        raise ParseError('If-Match must be a cart ETag such as "3".')
+
+
 class CartView(generics.RetrieveAPIView):
     queryset = Cart.objects.all()
     serializer_class = CartSerializer
     lookup_field = 'cart_code'
 
+    def get_object(self):
+        return get_cart_store().get_cart(self.kwargs['cart_code'])
+
 class CreateCartView(APIView):
     def post(self, request):
         # If user is authenticated, get or create their cart
         if request.user.is_authenticated:
-            cart, created = Cart.objects.get_or_create(
-                user=request.user,
-                paid=False,
-                defaults={'cart_code': get_random_string(11)}
-            )
+            cart, created = Cart.objects.get_or_create_for_user(request.user)
             message = 'User cart retrieved.'
             if created:
                 message = 'New user cart created.'
+            cart = get_cart_store().current(cart)
             serializer = CartSerializer(cart, context={'request': request})
             return Response({'message': message, 'cart': serializer.data}, status=status.HTTP_200_OK)
 
         # For anonymous users, create a new cart
         while True:
             code = get_random_string(11)
-            if not Cart.objects.filter(cart_code=code).exists():
+            if not Cart.objects.for_code(code).filter(cart_code=code).exists():
                 break
-        cart = Cart.objects.create(cart_code=code)
+        cart = Cart.objects.for_code(code).create(cart_code=code)
         serializer = CartSerializer(cart, context={'request': request})
         return Response({'message': 'Guest cart created', 'cart': serializer.data}, status=status.HTTP_201_CREATED)
 
 class AddToCartView(APIView):
     def post(self, request, cart_code, product_slug):
-        cart = get_object_or_404(Cart, cart_code=cart_code)
+        store = get_cart_store()
+        store.get_cart(cart_code)
         product = get_object_or_404(Product, slug=product_slug)
         quantity = int(request.data.get('quantity', 1))
         if quantity < 1:
             return Response({'error': 'Quantity must be at least 1'}, status=status.HTTP_400_BAD_REQUEST)
 
-        cart_item, created = CartItem.objects.get_or_create(
-            cart=cart,
-            product=product,
-            defaults={'quantity': quantity}
-        )
-
-        if not created:
-            cart_item.quantity += quantity
-            cart_item.save()
+        cart = store.add_item(cart_code, product, quantity, expected_version(request))
 
         serializer = CartSerializer(cart, context={'request': request})
-        return Response({'message': 'Item added to cart', 'cart': serializer.data}, status=status.HTTP_200_OK)
+        return Response({'message': 'Item added to cart', 'cart': serializer.data}, status=status.HTTP_200_OK,
+                        headers={'ETag': cart_etag(cart.version)})
 
 class CartItemDetailView(APIView):
     def patch(self, request, cart_code, item_id):
-        cart = get_object_or_404(Cart, cart_code=cart_code)
-        cart_item = get_object_or_404(CartItem, id=item_id, cart=cart)
-
+        store = get_cart_store()
         quantity = request.data.get('quantity')
         action = request.data.get('action')
 
@@ -75,32 +85,32 @@ class CartItemDetailView(APIView):
                 q = int(quantity)
             except (TypeError, ValueError):
                 return Response({'error': 'Quantity must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
-            if q <= 0:
-                cart_item.delete()
-                serializer = CartSerializer(cart, context={'request': request})
-                return Response({'message': 'Item removed from cart', 'cart': serializer.data}, status=status.HTTP_200_OK)
-            cart_item.quantity = q
-            cart_item.save()
+            removed = q <= 0
+            if removed:
+                cart = store.remove_item(cart_code, item_id, expected_version(request))
+            else:
+                cart = store.update_item(cart_code, item_id, q, expected_version(request))
         elif action in ('increment', 'decrement'):
+            # Applied by the store under the cart's lock, so concurrent increments all count
             delta = 1 if action == 'increment' else -1
-            cart_item.quantity += delta
-            if cart_item.quantity <= 0:
-                cart_item.delete()
-                serializer = CartSerializer(cart, context={'request': request})
-                return Response({'message': 'Item removed from cart', 'cart': serializer.data}, status=status.HTTP_200_OK)
-            cart_item.save()
+            cart, removed = store.adjust_item(cart_code, item_id, delta, expected_version(request))
         else:
             return Response({'error': 'Provide quantity or action (increment|decrement)'}, status=status.HTTP_400_BAD_REQUEST)
 
+        if removed:
+            serializer = CartSerializer(cart, context={'request': request})
+            return Response({'message': 'Item removed from cart', 'cart': serializer.data}, status=status.HTTP_200_OK,
+                            headers={'ETag': cart_etag(cart.version)})
+
         serializer = CartSerializer(cart, context={'request': request})
-        return Response({'message': 'Cart item updated', 'cart': serializer.data}, status=status.HTTP_200_OK)
+        return Response({'message': 'Cart item updated', 'cart': serializer.data}, status=status.HTTP_200_OK,
+                        headers={'ETag': cart_etag(cart.version)})
 
     def delete(self, request, cart_code, item_id):
-        cart = get_object_or_404(Cart, cart_code=cart_code)
-        cart_item = get_object_or_404(CartItem, id=item_id, cart=cart)
-        cart_item.delete()
+        cart = get_cart_store().remove_item(cart_code, item_id, expected_version(request))
         serializer = CartSerializer(cart, context={'request': request})
-        return Response({'message': 'Cart item deleted', 'cart': serializer.data}, status=status.HTTP_200_OK)
+        return Response({'message': 'Cart item deleted', 'cart': serializer.data}, status=status.HTTP_200_OK,
+                        headers={'ETag': cart_etag(cart.version)})
 
 class UserCartView(APIView):
     permission_classes = [IsAuthenticated]
@@ -109,16 +119,13 @@ class UserCartView(APIView):
         """
         Get or create the active cart for the logged-in user.
         """
-        cart, created = Cart.objects.get_or_create(
-            user=request.user,
-            paid=False,
-            defaults={'cart_code': get_random_string(11)} # Create a code if new
-        )
+        cart, created = Cart.objects.get_or_create_for_user(request.user)
         # Ensure cart has a code if it was created before the field was added
         if not cart.cart_code:
             cart.cart_code = get_random_string(11)
             cart.save()
 
+        cart = get_cart_store().current(cart)
         serializer = CartSerializer(cart, context={'request': request})
         return Response(serializer.data, status=status.HTTP_200_OK)
 
@@ -132,28 +139,34 @@ class MergeCartView(APIView):
             return Response({'error': 'Guest cart code is required.'}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            guest_cart = Cart.objects.get(cart_code=guest_cart_code, user__isnull=True)
+            guest_cart = Cart.objects.for_code(guest_cart_code).get(cart_code=guest_cart_code, user__isnull=True)
         except Cart.DoesNotExist:
             return Response({'error': 'Guest cart not found or already associated with a user.'}, status=status.HTTP_404_NOT_FOUND)
 
-        user_cart, created = Cart.objects.get_or_create(user=request.user, paid=False)
-
-        # Merge items from guest cart to user cart
-        for guest_item in guest_cart.items.all():
-            # Check if the same product already exists in the user's cart
-            user_item, item_created = CartItem.objects.get_or_create(
-                cart=user_cart,
-                product=guest_item.product,
-                defaults={'quantity': guest_item.quantity}
-            )
-            # If the item already existed, add the quantities
-            if not item_created:
-                user_item.quantity += guest_item.quantity
-                user_item.save()
-
-        # Delete the guest cart after merging
-        guest_cart.delete()
-
+        user_cart, created = Cart.objects.get_or_create_for_user(request.user)
+
+        store = get_cart_store()
+        # Both locks in one call, taken in the same (sorted) order as repricing takes them
+        with store.direct_write_many([guest_cart.cart_code, user_cart.cart_code]):
+            # Merge items from guest cart to user cart
+            for guest_item in guest_cart.items.all():
+                # Check if the same product already exists in the user's cart
+                # (through the related manager, so it runs on the user cart's shard)
+                user_item, item_created = user_cart.items.get_or_create(
+                    product_id=guest_item.product_id,
+                    defaults={'quantity': guest_item.quantity}
+                )
+                # If the item already existed, add the quantities
+                if not item_created:
+                    user_item.quantity += guest_item.quantity
+                    user_item.save()
+
+            # Delete the guest cart after merging
+            guest_cart.delete()
+            user_cart.bump_version()
+        publish_cart_event(user_cart.cart_code, user_cart.version, user_cart.user_id)
+
+        user_cart = store.current(user_cart)
         serializer = CartSerializer(user_cart, context={'request': request})
         return Response(serializer.data, status=status.HTTP_200_OK)
 
@@ -164,15 +177,28 @@ class CartAPIView(APIView):
     """
     GET: Retrieve cart by cart_mode/cart_code query parameter
     Frontend expects: GET /api/cart/?cart_mode=<code>
+
+    Cheap polling: pass ?version_only=1 to get just the version, or send
+    If-None-Match with the last ETag to get 304 when nothing changed.
     """
     def get(self, request):
         cart_code = request.query_params.get('cart_mode') or request.query_params.get('cart_code')
         if not cart_code:
             return Response({'detail': 'cart_mode or cart_code required'}, status=400)
 
-        cart = get_object_or_404(Cart, cart_code=cart_code)
+        store = get_cart_store()
+        version_only = request.query_params.get('version_only')
+        if version_only or 'If-None-Match' in request.headers:
+            version = store.get_version(cart_code)
+            etag = cart_etag(version)
+            if request.headers.get('If-None-Match') == etag:
+                return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+            if version_only:
+                return Response({'cart_code': cart_code, 'version': version}, headers={'ETag': etag})
+
+        cart = store.get_cart(cart_code)
         serializer = CartSerializer(cart, context={'request': request})
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        return Response(serializer.data, status=status.HTTP_200_OK, headers={'ETag': cart_etag(cart.version)})
 
 class AddItemAPIView(APIView):
     """
@@ -190,31 +216,14 @@ class AddItemAPIView(APIView):
 
         quantity = int(request.data.get('quantity', 1))
 
-        # Get or create cart if it doesn't exist
-        cart, created = Cart.objects.get_or_create(cart_code=cart_code)
         product = get_object_or_404(Product, id=product_id)
-
-        # Get or create cart item
-        cart_item, created = CartItem.objects.get_or_create(
-            cart=cart,
-            product=product,
-            defaults={'quantity': 0, 'unit_price': product.price}
-        )
-
-        # Update unit_price if this is a new item or price changed
-        if created or cart_item.unit_price != product.price:
-            cart_item.unit_price = product.price
-            cart_item.save()
-
-        # Add quantity
-        cart_item.quantity += quantity
-        cart_item.save()
+        cart = get_cart_store().add_item(cart_code, product, quantity, expected_version(request))
 
         serializer = CartSerializer(cart, context={'request': request})
         return Response({
             **serializer.data,
             'message': 'Added to cart'
-        }, status=status.HTTP_200_OK)
+        }, status=status.HTTP_200_OK, headers={'ETag': cart_etag(cart.version)})
 
 class UpdateItemAPIView(APIView):
     """
@@ -234,17 +243,13 @@ class UpdateItemAPIView(APIView):
         if quantity < 1:
             return Response({'detail': 'quantity must be at least 1'}, status=400)
 
-        cart = get_object_or_404(Cart, cart_code=cart_code)
-        cart_item = get_object_or_404(CartItem, id=item_id, cart=cart)
-
-        cart_item.quantity = quantity
-        cart_item.save()
+        cart = get_cart_store().update_item(cart_code, item_id, quantity, expected_version(request))
 
         serializer = CartSerializer(cart, context={'request': request})
         return Response({
             **serializer.data,
             'message': 'Cart updated'
-        }, status=status.HTTP_200_OK)
+        }, status=status.HTTP_200_OK, headers={'ETag': cart_etag(cart.version)})
 
 class DeleteItemAPIView(APIView):
     """
@@ -260,14 +265,12 @@ class DeleteItemAPIView(APIView):
         if not item_id:
             return Response({'detail': 'item_id required'}, status=400)
 
-        cart = get_object_or_404(Cart, cart_code=cart_code)
-        cart_item = get_object_or_404(CartItem, id=item_id, cart=cart)
-        cart_item.delete()
+        cart = get_cart_store().remove_item(cart_code, item_id, expected_version(request))
 
         serializer = CartSerializer(cart, context={'request': request})
         return Response({
             **serializer.data,
             'message': 'Item removed'
-        }, status=status.HTTP_200_OK)
+        }, status=status.HTTP_200_OK, headers={'ETag': cart_etag(cart.version)})
 
 # Create your views here.
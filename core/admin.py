@@ -1,7 +1,19 @@
+import io
+import json
+
+from django import forms
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
+from django.core.exceptions import PermissionDenied
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path
 from django.utils.html import format_html
-from .models import CustomUser, Transaction, Order, OrderItem, MobileMoneyPayment
+from django.conf import settings
+from . import mobile_money, payloads, rollups
+from .statements import match_statement
+from .models import (CustomUser, Transaction, Order, OrderItem, MobileMoneyPayment, PaymentAudit, Job, PaymentLedger,
+                     SalesRollup, OutboxEvent, ArchivedOrder, ArchivedTransaction)
 
 # Register your models here.
 
@@ -24,8 +36,16 @@ class CustomUserAdmin(UserAdmin):
 class TransactionAdmin(admin.ModelAdmin):
     list_display = ['transaction_id', 'user', 'amount', 'currency', 'status', 'payment_method', 'created_at']
     list_filter = ['status', 'payment_method', 'created_at']
-    search_fields = ['transaction_id', 'user__username']
-    readonly_fields = ['transaction_id', 'created_at', 'updated_at']
+    search_fields = ['transaction_id', 'provider_reference', 'user__username']
+    readonly_fields = ['transaction_id', 'created_at', 'updated_at', 'gateway_payload']
+
+    def gateway_payload(self, obj):
+        """Latest raw gateway response, decompressed only on the change page"""
+        data = payloads.latest(obj) if obj.pk else None
+        if data is None:
+            return '-'
+        return format_html('<pre style="max-height: 30em; overflow: auto;">{}</pre>', json.dumps(data, indent=2))
+    gateway_payload.short_description = 'Gateway payload'
 
 
 class OrderItemInline(admin.TabularInline):
@@ -43,6 +63,22 @@ class OrderAdmin(admin.ModelAdmin):
     inlines = [OrderItemInline]
 
 
+class PaymentAuditInline(admin.TabularInline):
+    model = PaymentAudit
+    extra = 0
+    can_delete = False
+    readonly_fields = ['action', 'previous_status', 'actor', 'note', 'created_at']
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+class StatementUploadForm(forms.Form):
+    provider = forms.ChoiceField(choices=MobileMoneyPayment.PROVIDER_CHOICES)
+    statement = forms.FileField(help_text='CSV export of the provider statement')
+    dry_run = forms.BooleanField(required=False, help_text='Only report what would be verified')
+
+
 @admin.register(MobileMoneyPayment)
 class MobileMoneyPaymentAdmin(admin.ModelAdmin):
     list_display = [
@@ -58,6 +94,7 @@ class MobileMoneyPaymentAdmin(admin.ModelAdmin):
     list_filter = ['status', 'provider', 'created_at']
     search_fields = ['transaction_id', 'phone_number', 'user__username', 'user__email']
     readonly_fields = ['created_at', 'verified_at', 'verified_by']
+    inlines = [PaymentAuditInline]
     
     fieldsets = (
         ('Payment Information', {
@@ -92,15 +129,17 @@ class MobileMoneyPaymentAdmin(admin.ModelAdmin):
     status_badge.short_description = 'Status'
     
     def amount_display(self, obj):
-        return format_html('<strong>₦{:,.2f}</strong>', obj.amount)
+        return format_html('<strong>₦{}</strong>', f'{obj.amount:,.2f}')
     amount_display.short_description = 'Amount'
     
     def verify_payments(self, request, queryset):
         """Verify selected payments"""
-        count = 0
-        for payment in queryset.filter(status='pending'):
-            payment.verify(admin_user=request.user)
-            count += 1
+        ids = list(queryset.filter(status='pending').order_by().values_list('pk', flat=True))
+        if len(ids) > settings.MOBILE_MONEY_BULK_JOB_THRESHOLD:
+            mobile_money.settle_later(ids, 'verified', request.user)
+            self.message_user(request, f'Verifying {len(ids)} payment(s) in the background', level='info')
+            return
+        count = mobile_money.verify_payments(ids, request.user)
         
         self.message_user(
             request, 
@@ -111,10 +150,12 @@ class MobileMoneyPaymentAdmin(admin.ModelAdmin):
     
     def reject_payments(self, request, queryset):
         """Reject selected payments"""
-        count = queryset.filter(status='pending').update(
-            status='rejected',
-            notes='Rejected by admin'
-        )
+        ids = list(queryset.filter(status='pending').order_by().values_list('pk', flat=True))
+        if len(ids) > settings.MOBILE_MONEY_BULK_JOB_THRESHOLD:
+            mobile_money.settle_later(ids, 'rejected', request.user, 'Rejected by admin')
+            self.message_user(request, f'Rejecting {len(ids)} payment(s) in the background', level='info')
+            return
+        count = mobile_money.reject_payments(ids, request.user, 'Rejected by admin')
         
         self.message_user(
             request, 
@@ -126,4 +167,134 @@ class MobileMoneyPaymentAdmin(admin.ModelAdmin):
     def get_queryset(self, request):
         """Optimize queries"""
         qs = super().get_queryset(request)
-        return qs.select_related('user', 'order', 'verified_by')
\ No newline at end of file
+        return qs.select_related('user', 'order', 'verified_by')
+
+    def get_urls(self):
+        urls = [
+            path('upload-statement/', self.admin_site.admin_view(self.upload_statement),
+                 name='core_mobilemoneypayment_upload_statement'),
+        ]
+        return urls + super().get_urls()
+
+    def upload_statement(self, request):
+        """Verify pending payments that exactly match an uploaded MTN/Airtel statement"""
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        form = StatementUploadForm(request.POST or None, request.FILES or None)
+        if request.method == 'POST' and form.is_valid():
+            upload = form.cleaned_data['statement']
+            try:
+                result = match_statement(io.TextIOWrapper(upload.file, encoding='utf-8-sig', newline=''),
+                                         form.cleaned_data['provider'], request.user, form.cleaned_data['dry_run'],
+                                         source=upload.name)
+            except (UnicodeDecodeError, ValueError) as e:
+                form.add_error('statement', str(e))
+            else:
+                verb = 'would be verified' if form.cleaned_data['dry_run'] else 'verified'
+                count = result['matched'] if form.cleaned_data['dry_run'] else result['verified']
+                self.message_user(
+                    request,
+                    f"{result['rows']} row(s): {count} payment(s) {verb}, {result['ambiguous']} ambiguous, "
+                    f"{result['unmatched']} unmatched, {result['skipped']} not successful",
+                    level='success'
+                )
+                for row in result['ambiguous_rows'][:50]:
+                    self.message_user(request, f"Row {row['row']}: {row['transaction_id']} ({row['reason']})",
+                                      level='warning')
+                return redirect('admin:core_mobilemoneypayment_changelist')
+        context = dict(
+            self.admin_site.each_context(request),
+            title='Upload statement',
+            opts=self.model._meta,
+            form=form,
+        )
+        return TemplateResponse(request, 'admin/core/mobilemoneypayment/upload_statement.html', context)
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'name', 'status', 'attempts', 'run_at', 'locked_by', 'finished_at']
+    list_filter = ['status', 'name']
+    search_fields = ['name', 'dedupe_key']
+    readonly_fields = ['created_at', 'finished_at', 'locked_by', 'locked_at', 'last_error']
+    actions = ['retry_jobs']
+
+    def retry_jobs(self, request, queryset):
+        """Queue failed or finished jobs again"""
+        updated = queryset.exclude(status='running').update(status='queued', attempts=0, last_error='')
+        self.message_user(request, f'{updated} job(s) queued')
+    retry_jobs.short_description = 'Queue selected jobs again'
+
+
+@admin.register(PaymentLedger)
+class PaymentLedgerAdmin(admin.ModelAdmin):
+    list_display = ['gateway', 'reference', 'outcome', 'transaction', 'order', 'created_at']
+    list_filter = ['gateway', 'outcome', 'created_at']
+    search_fields = ['reference', 'transaction__transaction_id']
+    readonly_fields = ['gateway', 'reference', 'outcome', 'transaction', 'order', 'result', 'created_at']
+
+
+@admin.register(OutboxEvent)
+class OutboxEventAdmin(admin.ModelAdmin):
+    list_display = ['id', 'topic', 'key', 'created_at', 'delivered_at', 'attempts']
+    list_filter = ['topic', ('delivered_at', admin.EmptyFieldListFilter)]
+    search_fields = ['key']
+    readonly_fields = ['topic', 'key', 'payload', 'created_at', 'delivered_at', 'attempts', 'last_error']
+
+
+@admin.register(SalesRollup)
+class SalesDashboardAdmin(admin.ModelAdmin):
+    """Sales dashboard: revenue, top products and gateway success rates, read from the rollups only"""
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def changelist_view(self, request, extra_context=None):
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        try:
+            days = max(1, int(request.GET.get('days', settings.ROLLUP_DASHBOARD_DAYS)))
+        except ValueError:
+            days = settings.ROLLUP_DASHBOARD_DAYS
+        context = dict(
+            self.admin_site.each_context(request),
+            title='Sales dashboard',
+            opts=self.model._meta,
+            **rollups.dashboard(days),
+            **(extra_context or {}),
+        )
+        return TemplateResponse(request, 'admin/core/salesrollup/dashboard.html', context)
+
+
+@admin.register(ArchivedOrder)
+class ArchivedOrderAdmin(admin.ModelAdmin):
+    list_display = ['id', 'user', 'total', 'status', 'created_at', 'month']
+    list_filter = ['status', 'month']
+    search_fields = ['user__username', 'id']
+    readonly_fields = ['id', 'month', 'user', 'transaction_ref', 'total', 'status', 'created_at', 'updated_at',
+                       'items', 'payments', 'archived_at']
+
+
+@admin.register(ArchivedTransaction)
+class ArchivedTransactionAdmin(admin.ModelAdmin):
+    list_display = ['transaction_id', 'user', 'amount', 'currency', 'status', 'payment_method', 'created_at']
+    list_filter = ['status', 'payment_method', 'month']
+    search_fields = ['transaction_id', 'provider_reference', 'user__username']
+    readonly_fields = ['id', 'month', 'user', 'cart_id', 'transaction_id', 'amount', 'currency', 'status',
+                       'payment_method', 'provider_reference', 'created_at', 'updated_at', 'archived_at',
+                       'gateway_payload']
+    exclude = ['payload']
+
+    def gateway_payload(self, obj):
+        """Latest raw gateway response, kept compressed on the archive row"""
+        if obj.payload is None:
+            return '-'
+        return format_html('<pre style="max-height: 30em; overflow: auto;">{}</pre>',
+                           json.dumps(payloads.decode(obj.payload), indent=2))
+    gateway_payload.short_description = 'Gateway payload'
@@ -0,0 +1,147 @@
+"""
+Archiving old orders and transactions.
+
+``archive(cutoff)`` moves every order created before cutoff into
+ArchivedOrder (its lines inlined as JSON), then every transaction created
+before cutoff that no live order points at into ArchivedTransaction.
+
+Nothing that pointed at a moved row is lost with it. The PaymentLedger
+entries and MobileMoneyPayments of an order stay live, with ``order`` set
+to NULL, so the archived order lists their gateway references in
+``payments``. An archived transaction keeps its latest gateway payload,
+still compressed, while the GatewayPayload rows cascade away; ledger
+entries pointing at it keep its ``provider_reference``. Each
+chunk is copied and deleted in one short database transaction, so a run
+can be stopped and resumed at any point and never holds a long lock. The
+archive rows keep their original ids and carry a ``month`` column, the
+natural partition key should the archive tables ever be partitioned or
+exported month by month (see ``archive_orders --export``).
+
+Because everything older than the cutoff is moved, live orders are always
+newer than archived ones; the order history reads the live table first and
+carries on into the archive (see core.history).
+"""
+import gzip
+import json
+import os
+import time
+
+from django.db import transaction as db_transaction
+
+from . import payloads
+from .models import (ArchivedOrder, ArchivedTransaction, GatewayPayload, MobileMoneyPayment, Order, OrderItem,
+                     PaymentLedger, Transaction)
+
+
+def month_of(value):
+    return value.date().replace(day=1)
+
+
+class Exporter:
+    """Appends archived rows to one gzipped JSON-lines file per kind and month"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = {}
+
+    def write(self, kind, month, row):
+        key = (kind, month)
+        if key not in self.files:
+            path = os.path.join(self.directory, f'{kind}-{month:%Y-%m}.jsonl.gz')
+            self.files[key] = gzip.open(path, 'at', encoding='utf-8')
+        self.files[key].write(json.dumps(row, default=str) + '\n')
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+
+
+def _archive_orders(ids, exporter=None):
+    items = {}
+    for item in (OrderItem.objects.filter(order_id__in=ids).order_by('id')
+                 .values('id', 'order_id', 'product_name', 'product_image', 'product_category', 'quantity', 'unit_price')):
+        items.setdefault(item.pop('order_id'), []).append(dict(item, unit_price=str(item['unit_price'])))
+    payments = {}
+    for order_id, gateway, reference in (PaymentLedger.objects.filter(order_id__in=ids).order_by('id')
+                                         .values_list('order_id', 'gateway', 'reference')):
+        payments.setdefault(order_id, []).append({'gateway': gateway, 'reference': reference})
+    for order_id, provider, transaction_id in (MobileMoneyPayment.objects.filter(order_id__in=ids).order_by('id')
+                                               .values_list('order_id', 'provider', 'transaction_id')):
+        payments.setdefault(order_id, []).append({'provider': provider, 'transaction_id': transaction_id})
+    rows = []
+    for order in Order.objects.filter(pk__in=ids).order_by().values(
+            'id', 'user_id', 'transaction_id', 'total', 'status', 'created_at', 'updated_at'):
+        row = ArchivedOrder(
+            id=order['id'], month=month_of(order['created_at']), user_id=order['user_id'],
+            transaction_ref=order['transaction_id'], total=order['total'], status=order['status'],
+            created_at=order['created_at'], updated_at=order['updated_at'], items=items.get(order['id'], []),
+            payments=payments.get(order['id'], []),
+        )
+        rows.append(row)
+        if exporter:
+            exporter.write('orders', row.month, dict(order, items=row.items, payments=row.payments))
+    ArchivedOrder.objects.bulk_create(rows, ignore_conflicts=True)
+    Order.objects.filter(pk__in=ids).delete()
+    return len(rows)
+
+
+def _archive_transactions(ids, exporter=None):
+    latest = {}
+    for transaction_id, data in (GatewayPayload.objects.filter(transaction_id__in=ids)
+                                 .order_by('transaction_id', '-created_at', '-id')
+                                 .values_list('transaction_id', 'data')):
+        latest.setdefault(transaction_id, data)
+    rows = []
+    for transaction in Transaction.objects.filter(pk__in=ids).order_by().values(
+            'id', 'user_id', 'cart_id', 'transaction_id', 'amount', 'currency', 'status', 'payment_method',
+            'provider_reference', 'created_at', 'updated_at'):
+        payload = latest.get(transaction['id'])
+        row = ArchivedTransaction(month=month_of(transaction['created_at']), payload=payload, **transaction)
+        rows.append(row)
+        if exporter:
+            exporter.write('transactions', row.month,
+                           dict(transaction, payload=payloads.decode(payload) if payload is not None else None))
+    ArchivedTransaction.objects.bulk_create(rows, ignore_conflicts=True)
+    # The GatewayPayload rows cascade; the latest one now lives on the archive row
+    Transaction.objects.filter(pk__in=ids).delete()
+    return len(rows)
+
+
+def candidates(cutoff):
+    """(orders, transactions) that an archive run with this cutoff would move"""
+    orders = Order.objects.filter(created_at__lt=cutoff)
+    # A transaction whose order is still live stays with it
+    transactions = Transaction.objects.filter(created_at__lt=cutoff, order__isnull=True)
+    return orders, transactions
+
+
+def archive(cutoff, batch_size=500, export_dir=None, sleep=0.0):
+    """
+    Move orders and transactions created before cutoff into the archive
+    tables, batch_size rows per database transaction. Returns counts and
+    the elapsed time.
+    """
+    started = time.monotonic()
+    exporter = Exporter(export_dir) if export_dir else None
+    results = {'orders': 0, 'transactions': 0}
+    try:
+        orders, transactions = candidates(cutoff)
+        for kind, queryset, move in (('orders', orders, _archive_orders),
+                                     ('transactions', transactions, _archive_transactions)):
+            queryset = queryset.order_by('pk')
+            last_pk = 0
+            while True:
+                ids = list(queryset.filter(pk__gt=last_pk).values_list('pk', flat=True)[:batch_size])
+                if not ids:
+                    break
+                last_pk = ids[-1]
+                with db_transaction.atomic():
+                    results[kind] += move(ids, exporter)
+                if sleep:
+                    time.sleep(sleep)
+    finally:
+        if exporter:
+            exporter.close()
+    results['elapsed'] = time.monotonic() - started
+    return results
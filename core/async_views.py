@@ -0,0 +1,167 @@
+"""
+Async Flutterwave verification views, served by the ASGI application.
+
+The verify round trip is awaited on the event loop through the httpx
+gateway client, so one worker process keeps many verifications in flight
+instead of parking a thread on each. Only the database writes hop to a
+thread with ``sync_to_async``. A per-process semaphore
+(ASYNC_VERIFY_CONCURRENCY) caps how many verifications talk to the gateway
+at once; the rest wait their turn on the loop. Payments already finalised
+are answered from the ledger (core.idempotency) without a gateway call.
+"""
+import asyncio
+import json
+import weakref
+from decimal import Decimal
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from django.shortcuts import redirect
+
+from cart_app.models import Cart
+from shopp_it import log
+from . import idempotency
+from .gateway import GatewayError, flutterwave_async
+from .models import Transaction
+from .payments import complete_payment, foreign_payment, mark_failed, record_flutterwave_transaction
+
+_slots = weakref.WeakKeyDictionary()  # event loop -> semaphore
+
+
+def _verify_slot():
+    loop = asyncio.get_running_loop()
+    semaphore = _slots.get(loop)
+    if semaphore is None:
+        semaphore = _slots[loop] = asyncio.Semaphore(settings.ASYNC_VERIFY_CONCURRENCY)
+    return semaphore
+
+
+async def _verify(transaction_id):
+    """Flutterwave's verified payment data, or None if it does not confirm the payment"""
+    async with _verify_slot():
+        response = await flutterwave_async().get(f'/transactions/{transaction_id}/verify',
+                                                 endpoint='transactions.verify')
+    if response.status_code != 200:
+        return None
+    verify_data = response.json()
+    if verify_data.get('status') != 'success':
+        return None
+    return verify_data
+
+
+_finalised = sync_to_async(idempotency.finalised)
+_record = sync_to_async(idempotency.record)
+
+
+def _redirect_for(result):
+    if result['outcome'] == 'successful':
+        return redirect(f"{settings.FRONTEND_BASE_URL}/payment/success?order_id={result['order_id']}")
+    return redirect(f"{settings.FRONTEND_BASE_URL}/payment/failed?error=verification_failed")
+
+
+def _response_for(result, transaction_id):
+    if result['outcome'] != 'successful':
+        return JsonResponse({'success': False, 'message': 'Payment verification failed'})
+    return JsonResponse({
+        'success': True,
+        'message': 'Payment verified successfully',
+        'order': {
+            'id': result['order_id'],
+            'total': result['total'],
+            'transaction_id': transaction_id,
+            'created_at': result['created_at']
+        }
+    })
+
+
+# Flutterwave Payment Verification (async twin of views.flutterwave_verify)
+async def flutterwave_verify(request):
+    status_param = request.GET.get('status')
+    tx_ref = request.GET.get('tx_ref')
+    transaction_id = request.GET.get('transaction_id')
+    if not all([status_param, tx_ref, transaction_id]):
+        return redirect(f"{settings.FRONTEND_BASE_URL}/payment/failed?error=missing_parameters")
+    log.bind(tx_ref=tx_ref)
+
+    result = await _finalised('flutterwave', transaction_id, tx_ref)
+    if result is not None:
+        return _redirect_for(result)
+
+    transaction = await Transaction.objects.filter(transaction_id=tx_ref).afirst()
+    if transaction is None:
+        return redirect(f"{settings.FRONTEND_BASE_URL}/payment/failed?error=transaction_not_found")
+
+    try:
+        verify_data = await _verify(transaction_id)
+    except GatewayError:
+        return redirect(f"{settings.FRONTEND_BASE_URL}/payment/failed?error=gateway_unavailable")
+    if foreign_payment(verify_data, tx_ref):
+        return redirect(f"{settings.FRONTEND_BASE_URL}/payment/failed?error=verification_failed")
+
+    data = verify_data.get('data', {}) if verify_data else {}
+    if (data.get('status') == 'successful' and
+            Decimal(str(data.get('amount'))) == transaction.amount and
+            data.get('currency') == transaction.currency):
+        order = await sync_to_async(complete_payment)(transaction.pk, verify_data)
+        return _redirect_for(await _record('flutterwave', transaction_id, 'successful', transaction, order))
+
+    await sync_to_async(mark_failed)(transaction.pk)
+    if data.get('status') == 'failed':
+        return _redirect_for(await _record('flutterwave', transaction_id, 'failed', transaction))
+    return redirect(f"{settings.FRONTEND_BASE_URL}/payment/failed?error=verification_failed")
+
+
+# Flutterwave Payment Callback (async twin of views.flutterwave_callback)
+async def flutterwave_callback(request):
+    if request.method != 'POST':
+        return JsonResponse({'detail': f'Method "{request.method}" not allowed.'}, status=405)
+    try:
+        payload = json.loads(request.body or b'{}')
+    except ValueError:
+        payload = request.POST
+    status_param = payload.get('status')
+    tx_ref = payload.get('tx_ref')
+    transaction_id = payload.get('transaction_id')
+    if not all([status_param, tx_ref, transaction_id]):
+        return JsonResponse({'success': False, 'message': 'Missing parameters'}, status=400)
+    log.bind(tx_ref=tx_ref)
+
+    result = await _finalised('flutterwave', transaction_id, tx_ref)
+    if result is not None:
+        return _response_for(result, transaction_id)
+
+    # Extract cart_code from tx_ref (format: cartcode-timestamp)
+    cart_code = tx_ref.split('-')[0] if '-' in tx_ref else tx_ref
+    cart = await Cart.objects.for_code(cart_code).filter(cart_code=cart_code).afirst()
+    if cart is None:
+        return JsonResponse({'success': False, 'message': 'Cart not found'}, status=404)
+
+    transaction = await sync_to_async(record_flutterwave_transaction)(tx_ref, cart)
+
+    try:
+        verify_data = await _verify(transaction_id)
+    except GatewayError:
+        # A 503 makes Flutterwave retry the webhook later
+        return JsonResponse({'success': False, 'message': 'Payment gateway unavailable'}, status=503)
+    if foreign_payment(verify_data, tx_ref):
+        return JsonResponse({'success': False, 'message': 'Payment verification failed'})
+
+    data = verify_data.get('data', {}) if verify_data else {}
+    if data.get('status') == 'successful':
+        amount = currency = None
+        if transaction.amount == Decimal('0'):
+            amount = Decimal(str(data.get('amount', 0)))
+            currency = data.get('currency', 'USD')
+        order = await sync_to_async(complete_payment)(transaction.pk, verify_data, amount, currency)
+        return _response_for(await _record('flutterwave', transaction_id, 'successful', transaction, order),
+                             transaction_id)
+
+    await sync_to_async(mark_failed)(transaction.pk)
+    if data.get('status') == 'failed':
+        return _response_for(await _record('flutterwave', transaction_id, 'failed', transaction), transaction_id)
+    return JsonResponse({'success': False, 'message': 'Payment verification failed'})
+
+
+# Webhooks carry no CSRF token (csrf_exempt cannot wrap async views on this Django version)
+flutterwave_callback.csrf_exempt = True
@@ -0,0 +1,142 @@
+"""
+JWT authentication without a user SELECT on every request.
+
+``CachedJWTAuthentication`` validates the token as simplejwt does, then
+resolves the user through a small in-process cache (entries live
+AUTH_USER_LOCAL_TTL seconds) and the shared cache, keyed by user id and a
+per-user version number. Saving or deleting a user bumps the version once
+the change is committed (see core.signals), which orphans every cached
+copy; other processes notice within AUTH_USER_LOCAL_TTL seconds. Updates
+that bypass ``save()`` (``queryset.update(is_active=False)``) must call
+``invalidate()`` themselves.
+
+The version only reaches other processes when AUTH_USER_CACHE is shared
+(Redis, Memcached). With a local-memory cache each process would keep its
+own version and could serve a deactivated user for the whole
+AUTH_USER_CACHE_TIMEOUT, so that layer is skipped and a process reads the
+user from the database again once its AUTH_USER_LOCAL_TTL entry expires.
+
+``TokenUserAuthentication`` is the claims-only mode for endpoints that
+only need the user id: request.user is a simplejwt TokenUser built from
+the token rather than a CustomUser. Deactivated and deleted users are
+still refused, by checking the user through ``cached_user()``, so they
+lose access within AUTH_USER_LOCAL_TTL seconds like everywhere else.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.translation import gettext_lazy as _
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+from shopp_it.caching import is_shared
+from .models import CustomUser
+
+_local = OrderedDict()  # user id -> (user, expires at)
+_local_lock = threading.Lock()
+
+
+def _cache():
+    return caches[settings.AUTH_USER_CACHE]
+
+
+def _version_key(user_id):
+    return f'auth-user-version:{user_id}'
+
+
+def _user_key(user_id, version):
+    return f'auth-user:{user_id}:{version}'
+
+
+def _load(user_id):
+    return CustomUser.objects.filter(**{api_settings.USER_ID_FIELD: user_id}).first()
+
+
+def cached_user(user_id):
+    """The user with this id, from the process cache, the shared cache or the database; None if there is none"""
+    user_id = str(user_id)  # tokens carry the id as a string
+    now = time.monotonic()
+    with _local_lock:
+        entry = _local.get(user_id)
+        if entry is not None and entry[1] > now:
+            _local.move_to_end(user_id)
+            # A copy, so a view changing request.user never touches the cached instance
+            return copy.copy(entry[0])
+
+    if is_shared(settings.AUTH_USER_CACHE):
+        cache = _cache()
+        # A version lost from the cache restarts from the clock, never from a number already used
+        version = cache.get_or_set(_version_key(user_id), time.time_ns, None)
+        key = _user_key(user_id, version)
+        user = cache.get(key)
+        if user is None:
+            user = _load(user_id)
+            if user is None:
+                return None
+            cache.set(key, user, settings.AUTH_USER_CACHE_TIMEOUT)
+    else:
+        user = _load(user_id)
+        if user is None:
+            return None
+
+    with _local_lock:
+        _local[user_id] = (user, now + settings.AUTH_USER_LOCAL_TTL)
+        _local.move_to_end(user_id)
+        while len(_local) > settings.AUTH_USER_LOCAL_SIZE:
+            _local.popitem(last=False)
+    return copy.copy(user)
+
+
+def invalidate(user_id):
+    """Forget every cached copy of the user"""
+    user_id = str(user_id)
+    with _local_lock:
+        _local.pop(user_id, None)
+    if not is_shared(settings.AUTH_USER_CACHE):
+        return
+    cache = _cache()
+    try:
+        cache.incr(_version_key(user_id))
+    except ValueError:
+        cache.set(_version_key(user_id), time.time_ns(), None)
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """simplejwt's JWTAuthentication with the user resolved through cached_user()"""
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+
+        user = cached_user(user_id)
+        if user is None:
+            raise AuthenticationFailed(_('User not found'), code='user_not_found')
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(_("The user's password has been changed."), code='password_changed')
+        return user
+
+
+class TokenUserAuthentication(JWTAuthentication):
+    """Claims-only: request.user is a TokenUser (id from the token), checked against cached_user() for is_active"""
+
+    def get_user(self, validated_token):
+        if api_settings.USER_ID_CLAIM not in validated_token:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+        user = cached_user(validated_token[api_settings.USER_ID_CLAIM])
+        if user is None:
+            raise AuthenticationFailed(_('User not found'), code='user_not_found')
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+        return api_settings.TOKEN_USER_CLASS(validated_token)
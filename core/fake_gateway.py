@@ -0,0 +1,144 @@
+"""
+A local stand-in for the Flutterwave v3 API, for tests and development.
+
+    with FakeGateway() as gateway:
+        with override_settings(FLUTTERWAVE_BASE_URL=gateway.url):
+            ...
+
+It implements ``POST /v3/payments`` (returns a hosted link and remembers the
+payment), ``GET /v3/transactions/<id>/verify`` and
+``GET /v3/transactions/verify_by_reference?tx_ref=...``. Set ``delay`` to
+make every response slow, ``fail_next`` to answer the next N requests with a
+503, or ``payment_status`` to control what verification reports (a
+payment's own ``status`` key overrides it). Run it
+standalone with ``python manage.py run_fake_gateway``.
+"""
+import itertools
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+VERIFY_PATH = re.compile(r'^/v3/transactions/(?P<id>[^/]+)/verify/?$')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = 'FakeGateway/1.0'
+
+    def log_message(self, format, *args):
+        if self.server.gateway.verbose:
+            super().log_message(format, *args)
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _intercept(self):
+        """Apply the configured delay/failure; True if the request was already answered"""
+        gateway = self.server.gateway
+        gateway.requests.append((self.command, self.path))
+        if gateway.delay:
+            time.sleep(gateway.delay)
+        with gateway.lock:
+            if gateway.fail_next > 0:
+                gateway.fail_next -= 1
+                self._reply(503, {'status': 'error', 'message': 'Service unavailable'})
+                return True
+        return False
+
+    def do_POST(self):
+        if self._intercept():
+            return
+        if self.path.rstrip('/') != '/v3/payments':
+            return self._reply(404, {'status': 'error', 'message': 'Not found'})
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            payload = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            return self._reply(400, {'status': 'error', 'message': 'Invalid JSON'})
+        if not payload.get('tx_ref') or payload.get('amount') is None:
+            return self._reply(400, {'status': 'error', 'message': 'tx_ref and amount are required'})
+
+        gateway = self.server.gateway
+        transaction_id = str(next(gateway.ids))
+        gateway.payments[transaction_id] = payload
+        self._reply(200, {
+            'status': 'success',
+            'message': 'Hosted Link',
+            'data': {'link': f'{gateway.url}/pay/{transaction_id}'},
+        })
+
+    def do_GET(self):
+        if self._intercept():
+            return
+        url = urlsplit(self.path)
+        payments = self.server.gateway.payments
+        if url.path.rstrip('/') == '/v3/transactions/verify_by_reference':
+            tx_ref = parse_qs(url.query).get('tx_ref', [''])[0]
+            transaction_id = next((id for id, payment in payments.items() if payment['tx_ref'] == tx_ref), None)
+        else:
+            match = VERIFY_PATH.match(url.path)
+            if not match:
+                return self._reply(404, {'status': 'error', 'message': 'Not found'})
+            transaction_id = match['id']
+        payment = payments.get(transaction_id)
+        if payment is None:
+            return self._reply(404, {'status': 'error', 'message': 'No transaction was found for this id'})
+        self._reply(200, {
+            'status': 'success',
+            'message': 'Transaction fetched successfully',
+            'data': {
+                'id': int(transaction_id),
+                'tx_ref': payment['tx_ref'],
+                'amount': payment['amount'],
+                'currency': payment.get('currency', 'USD'),
+                'status': payment.get('status', self.server.gateway.payment_status),
+            },
+        })
+
+
+class FakeGateway:
+    def __init__(self, host='127.0.0.1', port=0, delay=0.0, payment_status='successful', verbose=False):
+        self.delay = delay
+        self.fail_next = 0
+        self.payment_status = payment_status
+        self.verbose = verbose
+        self.payments = {}
+        self.requests = []
+        self.ids = itertools.count(1000)
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.gateway = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/v3'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='fake-gateway', daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        if self._thread is not None:
+            self.server.shutdown()
+            self._thread = None
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,63 @@
+"""
+A local stand-in for the PayPal payments API, for tests and development.
+
+    with override_settings(PAYPAL_API='core.fake_paypal.StubPayPalApi'):
+        ...
+
+Payments are created, found and executed in memory and every call is
+recorded in ``calls``. Set ``execute_fails`` to make executions fail.
+"""
+import itertools
+import threading
+
+from .paypal_client import PayPalApi
+
+
+class StubPayPalApi(PayPalApi):
+    """
+    In-memory stand-in for the PayPal payments API: payments are created,
+    found and executed locally and every call is recorded in ``calls``.
+    Set ``execute_fails`` to make executions fail.
+    """
+
+    def __init__(self, options=None, **kwargs):
+        super().__init__(options, **kwargs)
+        self.payments = {}
+        self.calls = []
+        self.execute_fails = False
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def http_call(self, url, method, **kwargs):
+        path = url.split('://', 1)[-1].split('/', 1)[-1]
+        self.calls.append((method, path))
+        if path == 'v1/oauth2/token':
+            return {'access_token': f'stub-token-{self.token_requests}', 'token_type': 'Bearer', 'expires_in': 32400}
+        raise NotImplementedError(f'{method} {path} is not stubbed')
+
+    def request(self, url, method, body=None, headers=None, refresh_token=None):
+        self.headers(refresh_token=refresh_token, headers=headers or {})
+        path = url.split('://', 1)[-1].split('/', 1)[-1].rstrip('/')
+        self.calls.append((method, path))
+        parts = path.split('/')
+        with self._lock:
+            if method == 'POST' and path == 'v1/payments/payment':
+                payment_id = f'PAYID-STUB{next(self._ids)}'
+                payment = dict(body or {}, id=payment_id, state='created', links=[
+                    {'rel': 'approval_url', 'method': 'REDIRECT',
+                     'href': f'https://www.sandbox.paypal.com/checkoutnow?token={payment_id}'},
+                ])
+                self.payments[payment_id] = payment
+                return payment
+            payment = self.payments.get(parts[3]) if len(parts) > 3 else None
+            if payment is None:
+                return {'error': {'name': 'INVALID_RESOURCE_ID', 'message': 'Requested resource ID was not found.'}}
+            if method == 'GET' and len(parts) == 4:
+                return payment
+            if method == 'POST' and parts[4:] == ['execute']:
+                if self.execute_fails:
+                    return {'error': {'name': 'PAYMENT_NOT_APPROVED_FOR_EXECUTION',
+                                      'message': 'Payer has not approved payment'}}
+                payment.update(state='approved', payer={'payer_info': {'payer_id': (body or {}).get('payer_id')}})
+                return payment
+        return {'error': {'name': 'NOT_STUBBED', 'message': f'{method} {path} is not stubbed'}}
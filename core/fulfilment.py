@@ -0,0 +1,84 @@
+"""
+Turning a paid transaction into an order.
+
+``fulfil_transaction`` is the single place that marks a transaction
+successful, copies the cart into an Order with its OrderItems, records the
+payment and order events in the outbox and marks the cart paid. It runs in
+one database transaction with a fixed number of queries whatever the cart
+size: items and products are read in one go and the order lines are
+written with a single bulk INSERT.
+"""
+from django.db import transaction as db_transaction
+
+from cart_app.sharding import with_products
+from . import outbox, payloads
+from .models import Transaction, Order, OrderItem
+
+
+class FulfilmentPending(Exception):
+    """The transaction was claimed by another caller but its order is not there (yet); try again later"""
+
+
+def order_items(order, cart):
+    """Unsaved OrderItems copying the cart's lines (product name, image and category as they are now)"""
+    return [
+        OrderItem(
+            order=order,
+            product_name=item.product.name,
+            product_image=item.product.image.url if item.product.image else '',
+            product_category=item.product.category,
+            quantity=item.quantity,
+            unit_price=item.unit_price
+        )
+        for item in with_products(cart.items.all())
+    ]
+
+
+def fulfil_transaction(transaction, response_data=None, amount=None, currency=None):
+    """
+    Mark transaction successful and create its order; returns the Order.
+    Safe to call again for the same transaction (a redirect and a webhook
+    often both verify it): only the first call creates the order, later
+    ones wait for it to commit and return it. Raises FulfilmentPending if
+    the transaction is marked successful but has no order.
+    """
+    with db_transaction.atomic():
+        # Claim the transaction with a conditional UPDATE before reading anything: it takes the
+        # write lock up front (on SQLite a read-then-write transaction can deadlock with
+        # concurrent verifications) and lets exactly one caller create the order
+        claimed = Transaction.objects.filter(pk=transaction.pk).exclude(status='successful').update(status='successful')
+        if not claimed:
+            # Lost the claim: the row lock waits for the winner to commit, so its order is visible
+            Transaction.objects.select_for_update().filter(pk=transaction.pk).exists()
+            order = Order.objects.filter(transaction_id=transaction.pk).first()
+            if order is None:
+                raise FulfilmentPending(f'Transaction {transaction.transaction_id} is successful but has no order')
+            return order
+
+        if amount is not None:
+            transaction.amount = amount
+            transaction.currency = currency
+        if response_data is not None:
+            payloads.store(transaction, response_data)
+            if transaction.payment_method == 'flutterwave' and not transaction.provider_reference:
+                reference = (response_data.get('data') or {}).get('id')
+                transaction.provider_reference = str(reference) if reference is not None else None
+        transaction.status = 'successful'
+        transaction.save()
+
+        cart = transaction.cart
+        order = Order.objects.create(
+            user_id=transaction.user_id,
+            transaction=transaction,
+            total=transaction.amount,
+            status='completed'
+        )
+        items = OrderItem.objects.bulk_create(order_items(order, cart))
+        outbox.emit(
+            outbox.payment_status(transaction, order.pk),
+            outbox.order_created(order, items, transaction.payment_method, transaction.transaction_id),
+        )
+
+        cart.paid = True
+        cart.save(update_fields=['paid', 'modified_at'])
+    return order
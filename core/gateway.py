@@ -0,0 +1,394 @@
+"""
+Shared HTTP client for payment gateways.
+
+One ``requests.Session`` per gateway keeps TLS connections pooled between
+payments. Every call is bounded by a connect and a read timeout, retried a
+few times with jittered exponential backoff when that is safe, and guarded
+by a circuit breaker: after repeated failures calls fail fast with
+``CircuitOpen`` instead of tying up workers on a gateway that is down.
+
+Latency, error and retry counts are kept per endpoint (see ``metrics()``).
+Each call is logged with its phase timings (``gateway_call``).
+Async views use ``AsyncGatewayClient`` (httpx), which shares the breaker
+and the metrics of the sync client for the same gateway.
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+import weakref
+from collections import deque
+
+import httpx
+import requests
+import urllib3
+from django.conf import settings
+from django.core.signals import setting_changed
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'})
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+class GatewayError(Exception):
+    """The gateway could not be reached or kept failing"""
+
+
+class CircuitOpen(GatewayError):
+    """Calls are short-circuited while the gateway is considered down"""
+
+
+class CircuitBreaker:
+    """
+    Closed: calls go through. After ``threshold`` consecutive failures the
+    circuit opens and calls fail fast for ``reset_timeout`` seconds, after
+    which a single trial call (half-open) decides whether it closes again.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self._trial = False
+
+
+def _never_connected(exc):
+    """Whether a requests error happened before the request could reach the gateway"""
+    if not isinstance(exc, requests.ConnectionError):
+        return False
+    # A connection dropped after sending (reset, remote disconnect) arrives as a ProtocolError
+    reason = exc.args[0] if exc.args else None
+    if isinstance(reason, urllib3.exceptions.MaxRetryError):
+        reason = reason.reason
+    return not isinstance(reason, urllib3.exceptions.ProtocolError)
+
+
+class EndpointStats:
+    """Call counters and a window of recent latencies for one endpoint"""
+
+    def __init__(self, window=500):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.short_circuited = 0
+        self.latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record_call(self, elapsed, failed):
+        with self._lock:
+            self.calls += 1
+            self.latencies.append(elapsed)
+            if failed:
+                self.errors += 1
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def record_short_circuit(self):
+        with self._lock:
+            self.short_circuited += 1
+
+    def snapshot(self):
+        with self._lock:
+            latencies = sorted(self.latencies)
+            counts = {
+                'calls': self.calls,
+                'errors': self.errors,
+                'retries': self.retries,
+                'short_circuited': self.short_circuited,
+            }
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 1)
+
+        return {
+            **counts,
+            'p50_ms': percentile(0.50),
+            'p95_ms': percentile(0.95),
+            'max_ms': round(latencies[-1] * 1000, 1) if latencies else None,
+        }
+
+
+class GatewayClient:
+    def __init__(self, name, base_url, headers=None, connect_timeout=3.05, read_timeout=15.0,
+                 retries=2, backoff=0.3, breaker=None, pool_size=10):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.headers = dict(headers or {})
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        # Retries are handled here so they share the breaker and the metrics
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    def _endpoint_stats(self, endpoint):
+        with self._stats_lock:
+            return self._stats.setdefault(endpoint, EndpointStats())
+
+    def _backoff(self, attempt):
+        # Full jitter: spread retries so clients do not hammer a recovering gateway in step
+        return random.uniform(0, self.backoff * (2 ** attempt))
+
+    def _prepare(self, method, endpoint, retry):
+        stats = self._endpoint_stats(endpoint)
+        if retry is None:
+            retry = method in IDEMPOTENT_METHODS
+        if not self.breaker.allow():
+            stats.record_short_circuit()
+            raise CircuitOpen(f'{self.name} is unavailable (circuit open)')
+        return stats, retry
+
+    def _should_retry(self, stats, method, endpoint, attempt, retry, response, error, connected, elapsed):
+        """Record one attempt; True if it failed and another attempt is allowed"""
+        failed = error is not None or response.status_code >= 500 or response.status_code in RETRY_STATUSES
+        stats.record_call(elapsed, failed)
+        if not failed:
+            self.breaker.record_success()
+            return False
+
+        # A request that never connected was never seen by the gateway, so it is always safe to repeat
+        if (retry or not connected) and attempt < self.retries:
+            stats.record_retry()
+            return True
+
+        self.breaker.record_failure()
+        logger.warning('%s %s %s failed after %d attempt(s): %s', self.name, method, endpoint, attempt + 1,
+                       error or f'HTTP {response.status_code}')
+        return False
+
+    def _finish(self, method, endpoint, response, attempt, started, waited, first_byte=None):
+        """Log a finished call with its timings"""
+        timings = {
+            'gateway': self.name,
+            'endpoint': endpoint,
+            'status': response.status_code if response is not None else None,
+            'attempts': attempt + 1,
+            'total_ms': round((time.monotonic() - started) * 1000, 1),
+            'backoff_ms': round(waited * 1000, 1),
+        }
+        if first_byte is not None:
+            timings['first_byte_ms'] = round(first_byte * 1000, 1)
+        logger.info('%s %s %s -> %s', self.name, method, endpoint, timings['status'] or 'error',
+                    extra={'gateway_call': timings})
+
+    def request(self, method, path, endpoint=None, retry=None, timeout=None, **kwargs):
+        """
+        Send a request and return the response, whatever its status (server
+        errors come back once retries are used up). Raises GatewayError when
+        the gateway cannot be reached and CircuitOpen while the breaker is open.
+
+        ``endpoint`` labels the metrics (defaults to the path). Only
+        idempotent methods are retried unless ``retry=True``; a request
+        that never connected is always safe to retry.
+        """
+        method = method.upper()
+        endpoint = endpoint or path
+        stats, retry = self._prepare(method, endpoint, retry)
+        url = f'{self.base_url}/{path.lstrip("/")}'
+        attempt = 0
+        call_started = time.monotonic()
+        waited = 0.0
+        while True:
+            started = time.monotonic()
+            response = error = None
+            connected = True
+            try:
+                response = self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+            except requests.RequestException as exc:
+                # Connect timeouts, refused connections, DNS and TLS failures never reached the gateway
+                error, connected = exc, not _never_connected(exc)
+            if self._should_retry(stats, method, endpoint, attempt, retry, response, error, connected,
+                                  time.monotonic() - started):
+                attempt += 1
+                delay = self._backoff(attempt)
+                time.sleep(delay)
+                waited += delay
+                continue
+            # requests' elapsed runs from sending the request until the response headers are parsed
+            self._finish(method, endpoint, response, attempt, call_started, waited,
+                         response.elapsed.total_seconds() if response is not None else None)
+            if error is not None:
+                raise GatewayError(f'{self.name} request failed: {error}') from error
+            return response
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def metrics(self):
+        with self._stats_lock:
+            endpoints = {name: stats.snapshot() for name, stats in self._stats.items()}
+        return {'gateway': self.name, 'circuit': self.breaker.state, 'endpoints': endpoints}
+
+
+class AsyncGatewayClient:
+    """httpx-based twin of a GatewayClient, for use on one event loop"""
+
+    def __init__(self, client):
+        self.client = client
+        connect_timeout, read_timeout = client.timeout
+        self.http = httpx.AsyncClient(
+            headers=client.headers,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=client.pool_size, max_keepalive_connections=client.pool_size),
+        )
+
+    async def request(self, method, path, endpoint=None, retry=None, timeout=None, **kwargs):
+        """Same contract as GatewayClient.request"""
+        client = self.client
+        method = method.upper()
+        endpoint = endpoint or path
+        stats, retry = client._prepare(method, endpoint, retry)
+        url = f'{client.base_url}/{path.lstrip("/")}'
+        if timeout is not None:
+            kwargs['timeout'] = httpx.Timeout(timeout[1], connect=timeout[0])
+        attempt = 0
+        call_started = time.monotonic()
+        waited = 0.0
+        while True:
+            started = time.monotonic()
+            response = error = None
+            connected = True
+            try:
+                response = await self.http.request(method, url, **kwargs)
+            except (httpx.ConnectTimeout, httpx.ConnectError) as exc:
+                error, connected = exc, False
+            except httpx.HTTPError as exc:
+                error = exc
+            if client._should_retry(stats, method, endpoint, attempt, retry, response, error, connected,
+                                    time.monotonic() - started):
+                attempt += 1
+                delay = client._backoff(attempt)
+                await asyncio.sleep(delay)
+                waited += delay
+                continue
+            client._finish(method, endpoint, response, attempt, call_started, waited)
+            if error is not None:
+                raise GatewayError(f'{client.name} request failed: {error}') from error
+            return response
+
+    async def get(self, path, **kwargs):
+        return await self.request('GET', path, **kwargs)
+
+    async def post(self, path, **kwargs):
+        return await self.request('POST', path, **kwargs)
+
+    async def aclose(self):
+        await self.http.aclose()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+_async_clients = weakref.WeakKeyDictionary()  # event loop -> {name: AsyncGatewayClient}
+_closing = set()  # tasks closing replaced async clients, kept until done
+
+
+def _build_flutterwave():
+    return GatewayClient(
+        'flutterwave',
+        settings.FLUTTERWAVE_BASE_URL,
+        headers={'Authorization': f'Bearer {settings.FLUTTERWAVE_SECRET_KEY}'},
+        connect_timeout=settings.GATEWAY_CONNECT_TIMEOUT,
+        read_timeout=settings.GATEWAY_READ_TIMEOUT,
+        retries=settings.GATEWAY_RETRIES,
+        backoff=settings.GATEWAY_BACKOFF,
+        breaker=CircuitBreaker(settings.GATEWAY_BREAKER_THRESHOLD, settings.GATEWAY_BREAKER_RESET),
+        pool_size=settings.GATEWAY_POOL_SIZE,
+    )
+
+
+def get_client(name):
+    """The process-wide client for a gateway"""
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = {'flutterwave': _build_flutterwave}[name]()
+    return client
+
+
+def flutterwave():
+    return get_client('flutterwave')
+
+
+def get_async_client(name):
+    """The client for a gateway on the running event loop (httpx pools cannot cross loops)"""
+    loop = asyncio.get_running_loop()
+    per_loop = _async_clients.setdefault(loop, {})
+    client = per_loop.get(name)
+    if client is None or client.client is not get_client(name):
+        if client is not None:
+            # Replaced after a settings change: close its pool instead of leaking the connections
+            task = loop.create_task(client.aclose())
+            _closing.add(task)
+            task.add_done_callback(_closing.discard)
+        client = per_loop[name] = AsyncGatewayClient(get_client(name))
+    return client
+
+
+def flutterwave_async():
+    return get_async_client('flutterwave')
+
+
+def metrics():
+    """Per-endpoint metrics for every gateway used by this process"""
+    return [client.metrics() for client in list(_clients.values())]
+
+
+def _reset_clients(setting, **kwargs):
+    if setting.startswith(('GATEWAY_', 'FLUTTERWAVE_')):
+        with _clients_lock:
+            _clients.clear()
+
+
+setting_changed.connect(_reset_clients)
@@ -0,0 +1,111 @@
+"""
+Order history pages.
+
+History is paged with a cursor on (created_at, id), so a page costs the
+same however many orders a buyer has and never skips or repeats orders
+when new ones arrive. The body stays a plain list of orders; the cursors
+for the neighbouring pages travel in the ``Link`` header (rel="next" /
+rel="prev").
+
+Orders moved to ArchivedOrder by ``archive_orders`` are all older than the
+live ones, so history reads the live orders first and then carries on
+into the archive: the page on which the live orders run out is topped up
+from the archive, and its next link pages through the archive with an
+``archive_cursor`` parameter. OrderSerializer renders both kinds.
+
+The first page, which is what nearly every request asks for, is cached
+per user. Each user has a version number in the cache; saving or deleting
+one of their orders bumps it (see core.signals), which orphans the cached
+page, so a page computed while an order was being written can never be
+served after it.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.pagination import Cursor, CursorPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param
+
+
+class OrderHistoryPagination(CursorPagination):
+    ordering = ('-created_at', '-id')
+
+    def __init__(self):
+        self.page_size = settings.ORDER_HISTORY_PAGE_SIZE
+
+    def get_paginated_response(self, data):
+        return Response(data, headers=self.get_headers())
+
+    def get_headers(self):
+        return link_header(self.get_next_link(), self.get_previous_link())
+
+
+class ArchivedOrderHistoryPagination(OrderHistoryPagination):
+    cursor_query_param = 'archive_cursor'
+
+
+def link_header(next_url, prev_url):
+    links = [f'<{url}>; rel="{rel}"' for url, rel in ((next_url, 'next'), (prev_url, 'prev')) if url]
+    return {'Link': ', '.join(links)} if links else {}
+
+
+def is_first_page(request):
+    return not {OrderHistoryPagination.cursor_query_param,
+                ArchivedOrderHistoryPagination.cursor_query_param} & set(request.query_params)
+
+
+def paginate(request, orders, archived):
+    """
+    (page, headers) for one history page: live orders, then archived ones
+    once the live orders run out.
+    """
+    archive_paginator = ArchivedOrderHistoryPagination()
+    if archive_paginator.cursor_query_param in request.query_params:
+        page = archive_paginator.paginate_queryset(archived, request)
+        return page, archive_paginator.get_headers()
+
+    paginator = OrderHistoryPagination()
+    page = paginator.paginate_queryset(orders, request)
+    if paginator.has_next:
+        return page, paginator.get_headers()
+
+    # The live orders end on this page: fill the rest of it from the archive
+    next_url = None
+    remaining = paginator.page_size - len(page)
+    if remaining:
+        archive_paginator.page_size = remaining
+        page = page + archive_paginator.paginate_queryset(archived, request)
+        archive_paginator.base_url = remove_query_param(archive_paginator.base_url, paginator.cursor_query_param)
+        next_url = archive_paginator.get_next_link()
+    elif archived.exists():
+        archive_paginator.base_url = remove_query_param(request.build_absolute_uri(), paginator.cursor_query_param)
+        next_url = archive_paginator.encode_cursor(Cursor(offset=0, reverse=False, position=None))
+    return page, link_header(next_url, paginator.get_previous_link())
+
+
+def _version_key(user_id):
+    return f'order-history-version:{user_id}'
+
+
+def _page_key(user_id, version):
+    return f'order-history:{user_id}:{version}'
+
+
+def cached_first_page(user_id):
+    """(version, page) where page is the cached (results, headers), or None on a miss"""
+    # A version lost from the cache restarts from the clock, never from a number already used
+    version = cache.get_or_set(_version_key(user_id), time.time_ns, None)
+    return version, cache.get(_page_key(user_id, version))
+
+
+def cache_first_page(user_id, version, results, headers):
+    cache.set(_page_key(user_id, version), (results, headers), settings.ORDER_HISTORY_CACHE_TIMEOUT)
+
+
+def invalidate(user_id):
+    """Forget the user's cached first page"""
+    try:
+        cache.incr(_version_key(user_id))
+    except ValueError:
+        cache.set(_version_key(user_id), time.time_ns(), None)
@@ -0,0 +1,85 @@
+"""
+Idempotent payment finalisation, keyed by the gateway's transaction id.
+
+Gateways deliver the same payment more than once (the customer's redirect,
+the frontend callback, webhook retries). The first delivery to finalise a
+payment records the outcome in ``PaymentLedger``, whose unique constraint
+on (gateway, reference) lets exactly one writer win. Later deliveries look
+the outcome up before doing anything else and answer from it, without
+calling the gateway or writing to the database.
+
+Lookups go through a small in-process LRU, then the shared cache, then the
+ledger, so repeats are usually answered from memory.
+"""
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, transaction as db_transaction
+
+from .models import PaymentLedger
+
+_local = OrderedDict()
+_local_lock = threading.Lock()
+
+
+def _key(gateway, reference):
+    return f'payment-result:{gateway}:{reference}'
+
+
+def _remember(key, result):
+    with _local_lock:
+        _local[key] = result
+        _local.move_to_end(key)
+        while len(_local) > settings.PAYMENT_LEDGER_LOCAL_SIZE:
+            _local.popitem(last=False)
+    caches[settings.PAYMENT_LEDGER_CACHE].set(key, result, settings.PAYMENT_LEDGER_CACHE_TIMEOUT)
+
+
+def finalised(gateway, reference, tx_ref=None):
+    """
+    The stored result of a payment already finalised, or None. With tx_ref,
+    a result recorded for a different merchant reference is ignored, so a
+    forged or mismatched delivery cannot borrow another payment's outcome.
+    """
+    key = _key(gateway, reference)
+    with _local_lock:
+        result = _local.get(key)
+        if result is not None:
+            _local.move_to_end(key)
+    if result is None:
+        result = caches[settings.PAYMENT_LEDGER_CACHE].get(key)
+        if result is None:
+            entry = PaymentLedger.objects.filter(gateway=gateway, reference=str(reference)).first()
+            if entry is None:
+                return None
+            result = entry.result
+        _remember(key, result)
+    if tx_ref is not None and result.get('tx_ref') != tx_ref:
+        return None
+    return result
+
+
+def record(gateway, reference, outcome, transaction=None, order=None):
+    """
+    Record the outcome of a payment and return the stored result. If another
+    delivery recorded it first, that result is returned instead (first
+    writer wins).
+    """
+    result = {
+        'outcome': outcome,
+        'tx_ref': transaction.transaction_id if transaction else None,
+        'order_id': order.id if order else None,
+        'total': str(order.total) if order else None,
+        'created_at': order.created_at.isoformat() if order else None,
+    }
+    try:
+        with db_transaction.atomic():
+            PaymentLedger.objects.create(gateway=gateway, reference=str(reference), outcome=outcome,
+                                         transaction=transaction, order=order, result=result)
+    except IntegrityError:
+        result = PaymentLedger.objects.get(gateway=gateway, reference=str(reference)).result
+    _remember(_key(gateway, reference), result)
+    return result
+
@@ -0,0 +1,157 @@
+"""
+A small job queue stored in the project database.
+
+Register work with ``@job('name')`` in an app's ``tasks`` module, enqueue it
+with ``enqueue('name', {...})`` and run ``python manage.py run_jobs``.
+
+Claiming is safe with several workers: on PostgreSQL (and other backends
+with SKIP LOCKED) candidates are locked with ``SELECT ... FOR UPDATE SKIP
+LOCKED``; on SQLite each candidate is claimed with a conditional UPDATE,
+so two workers can never both win the same job. While a job runs its
+worker refreshes ``locked_at`` every JOB_HEARTBEAT seconds (``heartbeat()``);
+a job whose worker died stops getting them and is re-queued once
+``locked_at`` is JOB_STALE_AFTER seconds old, however long the job itself
+takes. Jobs run at least once, so job functions must be safe to repeat.
+"""
+import logging
+import os
+import socket
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from shopp_it import log
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+registry = {}
+
+
+def job(name):
+    """Register a function as the handler for jobs called name"""
+    def decorator(func):
+        registry[name] = func
+        return func
+    return decorator
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def enqueue(name, payload=None, run_at=None, dedupe_key=None, max_attempts=None):
+    """
+    Queue a job and return it. With dedupe_key, a job already queued or done
+    under that key is returned instead of a new one (a failed one is queued
+    again), so retried webhooks do not multiply work.
+    """
+    fields = {
+        'name': name,
+        'payload': payload or {},
+        'run_at': run_at or timezone.now(),
+        'max_attempts': max_attempts or settings.JOB_MAX_ATTEMPTS,
+    }
+    if dedupe_key is None:
+        return Job.objects.create(**fields)
+    try:
+        with transaction.atomic():
+            return Job.objects.create(dedupe_key=dedupe_key, **fields)
+    except IntegrityError:
+        existing = Job.objects.get(dedupe_key=dedupe_key)
+        if existing.status == 'failed':
+            Job.objects.filter(pk=existing.pk, status='failed').update(
+                status='queued', attempts=0, run_at=fields['run_at'], last_error='')
+            existing.refresh_from_db()
+        return existing
+
+
+def claim(limit=1, worker=None):
+    """Claim up to limit due jobs for this worker and return them"""
+    worker = worker or worker_name()
+    now = timezone.now()
+    due = Job.objects.filter(status='queued', run_at__lte=now).order_by('run_at', 'id')
+    claimed_fields = {'status': 'running', 'locked_by': worker, 'locked_at': now, 'attempts': F('attempts') + 1}
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            ids = list(due.select_for_update(skip_locked=True).values_list('id', flat=True)[:limit])
+            Job.objects.filter(id__in=ids).update(**claimed_fields)
+    else:
+        # Look a little past the limit since other workers may win some candidates
+        ids = []
+        for job_id in due.values_list('id', flat=True)[:limit * 2]:
+            if Job.objects.filter(id=job_id, status='queued').update(**claimed_fields):
+                ids.append(job_id)
+                if len(ids) == limit:
+                    break
+    return list(Job.objects.filter(id__in=ids).order_by('run_at', 'id'))
+
+
+def retry_delay(attempts):
+    """Exponential backoff between attempts, capped at an hour"""
+    return timedelta(seconds=min(settings.JOB_RETRY_BACKOFF * 2 ** max(attempts - 1, 0), 3600))
+
+
+def heartbeat(job_ids, worker=None):
+    """Mark this worker's running jobs as still alive so requeue_stale() leaves them alone"""
+    worker = worker or worker_name()
+    return Job.objects.filter(id__in=job_ids, status='running', locked_by=worker).update(locked_at=timezone.now())
+
+
+def run(job):
+    """Run a claimed job and record the outcome (unless it was re-queued and taken over meanwhile)"""
+    handler = registry.get(job.name)
+    mine = Job.objects.filter(pk=job.pk, status='running', locked_by=job.locked_by)
+    # Each job gets its own logging context, like a request
+    token = log.new_request(f'job-{job.pk}')
+    try:
+        if handler is None:
+            raise LookupError(f'No handler registered for job {job.name!r}')
+        handler(**job.payload)
+    except Exception:
+        error = traceback.format_exc()
+        logger.warning('Job %s #%s failed (attempt %s/%s)', job.name, job.pk, job.attempts, job.max_attempts)
+        if job.attempts < job.max_attempts and handler is not None:
+            mine.update(
+                status='queued', run_at=timezone.now() + retry_delay(job.attempts), last_error=error,
+                locked_by='', locked_at=None)
+        else:
+            mine.update(
+                status='failed', last_error=error, finished_at=timezone.now(), locked_by='', locked_at=None)
+        return False
+    finally:
+        log.end_request(token)
+    mine.update(status='done', finished_at=timezone.now(), locked_by='', locked_at=None)
+    return True
+
+
+def requeue_stale(stale_after=None):
+    """Put back running jobs without a heartbeat for stale_after seconds (their worker crashed or was killed)"""
+    cutoff = timezone.now() - timedelta(seconds=stale_after or settings.JOB_STALE_AFTER)
+    return Job.objects.filter(status='running', locked_at__lt=cutoff).update(
+        status='queued', locked_by='', locked_at=None)
+
+
+_scheduled_slots = {}
+
+
+def schedule_due(schedule=None, now=None):
+    """
+    Enqueue the periodic jobs from JOB_SCHEDULE that are due. Each run is
+    keyed by its interval slot, so any number of workers enqueue it once.
+    """
+    now = now or timezone.now()
+    queued = []
+    for entry in settings.JOB_SCHEDULE if schedule is None else schedule:
+        key = entry.get('name', entry['job'])
+        slot = int(now.timestamp()) // int(entry['every'])
+        if _scheduled_slots.get(key) == slot:
+            continue
+        queued.append(enqueue(entry['job'], entry.get('payload'), dedupe_key=f'schedule:{key}:{slot}'))
+        _scheduled_slots[key] = slot
+    return queued
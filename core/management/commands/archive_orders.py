@@ -0,0 +1,49 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.archive import archive, candidates
+
+
+class Command(BaseCommand):
+    """
+    Move orders and transactions older than --days into the archive tables
+    (ArchivedOrder, ArchivedTransaction), in chunks of --batch-size rows per
+    transaction. Archived orders stay visible in the order history.
+    Optionally also append them to monthly gzipped JSON-lines files.
+
+    Ledger entries and mobile money payments stay live with their order
+    cleared; the archived order lists their references. Each archived
+    transaction keeps only its latest gateway payload.
+    """
+    help = 'Archive old orders and transactions out of the live tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.ARCHIVE_AFTER_DAYS,
+                            help='Archive orders and transactions created more than this many days ago')
+        parser.add_argument('--batch-size', type=int, default=settings.ARCHIVE_BATCH_SIZE,
+                            help='Rows moved per transaction')
+        parser.add_argument('--export', metavar='DIR',
+                            help='Also append archived rows to DIR/{orders,transactions}-YYYY-MM.jsonl.gz')
+        parser.add_argument('--sleep', type=float, default=0.0,
+                            help='Seconds to pause between chunks to let other writers through')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report how many rows would be archived')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        if options['dry_run']:
+            orders, transactions = candidates(cutoff)
+            self.stdout.write(f"{orders.count()} order(s) and {transactions.count()} transaction(s) created "
+                              f"before {cutoff:%Y-%m-%d} would be archived")
+            return
+
+        results = archive(cutoff, max(1, options['batch_size']), options['export'], options['sleep'])
+        elapsed = results['elapsed']
+        rate = (results['orders'] + results['transactions']) / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {results['orders']} order(s) and {results['transactions']} transaction(s) "
+            f"created before {cutoff:%Y-%m-%d} in {elapsed:.2f}s ({rate:.0f} rows/s)"
+        ))
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import CustomUser
+from core.statements import COLUMNS, match_statement
+
+
+class Command(BaseCommand):
+    """
+    Verify pending mobile money payments against an MTN or Airtel statement
+    export (CSV). Exact matches on transaction id, phone and amount are
+    verified in bulk; ambiguous rows are listed for manual review.
+    """
+    help = 'Match a mobile money statement CSV against pending payments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Statement CSV exported from the provider')
+        parser.add_argument('--provider', required=True, choices=sorted(COLUMNS))
+        parser.add_argument('--verified-by', metavar='USERNAME',
+                            help='Record this admin as the verifier')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report what would be verified')
+
+    def handle(self, *args, **options):
+        admin_user = None
+        if options['verified_by']:
+            admin_user = CustomUser.objects.filter(username=options['verified_by']).first()
+            if admin_user is None:
+                raise CommandError(f"No user called {options['verified_by']!r}")
+
+        try:
+            with open(options['path'], newline='', encoding='utf-8-sig') as statement:
+                result = match_statement(statement, options['provider'], admin_user, options['dry_run'],
+                                         source=options['path'])
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+
+        for row in result['ambiguous_rows']:
+            self.stdout.write(f"  row {row['row']}: {row['transaction_id']} ({row['reason']})")
+        verb = 'would verify' if options['dry_run'] else 'verified'
+        count = result['matched'] if options['dry_run'] else result['verified']
+        self.stdout.write(self.style.SUCCESS(
+            f"{result['rows']} row(s) in {result['elapsed']:.2f}s: {verb} {count}, "
+            f"{result['ambiguous']} ambiguous, {result['unmatched']} unmatched, {result['skipped']} not successful"
+        ))
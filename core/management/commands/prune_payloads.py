@@ -0,0 +1,24 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.payloads import prune
+
+
+class Command(BaseCommand):
+    """
+    Delete raw gateway payloads kept past their retention period. The
+    transactions themselves are untouched. Scheduled daily by run_jobs.
+    """
+    help = 'Delete gateway payloads older than GATEWAY_PAYLOAD_RETENTION_DAYS'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.GATEWAY_PAYLOAD_RETENTION_DAYS,
+                            help='Keep payloads from the last this many days')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Payloads deleted per statement')
+
+    def handle(self, *args, **options):
+        deleted = prune(timedelta(days=options['days']), max(1, options['batch_size']))
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} payload(s) older than {options['days']} day(s)"))
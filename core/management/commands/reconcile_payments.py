@@ -0,0 +1,55 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.reconciliation import pending_transactions, reconcile
+
+
+class Command(BaseCommand):
+    """
+    Settle transactions stuck in pending because the redirect and the
+    webhook were both lost: each is looked up at Flutterwave or PayPal and
+    fulfilled or failed. Lookups run concurrently (--workers) but never
+    faster than --rate per second. Scheduled every 15 minutes by run_jobs.
+    """
+    help = 'Verify pending payments with their gateway and fulfil or fail them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=settings.RECONCILE_AFTER_MINUTES,
+                            help='Only check transactions pending for longer than this many minutes')
+        parser.add_argument('--abandon-after', type=int, default=settings.RECONCILE_ABANDON_AFTER_HOURS,
+                            help='Fail transactions still unpaid after this many hours')
+        parser.add_argument('--workers', type=int, default=settings.RECONCILE_WORKERS,
+                            help='Gateway lookups in flight at once')
+        parser.add_argument('--rate', type=float, default=settings.RECONCILE_RATE,
+                            help='Gateway lookups per second')
+        parser.add_argument('--batch-size', type=int, default=settings.RECONCILE_BATCH_SIZE,
+                            help='Transactions read and settled per page')
+        parser.add_argument('--limit', type=int,
+                            help='Check at most this many transactions')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report how many transactions would be checked')
+
+    def handle(self, *args, **options):
+        older_than = timedelta(minutes=options['older_than'])
+        if options['dry_run']:
+            count = pending_transactions(older_than).count()
+            self.stdout.write(f"{count} transaction(s) pending for over {options['older_than']} minute(s) would be checked")
+            return
+
+        results = reconcile(
+            older_than=older_than,
+            abandon_after=timedelta(hours=options['abandon_after']),
+            workers=options['workers'],
+            rate=options['rate'],
+            batch_size=max(1, options['batch_size']),
+            limit=options['limit'],
+        )
+        elapsed = results['elapsed']
+        rate = results['checked'] / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f"Checked {results['checked']} transaction(s) in {elapsed:.2f}s ({rate:.1f}/s): "
+            f"{results['successful']} fulfilled, {results['failed']} failed, {results['abandoned']} abandoned, "
+            f"{results['pending']} still pending, {results['error']} error(s)"
+        ))
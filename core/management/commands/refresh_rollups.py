@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from core.rollups import refresh
+
+
+class Command(BaseCommand):
+    """
+    Rebuild the hourly and daily sales rollups read by the admin dashboard,
+    from the last refresh (minus ROLLUP_LOOKBACK_HOURS) onward. Scheduled
+    every 15 minutes by run_jobs.
+    """
+    help = 'Bring the sales, product and gateway rollups up to date'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true',
+                            help='Rebuild every bucket from the first order instead of from the last refresh')
+
+    def handle(self, *args, **options):
+        result = refresh(full=options['full'])
+        if result['since'] is None:
+            self.stdout.write('Nothing to roll up yet')
+            return
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt rollups from {result['since']:%Y-%m-%d %H:%M}: {result['rows']} row(s) in {result['elapsed']:.2f}s"
+        ))
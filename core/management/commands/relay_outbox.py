@@ -0,0 +1,71 @@
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from core import outbox
+
+
+class Command(BaseCommand):
+    """
+    Deliver order and payment events from the outbox to the sinks in
+    OUTBOX_SINKS, a batch at a time and at least once. When a sink fails or
+    pushes back, the batch is retried with exponential backoff and nothing
+    newer is read in the meantime. Run one relay; SIGTERM/SIGINT stops it
+    after the current batch.
+    """
+    help = 'Relay outbox events to downstream consumers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.OUTBOX_BATCH_SIZE,
+                            help='Events read and sent per batch')
+        parser.add_argument('--poll-interval', type=float, default=settings.OUTBOX_POLL_INTERVAL,
+                            help='Seconds to wait when the outbox is empty')
+        parser.add_argument('--max-backoff', type=float, default=settings.OUTBOX_MAX_BACKOFF,
+                            help='Longest wait, in seconds, between retries of a failing batch')
+        parser.add_argument('--once', action='store_true',
+                            help='Deliver what is in the outbox now, then exit')
+
+    def handle(self, *args, **options):
+        sinks = outbox.load_sinks()
+        if not sinks:
+            raise CommandError('OUTBOX_SINKS is empty: there is nowhere to deliver events')
+        batch_size = max(1, options['batch_size'])
+        stopping = threading.Event()
+        delivered = failures = 0
+
+        def stop(signum, frame):
+            self.stdout.write('Stopping after the current batch...')
+            stopping.set()
+
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, stop)
+            signal.signal(signal.SIGINT, stop)
+
+        self.stdout.write(f"Relaying to {', '.join(type(sink).__name__ for sink in sinks)}")
+        while not stopping.is_set():
+            try:
+                count = outbox.relay_batch(sinks, batch_size)
+            except Exception as e:
+                failures += 1
+                wait = min(options['max_backoff'], 2 ** (failures - 1))
+                if isinstance(e, outbox.Backpressure) and e.retry_after:
+                    wait = min(options['max_backoff'], max(wait, e.retry_after))
+                outbox.logger.warning('Outbox delivery failed (attempt %d), retrying in %.1fs: %s', failures, wait, e)
+                if options['once'] and failures >= 5:
+                    raise CommandError(f'Giving up after {failures} failed attempts: {e}')
+                close_old_connections()
+                stopping.wait(wait)
+                continue
+            failures = 0
+            delivered += count
+            if count < batch_size:
+                if options['once']:
+                    break
+                # Idle: drop a connection past CONN_MAX_AGE (or broken) before waiting
+                close_old_connections()
+                stopping.wait(options['poll_interval'])
+
+        self.stdout.write(self.style.SUCCESS(f"Delivered {delivered} event(s)"))
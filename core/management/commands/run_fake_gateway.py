@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from core.fake_gateway import FakeGateway
+
+
+class Command(BaseCommand):
+    """
+    Serve the fake Flutterwave API until interrupted. Point the app at it with
+    ``FLUTTERWAVE_BASE_URL=http://127.0.0.1:8081/v3``.
+    """
+    help = 'Run a local fake payment gateway'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8081)
+        parser.add_argument('--delay', type=float, default=0.0,
+                            help='Seconds to wait before every response')
+        parser.add_argument('--payment-status', default='successful',
+                            help='Status reported when verifying a payment')
+
+    def handle(self, *args, **options):
+        gateway = FakeGateway(options['host'], options['port'], delay=options['delay'],
+                              payment_status=options['payment_status'], verbose=True)
+        self.stdout.write(f"Fake gateway listening on {gateway.url}")
+        try:
+            gateway.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            gateway.stop()
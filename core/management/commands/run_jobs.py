@@ -0,0 +1,106 @@
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+from django.utils.module_loading import autodiscover_modules
+
+from core import jobs
+
+
+class Command(BaseCommand):
+    """
+    Background worker for core.jobs. Claims due jobs and runs up to
+    --concurrency of them at once in threads, enqueues the periodic jobs
+    from JOB_SCHEDULE, and puts back jobs abandoned by a dead worker. A
+    heartbeat thread keeps this worker's running jobs from looking abandoned.
+    Run several workers for more throughput; SIGTERM/SIGINT stops claiming
+    and lets running jobs finish.
+    """
+    help = 'Run queued background jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=settings.JOB_CONCURRENCY,
+                            help='Jobs run at the same time by this worker')
+        parser.add_argument('--poll-interval', type=float, default=settings.JOB_POLL_INTERVAL,
+                            help='Seconds to wait when no job is due')
+        parser.add_argument('--once', action='store_true',
+                            help='Run the jobs that are due now, then exit')
+        parser.add_argument('--no-schedule', action='store_true',
+                            help='Do not enqueue the periodic jobs from JOB_SCHEDULE')
+
+    def handle(self, *args, **options):
+        autodiscover_modules('tasks')
+        concurrency = max(1, options['concurrency'])
+        worker = jobs.worker_name()
+        stopping = threading.Event()
+        slots = threading.Semaphore(concurrency)
+        counts = {'done': 0, 'failed': 0}
+        running = set()
+        running_lock = threading.Lock()
+
+        def stop(signum, frame):
+            self.stdout.write('Stopping after running jobs finish...')
+            stopping.set()
+
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, stop)
+            signal.signal(signal.SIGINT, stop)
+
+        def execute(job):
+            try:
+                outcome = 'done' if jobs.run(job) else 'failed'
+                with running_lock:
+                    counts[outcome] += 1
+            finally:
+                with running_lock:
+                    running.discard(job.pk)
+                close_old_connections()
+                slots.release()
+
+        def beat():
+            while not stopped.wait(settings.JOB_HEARTBEAT):
+                with running_lock:
+                    job_ids = list(running)
+                if job_ids:
+                    jobs.heartbeat(job_ids, worker)
+                close_old_connections()
+            connection.close()
+
+        stopped = threading.Event()  # set once running jobs have finished
+        heart = threading.Thread(target=beat, name='job-heartbeat', daemon=True)
+        heart.start()
+
+        self.stdout.write(f"Worker {worker} running up to {concurrency} job(s) at a time")
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='job') as pool:
+            while not stopping.is_set():
+                if not options['no_schedule']:
+                    jobs.schedule_due()
+                jobs.requeue_stale()
+
+                free = 0
+                while slots.acquire(blocking=False):
+                    free += 1
+                claimed = jobs.claim(free, worker) if free else []
+                for _ in range(free - len(claimed)):
+                    slots.release()
+                with running_lock:
+                    running.update(job.pk for job in claimed)
+                for job in claimed:
+                    pool.submit(execute, job)
+
+                if options['once'] and not claimed:
+                    break
+                if not claimed:
+                    stopping.wait(options['poll_interval'])
+                elif len(claimed) == free:
+                    # Every slot is busy: wait for one to free up before claiming more
+                    slots.acquire()
+                    slots.release()
+
+        stopped.set()
+        heart.join()
+        self.stdout.write(self.style.SUCCESS(f"Worker {worker} stopped: {counts['done']} done, {counts['failed']} failed"))
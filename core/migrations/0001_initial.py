@@ -31,7 +31,7 @@ class Migration(migrations.Migration):
                 ('date_joined', models.DateTimeField(default=django.utils.timezone.now, verbose_name='date joined')),
                 ('city', models.CharField(blank=True, max_length=100, null=True)),
                 ('state', models.CharField(blank=True, max_length=100, null=True)),
-                ('address', models.CharField(blank=True, null=True)),
+                ('address', models.CharField(blank=True, max_length=255, null=True)),
                 ('phone', models.CharField(blank=True, max_length=15, null=True)),
                 ('groups', models.ManyToManyField(blank=True, help_text='The groups this user belongs to. A user will get all permissions granted to each of their groups.', related_name='user_set', related_query_name='user', to='auth.group', verbose_name='groups')),
                 ('user_permissions', models.ManyToManyField(blank=True, help_text='Specific permissions for this user.', related_name='user_set', related_query_name='user', to='auth.permission', verbose_name='user permissions')),
@@ -0,0 +1,20 @@
+# Generated by Django 4.2 on 2026-10-19 16:09
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cart_app', '0005_cart_sharding'),
+        ('core', '0004_mobilemoneypayment'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='transaction',
+            name='cart',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, to='cart_app.cart'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2 on 2026-10-19 16:18
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentLedger',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gateway', models.CharField(max_length=20)),
+                ('reference', models.CharField(max_length=100)),
+                ('outcome', models.CharField(choices=[('successful', 'Successful'), ('failed', 'Failed')], max_length=20)),
+                ('result', models.JSONField(blank=True, default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='core.order')),
+                ('transaction', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='core.transaction')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='paymentledger',
+            constraint=models.UniqueConstraint(fields=('gateway', 'reference'), name='unique_payment_ledger_reference'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-19 16:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_paymentledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='provider_reference',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+    ]
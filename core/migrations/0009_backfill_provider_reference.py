@@ -0,0 +1,55 @@
+from django.db import migrations, transaction
+
+BATCH_SIZE = 1000
+
+
+def provider_reference(payment_method, response_data):
+    """The gateway's payment id as the views stored it in response_data"""
+    response_data = response_data or {}
+    if payment_method == 'paypal':
+        return response_data.get('paypal_payment_id')
+    if payment_method == 'flutterwave':
+        reference = (response_data.get('data') or {}).get('id')
+        return str(reference) if reference is not None else None
+    return None
+
+
+def backfill(apps, schema_editor):
+    """Copy the gateway ids out of response_data, one short transaction per batch"""
+    Transaction = apps.get_model('core', 'Transaction')
+    db = schema_editor.connection.alias
+    seen = set()
+    last_pk = 0
+    while True:
+        batch = list(
+            Transaction.objects.using(db)
+            .filter(pk__gt=last_pk, provider_reference__isnull=True, response_data__isnull=False)
+            .order_by('pk')
+            .only('pk', 'payment_method', 'response_data')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+        changed = []
+        for row in batch:
+            reference = provider_reference(row.payment_method, row.response_data)
+            # The unique constraint follows; keep the oldest row if a reference was stored twice
+            if reference and (row.payment_method, reference) not in seen:
+                seen.add((row.payment_method, reference))
+                row.provider_reference = reference
+                changed.append(row)
+        with transaction.atomic(using=db):
+            Transaction.objects.using(db).bulk_update(changed, ['provider_reference'])
+
+
+class Migration(migrations.Migration):
+    # Each batch commits on its own so a large table is never locked for the whole backfill
+    atomic = False
+
+    dependencies = [
+        ('core', '0008_transaction_provider_reference'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_backfill_provider_reference'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='transaction',
+            constraint=models.UniqueConstraint(fields=('payment_method', 'provider_reference'), name='unique_transaction_provider_reference'),
+        ),
+    ]
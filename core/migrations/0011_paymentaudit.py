@@ -0,0 +1,30 @@
+# Generated by Django 4.2 on 2026-10-19 16:28
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_transaction_unique_provider_reference'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentAudit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.CharField(choices=[('verified', 'Verified'), ('rejected', 'Rejected')], max_length=20)),
+                ('previous_status', models.CharField(max_length=20)),
+                ('note', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('actor', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('payment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='audits', to='core.mobilemoneypayment')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,81 @@
+# Generated by Django 4.2 on 2026-10-19 16:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_paymentaudit'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GatewayRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=4)),
+                ('bucket', models.DateTimeField()),
+                ('payment_method', models.CharField(max_length=20)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('successful', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['-bucket'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ProductSalesRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=4)),
+                ('bucket', models.DateTimeField()),
+                ('product_name', models.CharField(max_length=255)),
+                ('category', models.CharField(blank=True, max_length=15)),
+                ('units', models.PositiveIntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+            ],
+            options={
+                'ordering': ['-bucket'],
+            },
+        ),
+        migrations.CreateModel(
+            name='RollupRefresh',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('refreshed_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SalesRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=4)),
+                ('bucket', models.DateTimeField()),
+                ('orders', models.PositiveIntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+            ],
+            options={
+                'ordering': ['-bucket'],
+            },
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='product_category',
+            field=models.CharField(blank=True, max_length=15, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='salesrollup',
+            constraint=models.UniqueConstraint(fields=('period', 'bucket'), name='unique_sales_rollup_bucket'),
+        ),
+        migrations.AddConstraint(
+            model_name='productsalesrollup',
+            constraint=models.UniqueConstraint(fields=('period', 'bucket', 'product_name', 'category'), name='unique_product_sales_rollup_bucket'),
+        ),
+        migrations.AddConstraint(
+            model_name='gatewayrollup',
+            constraint=models.UniqueConstraint(fields=('period', 'bucket', 'payment_method'), name='unique_gateway_rollup_bucket'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 4.2 on 2026-10-19 16:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_sales_rollups'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='mobilemoneypayment',
+            index=models.Index(fields=['-created_at', '-id'], name='momo_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mobilemoneypayment',
+            index=models.Index(fields=['status', '-created_at', '-id'], name='momo_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mobilemoneypayment',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['provider', 'created_at'], name='momo_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['-created_at', '-id'], name='order_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', '-created_at', '-id'], name='order_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['status', '-created_at', '-id'], name='order_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['-created_at', '-id'], name='transaction_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['user', '-created_at', '-id'], name='transaction_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['status', '-created_at', '-id'], name='transaction_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['payment_method', 'status'], name='transaction_method_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['id'], name='transaction_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2 on 2026-10-19 16:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_order_payment_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GatewayPayload',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data', models.BinaryField()),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('transaction', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payloads', to='core.transaction')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,48 @@
+import json
+import zlib
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import migrations, transaction
+from django.db.models import OuterRef, Subquery
+
+BATCH_SIZE = 1000
+
+
+def move_payloads(apps, schema_editor):
+    """Copy response_data into compressed GatewayPayload rows, one short transaction per batch"""
+    Transaction = apps.get_model('core', 'Transaction')
+    GatewayPayload = apps.get_model('core', 'GatewayPayload')
+    db = schema_editor.connection.alias
+    last_pk = 0
+    while True:
+        batch = list(
+            Transaction.objects.using(db)
+            .filter(pk__gt=last_pk, response_data__isnull=False, payloads__isnull=True)  # resumable
+            .order_by('pk')
+            .values_list('pk', 'response_data')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        last_pk = batch[-1][0]
+        rows = []
+        for pk, response_data in batch:
+            raw = json.dumps(response_data, separators=(',', ':'), cls=DjangoJSONEncoder).encode()
+            rows.append(GatewayPayload(transaction_id=pk, data=zlib.compress(raw), size=len(raw)))
+        with transaction.atomic(using=db):
+            GatewayPayload.objects.using(db).bulk_create(rows)
+            # Date each payload by when its transaction last changed, so retention applies to old ones
+            GatewayPayload.objects.using(db).filter(transaction_id__in=[pk for pk, _ in batch]).update(
+                created_at=Subquery(Transaction.objects.filter(pk=OuterRef('transaction_id')).values('updated_at')[:1]))
+
+
+class Migration(migrations.Migration):
+    # Each batch commits on its own so a large table is never locked for the whole move
+    atomic = False
+
+    dependencies = [
+        ('core', '0014_gatewaypayload'),
+    ]
+
+    operations = [
+        migrations.RunPython(move_payloads, migrations.RunPython.noop),
+    ]
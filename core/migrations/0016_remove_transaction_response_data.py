@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-19 16:35
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_move_response_data'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='transaction',
+            name='response_data',
+        ),
+    ]
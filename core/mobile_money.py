@@ -0,0 +1,92 @@
+"""
+Verifying and rejecting mobile money payments in bulk.
+
+An admin approving a few hundred payments used to cost two saves per
+payment. Here a whole selection is settled in one transaction with a fixed
+number of statements: one UPDATE for the payments, one for their orders and
+bulk INSERTs of the PaymentAudit rows and the outbox events (see
+core.outbox). Selections larger than MOBILE_MONEY_BULK_JOB_THRESHOLD are
+handed to a background job instead (see ``settle_later``).
+"""
+from django.db import transaction
+from django.db.transaction import on_commit
+from django.utils import timezone
+
+from shopp_it.events import publish
+from . import history, jobs, outbox
+from .models import MobileMoneyPayment, Order, PaymentAudit
+
+ORDER_STATUS = {'verified': 'completed', 'rejected': 'cancelled'}
+
+
+def _settle(payment_ids, action, admin_user=None, note=''):
+    """Move the pending payments among payment_ids to action; returns how many changed"""
+    now = timezone.now()
+    with transaction.atomic():
+        pending = list(
+            MobileMoneyPayment.objects.select_for_update()
+            .filter(pk__in=payment_ids, status='pending')
+            .order_by()
+            .values('pk', 'order_id', 'transaction_id', 'provider', 'user_id', 'amount')
+        )
+        if not pending:
+            return 0
+        ids = [payment['pk'] for payment in pending]
+        order_ids = [payment['order_id'] for payment in pending if payment['order_id'] is not None]
+
+        fields = {'status': action}
+        if action == 'verified':
+            fields.update(verified_at=now, verified_by=admin_user)
+        if note:
+            fields['notes'] = note
+        MobileMoneyPayment.objects.filter(pk__in=ids, status='pending').update(**fields)
+
+        orders = list(Order.objects.filter(pk__in=order_ids).order_by().values('id', 'user_id', 'total'))
+        Order.objects.filter(pk__in=order_ids).update(status=ORDER_STATUS[action], updated_at=now)
+
+        PaymentAudit.objects.bulk_create([
+            PaymentAudit(payment_id=pk, action=action, previous_status='pending', actor=admin_user, note=note)
+            for pk in ids
+        ])
+        outbox.emit(
+            *[outbox.mobile_money_status(payment['pk'], payment['transaction_id'], payment['provider'],
+                                         payment['user_id'], payment['amount'], payment['order_id'], action)
+              for payment in pending],
+            *[outbox.order_status(order['id'], order['user_id'], ORDER_STATUS[action]) for order in orders],
+        )
+
+        # UPDATE sends no post_save, so do here what the Order signals would have done
+        on_commit(lambda: _orders_changed(orders, ORDER_STATUS[action]))
+    return len(ids)
+
+
+def _orders_changed(orders, status):
+    for user_id in {order['user_id'] for order in orders}:
+        history.invalidate(user_id)
+    for order in orders:
+        publish(f"user:{order['user_id']}", {
+            'type': 'order.status',
+            'order_id': order['id'],
+            'status': status,
+            'total': str(order['total']),
+        })
+
+
+def verify_payments(payment_ids, admin_user=None, note=''):
+    """Verify pending payments and complete their orders; returns the number verified"""
+    return _settle(payment_ids, 'verified', admin_user, note)
+
+
+def reject_payments(payment_ids, admin_user=None, note=''):
+    """Reject pending payments and cancel their orders; returns the number rejected"""
+    return _settle(payment_ids, 'rejected', admin_user, note)
+
+
+def settle_later(payment_ids, action, admin_user=None, note=''):
+    """Queue a bulk verify/reject as a background job; returns the Job"""
+    return jobs.enqueue('mobile_money.settle', {
+        'payment_ids': list(payment_ids),
+        'action': action,
+        'admin_user_id': admin_user.pk if admin_user else None,
+        'note': note,
+    })
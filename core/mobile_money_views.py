@@ -2,9 +2,14 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
+from django.db import transaction as db_transaction
 from django.utils import timezone
+from . import outbox
+from .fulfilment import order_items
 from .models import Order, OrderItem, MobileMoneyPayment
 from cart_app.models import Cart
+from cart_app.pricing import price_cart
+from cart_app.store import get_cart_store
 
 
 @api_view(['POST'])
@@ -32,9 +37,12 @@ def verify_mobile_money_payment(request):
                 'error': 'This transaction ID has already been used'
             }, status=status.HTTP_400_BAD_REQUEST)
         
+        # Persist any cart changes still held in the cart store
+        get_cart_store().flush(cart_code)
+
         # Get cart
         try:
-            cart = Cart.objects.get(code=cart_code, user=request.user)
+            cart = Cart.objects.for_code(cart_code).get(cart_code=cart_code, user=request.user)
         except Cart.DoesNotExist:
             return Response({
                 'error': 'Cart not found'
@@ -47,42 +55,44 @@ def verify_mobile_money_payment(request):
             }, status=status.HTTP_400_BAD_REQUEST)
         
         # Calculate total
-        total = sum(item.product.price * item.quantity for item in cart.items.all())
-        
-        # Create pending payment record
-        payment = MobileMoneyPayment.objects.create(
-            user=request.user,
-            cart_code=cart_code,
-            provider=provider,
-            phone_number=phone_number,
-            transaction_id=transaction_id,
-            amount=total,
-            status='pending'  # Admin will verify manually
-        )
-        
-        # Create order with pending status
-        order = Order.objects.create(
-            user=request.user,
-            total=total,
-            status='pending',  # Will be confirmed after admin verification
-            payment_method=f'{provider.upper()} Mobile Money'
-        )
+        coupon = request.data.get('coupon')
+        pricing = price_cart(cart, coupon)
+        if coupon and not pricing['coupon']:
+            return Response({
+                'error': 'Invalid or expired coupon'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        total = pricing['total']
         
-        # Create order items
-        for item in cart.items.all():
-            OrderItem.objects.create(
-                order=order,
-                product=item.product,
-                quantity=item.quantity,
-                price=item.product.price
+        with db_transaction.atomic():
+            # Create pending payment record
+            payment = MobileMoneyPayment.objects.create(
+                user=request.user,
+                cart_code=cart_code,
+                provider=provider,
+                phone_number=phone_number,
+                transaction_id=transaction_id,
+                amount=total,
+                status='pending'  # Admin will verify manually
             )
-        
-        # Link payment to order
-        payment.order = order
-        payment.save()
+            
+            # Create order with pending status
+            order = Order.objects.create(
+                user=request.user,
+                total=total,
+                status='pending'  # Will be confirmed after admin verification
+            )
+            
+            # Create order items
+            items = OrderItem.objects.bulk_create(order_items(order, cart))
+            
+            # Link payment to order
+            payment.order = order
+            payment.save()
+            outbox.emit(outbox.order_created(order, items, 'mobile_money', transaction_id))
         
         # Clear cart
         cart.items.all().delete()
+        get_cart_store().invalidate(cart_code)
         
         return Response({
             'success': True,
@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
+from django.utils import timezone
 
 # Create your models here.
 class CustomUser(AbstractUser):
@@ -28,13 +29,15 @@ class Transaction(models.Model):
     )
     
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='transactions')
-    cart = models.ForeignKey('cart_app.Cart', on_delete=models.CASCADE, null=True, blank=True)
+    # No database-level constraint: carts may live on a shard (see cart_app.sharding)
+    cart = models.ForeignKey('cart_app.Cart', on_delete=models.CASCADE, null=True, blank=True, db_constraint=False)
     transaction_id = models.CharField(max_length=255, unique=True)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     currency = models.CharField(max_length=10, default='USD')
     status = models.CharField(max_length=20, choices=PAYMENT_STATUS, default='pending')
     payment_method = models.CharField(max_length=20, choices=PAYMENT_METHOD)
-    response_data = models.JSONField(blank=True, null=True)
+    # The gateway's own id for the payment (PayPal payment id, Flutterwave transaction id)
+    provider_reference = models.CharField(max_length=100, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -43,6 +46,38 @@ class Transaction(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        constraints = [
+            models.UniqueConstraint(fields=['payment_method', 'provider_reference'],
+                                    name='unique_transaction_provider_reference'),
+        ]
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='transaction_created_idx'),  # admin changelist, rollups
+            models.Index(fields=['user', '-created_at', '-id'], name='transaction_user_created_idx'),
+            models.Index(fields=['status', '-created_at', '-id'], name='transaction_status_created_idx'),
+            models.Index(fields=['payment_method', 'status'], name='transaction_method_status_idx'),
+            # Reconciliation pages through pending transactions (a small slice of the table) by id
+            models.Index(fields=['id'], condition=models.Q(status='pending'),
+                         name='transaction_pending_idx'),
+        ]
+
+
+class GatewayPayload(models.Model):
+    """
+    The raw gateway response a transaction was settled from (Flutterwave
+    verify payload, executed PayPal payment), kept as zlib-compressed JSON
+    out of the Transaction row and read only when asked for (see
+    core.payloads). Deleted after GATEWAY_PAYLOAD_RETENTION_DAYS.
+    """
+    transaction = models.ForeignKey(Transaction, on_delete=models.CASCADE, related_name='payloads')
+    data = models.BinaryField()
+    size = models.PositiveIntegerField(default=0)  # uncompressed bytes
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"Payload for {self.transaction_id} ({self.size} bytes)"
 
 
 class Order(models.Model):
@@ -65,6 +100,11 @@ class Order(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='order_created_idx'),  # admin changelist
+            models.Index(fields=['user', '-created_at', '-id'], name='order_user_created_idx'),  # order history
+            models.Index(fields=['status', '-created_at', '-id'], name='order_status_created_idx'),  # rollups, admin filter
+        ]
 
 
 class OrderItem(models.Model):
@@ -73,6 +113,8 @@ class OrderItem(models.Model):
     product_image = models.CharField(max_length=500, blank=True, null=True)
     quantity = models.PositiveIntegerField(default=1)
     unit_price = models.DecimalField(max_digits=10, decimal_places=2)
+    # Category of the product when it was bought, for the sales rollups
+    product_category = models.CharField(max_length=15, blank=True, null=True)
     
     def __str__(self):
         return f"{self.quantity} x {self.product_name}"
@@ -110,27 +152,267 @@ class MobileMoneyPayment(models.Model):
         ordering = ['-created_at']
         verbose_name = 'Mobile Money Payment'
         verbose_name_plural = 'Mobile Money Payments'
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='momo_created_idx'),  # admin changelist
+            models.Index(fields=['status', '-created_at', '-id'], name='momo_status_created_idx'),
+            # Pending payments are what admins and statement matching work through
+            models.Index(fields=['provider', 'created_at'], condition=models.Q(status='pending'),
+                         name='momo_pending_idx'),
+        ]
     
     def __str__(self):
         return f"{self.get_provider_display()} - {self.transaction_id} - {self.get_status_display()}"
     
     def verify(self, admin_user=None):
-        """Mark payment as verified"""
-        from django.utils import timezone
-        self.status = 'verified'
-        self.verified_at = timezone.now()
-        if admin_user:
-            self.verified_by = admin_user
-        self.save()
-        
-        # Update order status
-        if self.order:
-            self.order.status = 'completed'
-            self.order.save()
+        """Mark payment as verified and complete its order"""
+        from .mobile_money import verify_payments
+        verify_payments([self.pk], admin_user)
+        self.refresh_from_db()
     
-    def reject(self, reason=''):
-        """Mark payment as rejected"""
-        self.status = 'rejected'
-        if reason:
-            self.notes = reason
-        self.save()
+    def reject(self, reason='', admin_user=None):
+        """Mark payment as rejected and cancel its order"""
+        from .mobile_money import reject_payments
+        reject_payments([self.pk], admin_user, reason)
+        self.refresh_from_db()
+
+
+class PaymentAudit(models.Model):
+    """One row per mobile money payment status change made by an admin"""
+    ACTION_CHOICES = [
+        ('verified', 'Verified'),
+        ('rejected', 'Rejected'),
+    ]
+
+    payment = models.ForeignKey(MobileMoneyPayment, on_delete=models.CASCADE, related_name='audits')
+    action = models.CharField(max_length=20, choices=ACTION_CHOICES)
+    previous_status = models.CharField(max_length=20)
+    actor = models.ForeignKey(CustomUser, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    note = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.payment_id} {self.action} by {self.actor_id or 'system'}"
+
+
+class PaymentLedger(models.Model):
+    """
+    Final outcome of each gateway payment, keyed by the gateway's own
+    transaction id. The unique constraint makes repeat deliveries (webhook
+    retries, the redirect plus the callback) finalise a payment only once.
+    """
+    OUTCOME_CHOICES = [
+        ('successful', 'Successful'),
+        ('failed', 'Failed'),
+    ]
+
+    gateway = models.CharField(max_length=20)
+    reference = models.CharField(max_length=100)
+    transaction = models.ForeignKey(Transaction, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    outcome = models.CharField(max_length=20, choices=OUTCOME_CHOICES)
+    result = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['gateway', 'reference'], name='unique_payment_ledger_reference'),
+        ]
+
+    def __str__(self):
+        return f"{self.gateway}:{self.reference} ({self.outcome})"
+
+
+class Job(models.Model):
+    """
+    A unit of background work (see core.jobs). Workers claim queued jobs whose
+    run_at has passed; failures are retried with backoff up to max_attempts.
+    """
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    # Optional idempotency key: enqueueing the same work twice yields one job
+    dedupe_key = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    run_at = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['run_at', 'id']
+        indexes = [models.Index(fields=['status', 'run_at'])]
+
+    def __str__(self):
+        return f"{self.name} #{self.pk} ({self.status})"
+
+
+PERIOD_CHOICES = [
+    ('hour', 'Hour'),
+    ('day', 'Day'),
+]
+
+
+class SalesRollup(models.Model):
+    """Completed orders and revenue per hour and per day (see core.rollups)"""
+    period = models.CharField(max_length=4, choices=PERIOD_CHOICES)
+    bucket = models.DateTimeField()
+    orders = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        ordering = ['-bucket']
+        constraints = [
+            models.UniqueConstraint(fields=['period', 'bucket'], name='unique_sales_rollup_bucket'),
+        ]
+
+    def __str__(self):
+        return f"{self.period} {self.bucket:%Y-%m-%d %H:%M}: {self.orders} order(s)"
+
+
+class ProductSalesRollup(models.Model):
+    """Units and revenue per product (and its category) per hour and per day"""
+    period = models.CharField(max_length=4, choices=PERIOD_CHOICES)
+    bucket = models.DateTimeField()
+    product_name = models.CharField(max_length=255)
+    category = models.CharField(max_length=15, blank=True)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        ordering = ['-bucket']
+        constraints = [
+            models.UniqueConstraint(fields=['period', 'bucket', 'product_name', 'category'],
+                                    name='unique_product_sales_rollup_bucket'),
+        ]
+
+    def __str__(self):
+        return f"{self.period} {self.bucket:%Y-%m-%d %H:%M}: {self.units} x {self.product_name}"
+
+
+class GatewayRollup(models.Model):
+    """Payment attempts and their outcomes per gateway per hour and per day"""
+    period = models.CharField(max_length=4, choices=PERIOD_CHOICES)
+    bucket = models.DateTimeField()
+    payment_method = models.CharField(max_length=20)
+    attempts = models.PositiveIntegerField(default=0)
+    successful = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ['-bucket']
+        constraints = [
+            models.UniqueConstraint(fields=['period', 'bucket', 'payment_method'],
+                                    name='unique_gateway_rollup_bucket'),
+        ]
+
+    def __str__(self):
+        return f"{self.period} {self.bucket:%Y-%m-%d %H:%M}: {self.payment_method} {self.successful}/{self.attempts}"
+
+
+class RollupRefresh(models.Model):
+    """When the rollups were last refreshed"""
+    name = models.CharField(max_length=50, unique=True)
+    refreshed_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.name} @ {self.refreshed_at}"
+
+
+class OutboxEvent(models.Model):
+    """
+    An order or payment event for downstream consumers, written in the same
+    database transaction as the change it describes and delivered later by
+    ``manage.py relay_outbox`` (see core.outbox).
+    """
+    topic = models.CharField(max_length=50)  # e.g. 'order.created', 'payment.status'
+    key = models.CharField(max_length=100)  # what the event is about, e.g. 'order:42'
+    payload = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+    delivered_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            # The relay only ever reads undelivered events, oldest first
+            models.Index(fields=['id'], condition=models.Q(delivered_at__isnull=True), name='outbox_undelivered_idx'),
+            models.Index(fields=['delivered_at'], name='outbox_delivered_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.topic} {self.key} #{self.pk}"
+
+
+class ArchivedTransaction(models.Model):
+    """
+    A transaction moved out of Transaction by ``manage.py archive_orders``
+    (see core.archive). Keeps its original id and its latest gateway
+    payload; ``month`` (the first day of the month it was created) is the
+    partition key.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    month = models.DateField()
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='archived_transactions')
+    cart_id = models.BigIntegerField(null=True, blank=True)
+    transaction_id = models.CharField(max_length=255, unique=True)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    currency = models.CharField(max_length=10, default='USD')
+    status = models.CharField(max_length=20, choices=Transaction.PAYMENT_STATUS)
+    payment_method = models.CharField(max_length=20, choices=Transaction.PAYMENT_METHOD)
+    provider_reference = models.CharField(max_length=100, null=True, blank=True)
+    payload = models.BinaryField(null=True, blank=True)  # latest GatewayPayload.data, still compressed
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [models.Index(fields=['month'], name='archived_tx_month_idx')]
+
+    def __str__(self):
+        return f"{self.transaction_id} - {self.status} (archived)"
+
+
+class ArchivedOrder(models.Model):
+    """
+    An order moved out of Order by ``manage.py archive_orders``, with its
+    lines inlined in ``items`` and the ledger entries and mobile money
+    payments that pointed at it in ``payments``. Keeps its original id and
+    is still served by the order history (see core.history); ``month`` is
+    the partition key.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    month = models.DateField()
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='archived_orders')
+    transaction_ref = models.BigIntegerField(null=True, blank=True)  # id of the (possibly archived) transaction
+    total = models.DecimalField(max_digits=10, decimal_places=2)
+    status = models.CharField(max_length=20, choices=Order.ORDER_STATUS)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    items = models.JSONField(default=list)
+    payments = models.JSONField(default=list)  # e.g. [{'gateway': 'paypal', 'reference': 'PAY-1'}]
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at', '-id'], name='archived_order_user_idx'),
+            models.Index(fields=['month'], name='archived_order_month_idx'),
+        ]
+
+    def __str__(self):
+        return f"Order #{self.id} (archived)"
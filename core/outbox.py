@@ -0,0 +1,207 @@
+"""
+Transactional outbox for order and payment events.
+
+Analytics, email and the ERP want to hear about orders and payments, but
+calling them during checkout would make checkout as slow and as fragile
+as they are. Instead every change writes an OutboxEvent in the same
+database transaction (fulfilment, failed payments, mobile money
+verification), so an event exists exactly when its change was committed.
+``manage.py relay_outbox`` then reads undelivered events in id order, a
+batch at a time, and hands each batch to every sink in OUTBOX_SINKS.
+
+Delivery is at least once. A batch is marked delivered only after every
+sink accepted it, so a crash or a failing sink means the batch is sent
+again, possibly to sinks that already have it. Consumers should dedupe on
+the event ``id``. A sink pushes back by raising (``Backpressure`` when it
+knows how long to wait); the relay reads nothing more until the batch goes
+through, backing off up to OUTBOX_MAX_BACKOFF seconds.
+
+Sinks are classes taking their options as keyword arguments with a
+``send(messages)`` method: ``FileSink`` (JSON lines), ``HttpSink`` (POSTs
+each batch as JSON) and ``QueueSink`` (a bounded in-process queue for
+consumers running in the relay's process).
+"""
+import json
+import logging
+import os
+import queue
+import threading
+
+import httpx
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+
+# Events
+
+def event(topic, key, payload):
+    """An unsaved OutboxEvent; save it inside the transaction making the change"""
+    return OutboxEvent(topic=topic, key=key, payload=json.loads(json.dumps(payload, cls=DjangoJSONEncoder)))
+
+
+def emit(*events):
+    """Write events; call inside the transaction.atomic() block that makes the change"""
+    OutboxEvent.objects.bulk_create(events)
+
+
+def order_created(order, items, payment_method=None, payment_reference=None):
+    return event('order.created', f'order:{order.pk}', {
+        'order_id': order.pk,
+        'user_id': order.user_id,
+        'status': order.status,
+        'total': order.total,
+        'payment_method': payment_method,
+        'payment_reference': payment_reference,
+        'items': [
+            {'product_name': item.product_name, 'category': item.product_category,
+             'quantity': item.quantity, 'unit_price': item.unit_price}
+            for item in items
+        ],
+    })
+
+
+def order_status(order_id, user_id, status):
+    return event('order.status', f'order:{order_id}', {'order_id': order_id, 'user_id': user_id, 'status': status})
+
+
+def payment_status(transaction, order_id=None):
+    return event('payment.status', f'transaction:{transaction.transaction_id}', {
+        'transaction_id': transaction.transaction_id,
+        'payment_method': transaction.payment_method,
+        'provider_reference': transaction.provider_reference,
+        'user_id': transaction.user_id,
+        'amount': transaction.amount,
+        'currency': transaction.currency,
+        'status': transaction.status,
+        'order_id': order_id,
+    })
+
+
+def mobile_money_status(payment_id, transaction_id, provider, user_id, amount, order_id, status):
+    return event('payment.status', f'mobile_money:{transaction_id}', {
+        'transaction_id': transaction_id,
+        'payment_method': 'mobile_money',
+        'provider': provider,
+        'payment_id': payment_id,
+        'user_id': user_id,
+        'amount': amount,
+        'status': status,
+        'order_id': order_id,
+    })
+
+
+# Sinks
+
+class Backpressure(Exception):
+    """A sink cannot take more right now; retry the batch after retry_after seconds"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class FileSink:
+    """Appends each event as a JSON line and syncs the file before acknowledging"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, messages):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for message in messages:
+                f.write(json.dumps(message) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class HttpSink:
+    """POSTs each batch as a JSON list; any 2xx acknowledges it, 429 and 503 push back"""
+
+    def __init__(self, url, timeout=10, headers=None):
+        self.url = url
+        self.client = httpx.Client(timeout=timeout, headers=headers)
+
+    def send(self, messages):
+        response = self.client.post(self.url, json=messages)
+        if response.status_code in (429, 503):
+            retry_after = response.headers.get('Retry-After')
+            raise Backpressure(f'{self.url} answered HTTP {response.status_code}',
+                               float(retry_after) if retry_after and retry_after.isdigit() else None)
+        response.raise_for_status()
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def get_queue(name='outbox', maxsize=1000):
+    """The in-process queue a QueueSink called name delivers to"""
+    with _queues_lock:
+        if name not in _queues:
+            _queues[name] = queue.Queue(maxsize=maxsize)
+        return _queues[name]
+
+
+class QueueSink:
+    """Puts events on a bounded in-process queue (see get_queue), pushing back while it is full"""
+
+    def __init__(self, name='outbox', maxsize=1000, timeout=5):
+        self.queue = get_queue(name, maxsize)
+        self.timeout = timeout
+
+    def send(self, messages):
+        for message in messages:
+            try:
+                self.queue.put(message, timeout=self.timeout)
+            except queue.Full:
+                raise Backpressure(f'Queue full ({self.queue.maxsize} events)', self.timeout)
+
+
+def load_sinks():
+    return [import_string(sink['class'])(**sink.get('options', {})) for sink in settings.OUTBOX_SINKS]
+
+
+# Relay
+
+def message(outbox_event):
+    return {
+        'id': outbox_event.pk,
+        'topic': outbox_event.topic,
+        'key': outbox_event.key,
+        'created_at': outbox_event.created_at.isoformat(),
+        'payload': outbox_event.payload,
+    }
+
+
+def relay_batch(sinks, batch_size=100):
+    """
+    Deliver the oldest undelivered events to every sink and return how many
+    were delivered. A sink's exception is re-raised after the attempt is
+    recorded on the events.
+    """
+    events = list(OutboxEvent.objects.filter(delivered_at__isnull=True).order_by('id')[:batch_size])
+    if not events:
+        return 0
+    ids = [e.pk for e in events]
+    messages = [message(e) for e in events]
+    try:
+        for sink in sinks:
+            sink.send(messages)
+    except Exception as e:
+        OutboxEvent.objects.filter(pk__in=ids).update(attempts=F('attempts') + 1, last_error=str(e)[:1000])
+        raise
+    OutboxEvent.objects.filter(pk__in=ids).update(delivered_at=timezone.now(), attempts=F('attempts') + 1,
+                                                  last_error='')
+    return len(events)
+
+
+def prune(older_than):
+    """Delete events delivered more than older_than ago; returns how many"""
+    return OutboxEvent.objects.filter(delivered_at__lt=timezone.now() - older_than).delete()[0]
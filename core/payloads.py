@@ -0,0 +1,51 @@
+"""
+Raw gateway payloads, stored beside the transaction instead of in it.
+
+Verify responses and executed PayPal payments run to kilobytes each and
+are only ever read when someone investigates a payment, so they live in
+GatewayPayload as zlib-compressed JSON. Transaction rows stay small and
+list queries never load them. ``prune()`` (run daily by
+``manage.py prune_payloads``) deletes payloads past
+GATEWAY_PAYLOAD_RETENTION_DAYS.
+"""
+import json
+import zlib
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from .models import GatewayPayload
+
+
+def encode(data):
+    """(compressed bytes, uncompressed size) for a JSON-serialisable payload"""
+    raw = json.dumps(data, separators=(',', ':'), cls=DjangoJSONEncoder).encode()
+    return zlib.compress(raw), len(raw)
+
+
+def decode(blob):
+    return json.loads(zlib.decompress(bytes(blob)))
+
+
+def store(transaction, data):
+    """Keep data as the transaction's latest gateway payload"""
+    blob, size = encode(data)
+    return GatewayPayload.objects.create(transaction=transaction, data=blob, size=size)
+
+
+def latest(transaction):
+    """The transaction's most recent payload, decoded, or None"""
+    blob = (GatewayPayload.objects.filter(transaction=transaction).order_by('-created_at', '-id')
+            .values_list('data', flat=True).first())
+    return decode(blob) if blob is not None else None
+
+
+def prune(older_than, batch_size=1000):
+    """Delete payloads created more than older_than ago, a batch at a time; returns how many"""
+    cutoff = timezone.now() - older_than
+    deleted = 0
+    while True:
+        ids = list(GatewayPayload.objects.filter(created_at__lt=cutoff).order_by().values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += GatewayPayload.objects.filter(pk__in=ids).delete()[0]
@@ -0,0 +1,63 @@
+"""
+Payment state changes shared by the sync views, the async views and the
+background jobs.
+"""
+import logging
+from decimal import Decimal
+
+from django.db import transaction as db_transaction
+
+from . import outbox
+from .fulfilment import fulfil_transaction
+from .models import Transaction
+
+logger = logging.getLogger(__name__)
+
+
+def record_flutterwave_transaction(tx_ref, cart):
+    """The transaction for tx_ref, created as pending if Flutterwave reports it first"""
+    transaction, created = Transaction.objects.get_or_create(
+        transaction_id=tx_ref,
+        defaults={
+            'user_id': cart.user_id,
+            'cart': cart,
+            'amount': Decimal('0'),  # Will be updated from Flutterwave
+            'currency': 'USD',
+            'payment_method': 'flutterwave',
+            'status': 'pending'
+        }
+    )
+    return transaction
+
+
+def foreign_payment(verify_data, tx_ref):
+    """
+    Whether a Flutterwave verify response describes a payment made for
+    another tx_ref. A gateway transaction id paid for one cart must never
+    settle (or fail) another cart's transaction.
+    """
+    data = (verify_data or {}).get('data') or {}
+    if data and data.get('tx_ref') != tx_ref:
+        logger.warning('Flutterwave payment %s belongs to tx_ref %s, not %s',
+                       data.get('id'), data.get('tx_ref'), tx_ref)
+        return True
+    return False
+
+
+def mark_failed(transaction_pk):
+    """Fail a transaction that has not succeeded, recording the change in the outbox"""
+    with db_transaction.atomic():
+        transaction = Transaction.objects.select_for_update().get(pk=transaction_pk)
+        if transaction.status == 'successful':
+            return
+        changed = transaction.status != 'failed'
+        transaction.status = 'failed'
+        transaction.save(update_fields=['status', 'updated_at'])
+        if changed:
+            outbox.emit(outbox.payment_status(transaction))
+
+
+def complete_payment(transaction_pk, verify_data, amount=None, currency=None):
+    """Fulfil a verified Flutterwave payment by transaction id (for async views and jobs)"""
+    transaction = Transaction.objects.get(pk=transaction_pk)
+    return fulfil_transaction(transaction, verify_data, amount, currency)
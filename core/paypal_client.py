@@ -0,0 +1,100 @@
+"""
+Process-wide PayPal REST client.
+
+``paypal()`` returns one ``paypalrestsdk.Api`` per process, built from the
+PAYPAL_* settings on first use. Pass it to the SDK resources
+(``Payment(..., api=paypal())``, ``Payment.find(id, api=paypal())``)
+instead of calling ``paypalrestsdk.configure`` per request.
+
+The OAuth access token is reused until PAYPAL_TOKEN_REFRESH_MARGIN seconds
+before it expires. Refreshing happens under a lock, so a burst of requests
+with an expired token makes one token call, not one each. HTTP goes through
+a pooled ``requests.Session`` with the gateway timeouts.
+
+Set PAYPAL_API to the dotted path of another Api class to swap the client,
+e.g. ``core.fake_paypal.StubPayPalApi`` for tests and local development.
+"""
+import threading
+import time
+
+import paypalrestsdk
+import requests
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.utils.module_loading import import_string
+from requests.adapters import HTTPAdapter
+
+
+class PayPalApi(paypalrestsdk.Api):
+    def __init__(self, options=None, refresh_margin=60, timeout=None, pool_size=10, **kwargs):
+        super().__init__(options, **kwargs)
+        self.refresh_margin = refresh_margin
+        self.timeout = timeout
+        self.token_expires_at = None
+        self.token_requests = 0
+        self._token_lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def validate_token_hash(self):
+        # Drop the token a little before PayPal expires it, so no request is sent with a stale one
+        if self.token_hash is not None and self.token_expires_at is not None \
+                and time.monotonic() >= self.token_expires_at:
+            self.token_hash = None
+
+    def get_token_hash(self, authorization_code=None, refresh_token=None, headers=None):
+        if authorization_code is not None or refresh_token is not None:
+            return super().get_token_hash(authorization_code, refresh_token, headers)
+        self.validate_token_hash()
+        token = self.token_hash
+        if token is not None:
+            return token
+        with self._token_lock:
+            # Another request may have refreshed the token while this one waited
+            self.validate_token_hash()
+            if self.token_hash is None:
+                self.token_requests += 1
+                token = super().get_token_hash(headers=headers)
+                expires_in = token.get('expires_in')
+                self.token_expires_at = (time.monotonic() + max(float(expires_in) - self.refresh_margin, 0)
+                                         if expires_in is not None else None)
+            return self.token_hash
+
+    def http_call(self, url, method, **kwargs):
+        response = self.session.request(method, url, proxies=self.proxies, timeout=self.timeout, **kwargs)
+        return self.handle_response(response, response.content.decode('utf-8'))
+
+
+_api = None
+_api_lock = threading.Lock()
+
+
+def paypal():
+    """The process-wide PayPal API client"""
+    global _api
+    api = _api
+    if api is None:
+        with _api_lock:
+            api = _api
+            if api is None:
+                api = _api = import_string(settings.PAYPAL_API)(
+                    mode=settings.PAYPAL_MODE,
+                    client_id=settings.PAYPAL_CLIENT_ID,
+                    client_secret=settings.PAYPAL_CLIENT_SECRET,
+                    refresh_margin=settings.PAYPAL_TOKEN_REFRESH_MARGIN,
+                    timeout=(settings.GATEWAY_CONNECT_TIMEOUT, settings.GATEWAY_READ_TIMEOUT),
+                    pool_size=settings.GATEWAY_POOL_SIZE,
+                )
+    return api
+
+
+def _reset_client(setting, **kwargs):
+    global _api
+    if setting.startswith('PAYPAL_') or setting.startswith('GATEWAY_'):
+        with _api_lock:
+            _api = None
+
+
+setting_changed.connect(_reset_client)
@@ -0,0 +1,204 @@
+"""
+Reconciling payments whose redirect and webhook never arrived.
+
+``reconcile()`` pages through transactions left pending, asks the gateway
+what became of each one and settles them: paid ones are fulfilled, ones the
+gateway reports failed (or that were never paid within
+RECONCILE_ABANDON_AFTER_HOURS) are marked failed. Gateway lookups run on a
+bounded thread pool behind a token-bucket rate limiter so a large backlog
+cannot trip the gateways' rate limits; all database work stays on the
+calling thread.
+
+Run it with ``python manage.py reconcile_payments`` (it is also scheduled
+from JOB_SCHEDULE).
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+
+import paypalrestsdk
+from django.db import transaction as db_transaction
+from django.utils import timezone
+
+from . import idempotency, outbox
+from .fulfilment import fulfil_transaction
+from .gateway import GatewayError, flutterwave
+from .models import Transaction
+from .paypal_client import paypal
+
+logger = logging.getLogger(__name__)
+
+PAYPAL_FAILED_STATES = frozenset({'failed', 'canceled', 'expired'})
+
+
+class TokenBucket:
+    """Allows ``rate`` calls per second on average, with bursts of up to ``capacity``"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting for one if the bucket is empty"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Outcome:
+    """What the gateway says about one pending transaction"""
+
+    def __init__(self, status, reference=None, data=None, amount=None, currency=None, detail=''):
+        self.status = status  # 'successful', 'failed', 'abandoned', 'pending' or 'error'
+        self.reference = reference  # the gateway's id for the payment, if it has one
+        self.data = data
+        self.amount = amount
+        self.currency = currency
+        self.detail = detail
+
+
+def check_flutterwave(transaction, abandoned):
+    try:
+        response = flutterwave().get('/transactions/verify_by_reference', endpoint='transactions.verify_by_reference',
+                                     params={'tx_ref': transaction.transaction_id})
+    except GatewayError as e:
+        return Outcome('error', detail=str(e))
+    if response.status_code == 404:
+        # Flutterwave has no payment for this reference: the customer never paid
+        return Outcome('abandoned' if abandoned else 'pending')
+    if response.status_code != 200:
+        return Outcome('error', detail=f'HTTP {response.status_code}')
+
+    verify_data = response.json()
+    data = verify_data.get('data') or {}
+    reference = str(data['id']) if data.get('id') is not None else None
+    status = data.get('status')
+    if status == 'successful':
+        amount = Decimal(str(data.get('amount', 0)))
+        currency = data.get('currency', 'USD')
+        if transaction.amount == Decimal('0'):
+            # Created by a webhook before the amount was known
+            return Outcome('successful', reference, verify_data, amount, currency)
+        if amount != transaction.amount or currency != transaction.currency:
+            return Outcome('failed', reference, verify_data, detail='amount or currency mismatch')
+        return Outcome('successful', reference, verify_data)
+    if status == 'failed':
+        return Outcome('failed', reference, verify_data)
+    return Outcome('abandoned' if abandoned else 'pending', reference)
+
+
+def check_paypal(transaction, abandoned):
+    payment_id = transaction.provider_reference
+    if not payment_id:
+        # The payment was never created at PayPal
+        return Outcome('abandoned' if abandoned else 'pending')
+    try:
+        payment = paypalrestsdk.Payment.find(payment_id, api=paypal())
+    except paypalrestsdk.exceptions.ResourceNotFound:
+        return Outcome('abandoned' if abandoned else 'pending')
+    except (paypalrestsdk.exceptions.ConnectionError, OSError) as e:
+        return Outcome('error', detail=str(e))
+    if payment.state == 'approved':
+        return Outcome('successful', payment_id, payment.to_dict())
+    if payment.state in PAYPAL_FAILED_STATES:
+        return Outcome('failed', payment_id)
+    if payment.error:
+        return Outcome('error', detail=str(payment.error))
+    return Outcome('abandoned' if abandoned else 'pending', payment_id)
+
+
+CHECKS = {
+    'flutterwave': check_flutterwave,
+    'paypal': check_paypal,
+}
+
+
+def pending_transactions(older_than):
+    return Transaction.objects.filter(
+        status='pending', payment_method__in=list(CHECKS), created_at__lt=timezone.now() - older_than,
+    ).order_by('pk')
+
+
+def reconcile(older_than=timedelta(minutes=30), abandon_after=timedelta(hours=24), workers=8, rate=10.0,
+              batch_size=200, limit=None):
+    """
+    Settle pending transactions older than older_than and return counts per
+    outcome plus the elapsed time.
+    """
+    bucket = TokenBucket(rate)
+    abandon_before = timezone.now() - abandon_after
+    results = {'checked': 0, 'successful': 0, 'failed': 0, 'abandoned': 0, 'pending': 0, 'error': 0}
+    started = time.monotonic()
+
+    def check(transaction):
+        bucket.acquire()
+        try:
+            return CHECKS[transaction.payment_method](transaction, transaction.created_at < abandon_before)
+        except Exception as e:
+            logger.exception('Reconciling %s failed', transaction.transaction_id)
+            return Outcome('error', detail=str(e))
+
+    candidates = pending_transactions(older_than)
+    last_pk = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='reconcile') as pool:
+        while limit is None or results['checked'] < limit:
+            size = batch_size if limit is None else min(batch_size, limit - results['checked'])
+            page = list(candidates.filter(pk__gt=last_pk)[:size])
+            if not page:
+                break
+            last_pk = page[-1].pk
+            outcomes = list(pool.map(check, page))
+            settle(page, outcomes, results)
+            results['checked'] += len(page)
+
+    results['elapsed'] = time.monotonic() - started
+    return results
+
+
+def settle(page, outcomes, results):
+    """Apply one page of outcomes: fulfil the paid, then fail the rest with one UPDATE"""
+    failed = []
+    with db_transaction.atomic():
+        for transaction, outcome in zip(page, outcomes):
+            results[outcome.status] += 1
+            if outcome.status == 'successful':
+                try:
+                    with db_transaction.atomic():
+                        order = fulfil_transaction(transaction, outcome.data, outcome.amount, outcome.currency)
+                except Exception:
+                    logger.exception('Fulfilling %s failed', transaction.transaction_id)
+                    results['successful'] -= 1
+                    results['error'] += 1
+                    continue
+                if outcome.reference:
+                    idempotency.record(transaction.payment_method, outcome.reference, 'successful', transaction, order)
+            elif outcome.status in ('failed', 'abandoned'):
+                failed.append((transaction, outcome))
+            elif outcome.status == 'error':
+                logger.warning('Could not reconcile %s: %s', transaction.transaction_id, outcome.detail)
+
+        if failed:
+            # Lock first so only transactions this UPDATE really fails get an outbox event
+            still_pending = set(Transaction.objects.select_for_update().filter(
+                pk__in=[t.pk for t, _ in failed], status='pending').values_list('pk', flat=True))
+            Transaction.objects.filter(pk__in=still_pending).update(status='failed', updated_at=timezone.now())
+            failed = [(t, o) for t, o in failed if t.pk in still_pending]
+            for transaction, _ in failed:
+                transaction.status = 'failed'
+            outbox.emit(*[outbox.payment_status(transaction) for transaction, _ in failed])
+        for transaction, outcome in failed:
+            if outcome.status == 'failed' and outcome.reference:
+                idempotency.record(transaction.payment_method, outcome.reference, 'failed', transaction)
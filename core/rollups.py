@@ -0,0 +1,149 @@
+"""
+Hourly and daily sales rollups for the admin dashboard.
+
+Reports used to scan Order, OrderItem and Transaction end to end. Instead
+``refresh()`` keeps four small tables up to date: SalesRollup (completed
+orders and revenue), ProductSalesRollup (units and revenue per product and
+category) and GatewayRollup (payment attempts and outcomes per gateway),
+each at hour and day granularity, plus a RollupRefresh recording when
+they were last refreshed.
+
+A refresh only rebuilds buckets from the day of the previous refresh minus
+ROLLUP_LOOKBACK_HOURS onward, deleting and re-aggregating them in one
+database transaction. The lookback picks up orders and payments whose
+status changed after they were created (a mobile money order completed
+when an admin verifies it, a transaction failed by reconciliation); changes
+older than that need ``refresh_rollups --full``.
+
+Run it with ``python manage.py refresh_rollups`` (also scheduled from
+JOB_SCHEDULE).
+"""
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Min, Q, Sum
+from django.db.models.functions import TruncDay, TruncHour
+from django.utils import timezone
+
+from .models import (GatewayRollup, Order, OrderItem, ProductSalesRollup, RollupRefresh, SalesRollup,
+                     Transaction)
+
+ROLLUP = 'sales'
+PERIODS = {
+    'hour': TruncHour,
+    'day': TruncDay,
+}
+REVENUE_STATUSES = ['completed']
+
+
+def last_refreshed():
+    """When the rollups were last refreshed, or None if they never were"""
+    return RollupRefresh.objects.filter(name=ROLLUP).values_list('refreshed_at', flat=True).first()
+
+
+def _start_of_day(value):
+    return timezone.localtime(value).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _earliest():
+    dates = [
+        Order.objects.order_by().aggregate(first=Min('created_at'))['first'],
+        Transaction.objects.order_by().aggregate(first=Min('created_at'))['first'],
+    ]
+    dates = [d for d in dates if d is not None]
+    return min(dates) if dates else None
+
+
+def _sales(period, since):
+    trunc = PERIODS[period]
+    rows = (Order.objects.filter(created_at__gte=since, status__in=REVENUE_STATUSES)
+            .order_by().annotate(bucket=trunc('created_at')).values('bucket')
+            .annotate(orders=Count('id'), revenue=Sum('total')))
+    return [SalesRollup(period=period, **row) for row in rows]
+
+
+def _products(period, since):
+    trunc = PERIODS[period]
+    line_total = ExpressionWrapper(F('quantity') * F('unit_price'),
+                                   output_field=DecimalField(max_digits=14, decimal_places=2))
+    rows = (OrderItem.objects.filter(order__created_at__gte=since, order__status__in=REVENUE_STATUSES)
+            .order_by().annotate(bucket=trunc('order__created_at'))
+            .values('bucket', 'product_name', 'product_category')
+            .annotate(units=Sum('quantity'), revenue=Sum(line_total)))
+    merged = {}
+    for row in rows:
+        # NULL and '' both mean "no category"; they must land in the same row
+        key = (row['bucket'], row['product_name'], row['product_category'] or '')
+        if key in merged:
+            merged[key].units += row['units']
+            merged[key].revenue += row['revenue']
+        else:
+            merged[key] = ProductSalesRollup(period=period, bucket=key[0], product_name=key[1], category=key[2],
+                                             units=row['units'], revenue=row['revenue'])
+    return list(merged.values())
+
+
+def _gateways(period, since):
+    trunc = PERIODS[period]
+    rows = (Transaction.objects.filter(created_at__gte=since)
+            .order_by().annotate(bucket=trunc('created_at')).values('bucket', 'payment_method')
+            .annotate(attempts=Count('id'), successful=Count('id', filter=Q(status='successful')),
+                      failed=Count('id', filter=Q(status='failed'))))
+    return [GatewayRollup(period=period, **row) for row in rows]
+
+
+def refresh(full=False, lookback=None):
+    """
+    Bring the rollups up to date and return what was rebuilt: the start of
+    the rebuilt range, the number of rows written and the elapsed time.
+    """
+    started = time.monotonic()
+    now = timezone.now()
+    if lookback is None:
+        lookback = timedelta(hours=settings.ROLLUP_LOOKBACK_HOURS)
+    last = None if full else last_refreshed()
+    since = (last - lookback) if last is not None else _earliest()
+    written = 0
+
+    with transaction.atomic():
+        if since is not None:
+            since = _start_of_day(since)
+            for model, build in ((SalesRollup, _sales), (ProductSalesRollup, _products), (GatewayRollup, _gateways)):
+                model.objects.filter(bucket__gte=since).delete()
+                for period in PERIODS:
+                    rows = build(period, since)
+                    model.objects.bulk_create(rows, batch_size=500)
+                    written += len(rows)
+        RollupRefresh.objects.update_or_create(name=ROLLUP, defaults={'refreshed_at': now})
+
+    return {'since': since, 'rows': written, 'elapsed': time.monotonic() - started}
+
+
+def dashboard(days):
+    """Figures for the admin dashboard over the last ``days`` days, read from the rollups alone"""
+    now = timezone.now()
+    since = _start_of_day(now) - timedelta(days=days - 1)
+    daily = SalesRollup.objects.filter(period='day', bucket__gte=since).order_by('bucket')
+    products = ProductSalesRollup.objects.filter(period='day', bucket__gte=since).order_by()
+    gateways = list(
+        GatewayRollup.objects.filter(period='day', bucket__gte=since).order_by('payment_method')
+        .values('payment_method').annotate(attempts=Sum('attempts'), successful=Sum('successful'), failed=Sum('failed'))
+    )
+    for gateway in gateways:
+        gateway['success_rate'] = 100 * gateway['successful'] / gateway['attempts'] if gateway['attempts'] else None
+    return {
+        'days': days,
+        'since': since,
+        'refreshed_at': last_refreshed(),
+        'totals': daily.aggregate(orders=Sum('orders'), revenue=Sum('revenue')),
+        'daily': list(daily.values('bucket', 'orders', 'revenue')),
+        'hourly': list(SalesRollup.objects.filter(period='hour', bucket__gte=now - timedelta(hours=24))
+                       .order_by('bucket').values('bucket', 'orders', 'revenue')),
+        'top_products': list(products.values('product_name', 'category')
+                             .annotate(units=Sum('units'), revenue=Sum('revenue')).order_by('-revenue')[:10]),
+        'categories': list(products.values('category')
+                           .annotate(units=Sum('units'), revenue=Sum('revenue')).order_by('-revenue')),
+        'gateways': gateways,
+    }
@@ -0,0 +1,74 @@
+from django.db.models.signals import post_delete, post_init, post_save
+from django.db.transaction import on_commit
+from django.dispatch import receiver
+
+from shopp_it.events import publish
+from . import authentication, history
+from .models import CustomUser, Transaction, Order
+
+
+@receiver(post_init, sender=Transaction)
+@receiver(post_init, sender=Order)
+def remember_status(sender, instance, **kwargs):
+    """Keep the loaded status so saves can tell whether it actually changed"""
+    # Read from __dict__ so deferred loading never triggers a query
+    instance._original_status = instance.__dict__.get('status')
+
+
+def _publish_status(instance, created, event, channels):
+    if not created and instance.status == instance._original_status:
+        return
+    instance._original_status = instance.status
+    on_commit(lambda: [publish(channel, event) for channel in channels])
+
+
+@receiver(post_save, sender=Transaction)
+def publish_transaction_status(sender, instance, created, **kwargs):
+    """Push payment status transitions to the user's (and cart's) event stream"""
+    channels = [f'user:{instance.user_id}']
+    if instance.cart_id and Transaction.cart.is_cached(instance):
+        channels.append(f'cart:{instance.cart.cart_code}')
+    event = {
+        'type': 'transaction.status',
+        'transaction_id': instance.transaction_id,
+        'payment_method': instance.payment_method,
+        'status': instance.status,
+    }
+    _publish_status(instance, created, event, channels)
+
+
+@receiver(post_save, sender=Order)
+def publish_order_status(sender, instance, created, **kwargs):
+    """Push order creation and status changes to the user's (and cart's) event stream"""
+    channels = [f'user:{instance.user_id}']
+    if instance.transaction_id and Order.transaction.is_cached(instance):
+        transaction = instance.transaction
+        if transaction.cart_id and Transaction.cart.is_cached(transaction):
+            channels.append(f'cart:{transaction.cart.cart_code}')
+    event = {
+        'type': 'order.status',
+        'order_id': instance.id,
+        'status': instance.status,
+        'total': str(instance.total),
+    }
+    _publish_status(instance, created, event, channels)
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Order)
+def invalidate_order_history(sender, instance, **kwargs):
+    """Drop the user's cached first history page once the change is committed"""
+    on_commit(lambda: history.invalidate(instance.user_id))
+
+
+@receiver(post_save, sender=CustomUser)
+def invalidate_cached_user(sender, instance, **kwargs):
+    """Drop the cached user once the change is committed; a deactivated user's tokens stop working"""
+    user_id = instance.pk
+    on_commit(lambda: authentication.invalidate(user_id))
+
+
+@receiver(post_delete, sender=CustomUser)
+def forget_deleted_user(sender, instance, **kwargs):
+    user_id = instance.pk
+    on_commit(lambda: authentication.invalidate(user_id))
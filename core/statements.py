@@ -0,0 +1,136 @@
+"""
+Matching MTN and Airtel statement exports against pending mobile money
+payments.
+
+The statement CSV is streamed row by row against an in-memory index of the
+provider's pending payments keyed by transaction id. A row matches when the
+transaction id, the sender's phone number (normalised) and the amount all
+agree; every match is verified in bulk through core.mobile_money. Rows that
+only partly agree, or whose transaction id appears twice, are reported as
+ambiguous and left for an admin to review.
+
+Used by ``python manage.py match_statements`` and the "Upload statement"
+page of the mobile money admin.
+"""
+import csv
+import re
+import time
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+
+from .mobile_money import verify_payments
+from .models import MobileMoneyPayment
+
+# Header names seen in each provider's exports, by the field they hold (compared lowercased, alphanumerics only)
+COLUMNS = {
+    'mtn': {
+        'transaction_id': ['transactionid', 'financialtransactionid', 'externaltransactionid', 'id'],
+        'phone': ['from', 'fromnumber', 'frommsisdn', 'sender', 'payer'],
+        'amount': ['amount', 'transactionamount'],
+        'status': ['status', 'transactionstatus'],
+    },
+    'airtel': {
+        'transaction_id': ['transactionid', 'txnid', 'referenceid', 'airtelmoneyid', 'id'],
+        'phone': ['sendermsisdn', 'msisdn', 'sender', 'frommsisdn', 'payer'],
+        'amount': ['transactionamount', 'amount'],
+        'status': ['transactionstatus', 'status'],
+    },
+}
+SUCCESS_STATUSES = frozenset({'successful', 'success', 'completed', 'ts'})  # Airtel exports say TS
+VERIFY_BATCH = 500
+
+
+def normalize_phone(value):
+    """National number without country code or leading zeros, so 0803..., 234803... and +234 803... agree"""
+    digits = re.sub(r'\D', '', value or '')
+    country_code = settings.MOBILE_MONEY_COUNTRY_CODE
+    if country_code and digits.startswith(country_code) and len(digits) > len(country_code) + 7:
+        digits = digits[len(country_code):]
+    return digits.lstrip('0')
+
+
+def parse_amount(value):
+    try:
+        return Decimal(re.sub(r'[^\d.\-]', '', value or '')).quantize(Decimal('0.01'))
+    except InvalidOperation:
+        return None
+
+
+def _column_map(fieldnames, provider):
+    """{field: header} for the headers this export uses"""
+    headers = {re.sub(r'[^a-z0-9]', '', name.lower()): name for name in fieldnames or []}
+    found = {}
+    for field, candidates in COLUMNS[provider].items():
+        for candidate in candidates:
+            if candidate in headers:
+                found[field] = headers[candidate]
+                break
+    missing = {'transaction_id', 'phone', 'amount'} - set(found)
+    if missing:
+        raise ValueError(f"Statement has no {', '.join(sorted(missing))} column for {provider}")
+    return found
+
+
+def pending_index(provider):
+    """Pending payments of a provider by transaction id: {id: (pk, phone, amount)}"""
+    return {
+        transaction_id.strip().upper(): (pk, normalize_phone(phone), amount)
+        for pk, transaction_id, phone, amount in MobileMoneyPayment.objects.filter(provider=provider, status='pending')
+        .order_by().values_list('pk', 'transaction_id', 'phone_number', 'amount').iterator(chunk_size=2000)
+    }
+
+
+def match_statement(lines, provider, admin_user=None, dry_run=False, source='statement'):
+    """
+    Match a statement (any iterable of CSV text lines) and verify the exact
+    matches. Returns counts plus the ambiguous rows for review.
+    """
+    started = time.monotonic()
+    reader = csv.DictReader(lines)
+    columns = _column_map(reader.fieldnames, provider)
+    index = pending_index(provider)
+
+    matched = {}  # transaction id -> payment pk
+    ambiguous = []
+    seen = set()
+    result = {'rows': 0, 'skipped': 0, 'matched': 0, 'ambiguous': 0, 'unmatched': 0, 'verified': 0}
+    for row in reader:
+        result['rows'] += 1
+        status = row.get(columns['status'], '') if 'status' in columns else 'successful'
+        if (status or '').strip().lower() not in SUCCESS_STATUSES:
+            result['skipped'] += 1
+            continue
+        transaction_id = (row.get(columns['transaction_id']) or '').strip().upper()
+        if transaction_id in seen:
+            # The same reference twice in one statement: neither copy can be trusted
+            if matched.pop(transaction_id, None) is not None:
+                result['matched'] -= 1
+            ambiguous.append({'row': result['rows'], 'transaction_id': transaction_id, 'reason': 'duplicate in statement'})
+            continue
+        seen.add(transaction_id)
+
+        payment = index.get(transaction_id)
+        if payment is None:
+            result['unmatched'] += 1
+            continue
+        pk, phone, amount = payment
+        row_phone = normalize_phone(row.get(columns['phone']))
+        row_amount = parse_amount(row.get(columns['amount']))
+        if row_phone == phone and row_amount == amount:
+            matched[transaction_id] = pk
+            result['matched'] += 1
+        else:
+            reasons = [name for name, ok in (('phone', row_phone == phone), ('amount', row_amount == amount)) if not ok]
+            ambiguous.append({'row': result['rows'], 'transaction_id': transaction_id,
+                              'reason': f"{' and '.join(reasons)} differ"})
+
+    result['ambiguous'] = len(ambiguous)
+    if not dry_run:
+        ids = list(matched.values())
+        for start in range(0, len(ids), VERIFY_BATCH):
+            result['verified'] += verify_payments(ids[start:start + VERIFY_BATCH], admin_user,
+                                                  f'Matched {provider.upper()} {source}')
+    result['elapsed'] = time.monotonic() - started
+    result['ambiguous_rows'] = ambiguous
+    return result
@@ -0,0 +1,77 @@
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+from shopp_it.events import get_broker
+from .authentication import cached_user
+
+
+def _user_id_from_token(request):
+    """Active user's id from a Bearer header or ?token= (EventSource cannot send headers)"""
+    header = request.headers.get('Authorization', '')
+    raw_token = header.split(' ', 1)[1] if header.startswith('Bearer ') else request.GET.get('token')
+    if not raw_token:
+        return None
+    validated_token = JWTAuthentication().get_validated_token(raw_token)
+    if jwt_settings.USER_ID_CLAIM not in validated_token:
+        raise InvalidToken('Token contained no recognizable user identification')
+    user = cached_user(validated_token[jwt_settings.USER_ID_CLAIM])
+    if user is None:
+        raise AuthenticationFailed('User not found', code='user_not_found')
+    if jwt_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+        raise AuthenticationFailed('User is inactive', code='user_inactive')
+    return user.pk
+
+
+async def _events(channels):
+    subscription = get_broker().subscribe(channels)
+    try:
+        yield 'retry: 3000\n\n'
+        while True:
+            event = await subscription.get(timeout=settings.EVENT_STREAM_HEARTBEAT)
+            if event is None:
+                yield ': keep-alive\n\n'
+            else:
+                yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+    finally:
+        subscription.close()
+
+
+# Cart and payment status stream (replaces polling /api/cart/ and the payment status pages)
+async def event_stream(request):
+    """
+    Server-sent events for a cart (?cart_code=) and/or the signed-in user.
+    Pushes cart.updated, transaction.status and order.status events.
+    Only the ASGI application can hold these connections open.
+    """
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({'error': 'Event streams are only served by the ASGI application'}, status=501)
+
+    channels = []
+    cart_code = request.GET.get('cart_code') or request.GET.get('cart_mode')
+    if cart_code:
+        channels.append(f'cart:{cart_code}')
+
+    try:
+        user_id = await sync_to_async(_user_id_from_token)(request)
+    except (InvalidToken, TokenError):
+        return JsonResponse({'error': 'Invalid or expired token'}, status=401)
+    except AuthenticationFailed as e:
+        return JsonResponse({'error': str(e.detail)}, status=401)
+    if user_id:
+        channels.append(f'user:{user_id}')
+
+    if not channels:
+        return JsonResponse({'error': 'cart_code or token required'}, status=400)
+
+    response = StreamingHttpResponse(_events(channels), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,76 @@
+"""
+Background job handlers (see core.jobs). Loaded by ``manage.py run_jobs``.
+"""
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.management import call_command
+from django.utils import timezone
+
+from cart_app.models import Cart
+from . import idempotency, outbox
+from .gateway import GatewayError, flutterwave
+from .jobs import job
+from .mobile_money import reject_payments, verify_payments
+from .models import CustomUser, Job
+from .payments import complete_payment, foreign_payment, mark_failed, record_flutterwave_transaction
+
+
+@job('flutterwave.verify_payment')
+def verify_flutterwave_payment(tx_ref, transaction_id):
+    """Verify a webhook-reported payment and fulfil it; gateway trouble raises so the job is retried"""
+    if idempotency.finalised('flutterwave', transaction_id, tx_ref) is not None:
+        return
+    cart_code = tx_ref.split('-')[0] if '-' in tx_ref else tx_ref
+    cart = Cart.objects.for_code(cart_code).filter(cart_code=cart_code).first()
+    if cart is None:
+        return
+    transaction = record_flutterwave_transaction(tx_ref, cart)
+
+    response = flutterwave().get(f'/transactions/{transaction_id}/verify', endpoint='transactions.verify')
+    if response.status_code >= 500:
+        raise GatewayError(f'Flutterwave answered HTTP {response.status_code}')
+    verify_data = response.json() if response.status_code == 200 else {}
+    if foreign_payment(verify_data, tx_ref):
+        return
+    data = verify_data.get('data', {}) if verify_data.get('status') == 'success' else {}
+
+    if data.get('status') != 'successful':
+        mark_failed(transaction.pk)
+        if data.get('status') == 'failed':
+            idempotency.record('flutterwave', transaction_id, 'failed', transaction)
+        return
+    amount = currency = None
+    if transaction.amount == Decimal('0'):
+        amount = Decimal(str(data.get('amount', 0)))
+        currency = data.get('currency', 'USD')
+    order = complete_payment(transaction.pk, verify_data, amount, currency)
+    idempotency.record('flutterwave', transaction_id, 'successful', transaction, order)
+
+
+@job('call_command')
+def run_management_command(command, args=None, options=None):
+    """Run a management command, e.g. from JOB_SCHEDULE"""
+    call_command(command, *(args or []), **(options or {}))
+
+
+@job('jobs.prune')
+def prune_jobs(days=7):
+    """Delete finished jobs older than days"""
+    cutoff = timezone.now() - timedelta(days=days)
+    Job.objects.filter(status__in=['done', 'failed'], finished_at__lt=cutoff).delete()
+
+
+@job('outbox.prune')
+def prune_outbox(days=None):
+    """Delete outbox events delivered more than days (OUTBOX_RETENTION_DAYS) ago"""
+    outbox.prune(timedelta(days=days if days is not None else settings.OUTBOX_RETENTION_DAYS))
+
+
+@job('mobile_money.settle')
+def settle_mobile_money(payment_ids, action, admin_user_id=None, note=''):
+    """Bulk verify or reject mobile money payments queued from the admin"""
+    admin_user = CustomUser.objects.filter(pk=admin_user_id).first() if admin_user_id else None
+    settle = verify_payments if action == 'verified' else reject_payments
+    settle(payment_ids, admin_user, note)
@@ -1,3 +1,1082 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import importlib
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import skipUnless
 
-# Create your tests here.
+import requests
+import urllib3
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.admin.sites import site
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.test import (AsyncClient, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.module_loading import autodiscover_modules
+from rest_framework_simplejwt.tokens import AccessToken
+
+from cart_app.models import Cart
+from shop_app.models import Product
+from shopp_it import events, log
+from shopp_it.asgi import application
+from . import (authentication, gateway, history, idempotency, jobs, mobile_money, outbox, payloads, rollups,
+               tasks)
+from .fake_gateway import FakeGateway
+from .fulfilment import FulfilmentPending, fulfil_transaction
+from .models import (ArchivedOrder, ArchivedTransaction, CustomUser, GatewayPayload, GatewayRollup, Job,
+                     MobileMoneyPayment, Order, OrderItem, OutboxEvent, PaymentAudit, PaymentLedger,
+                     ProductSalesRollup, SalesRollup, Transaction)
+from .payments import mark_failed
+from .paypal_client import paypal
+from .reconciliation import TokenBucket
+from .statements import match_statement
+
+
+class PaymentTestCase(TestCase):
+    databases = '__all__'  # carts may live on any shard
+
+    def setUp(self):
+        cache.clear()
+        idempotency._local.clear()
+        self.product = Product.objects.create(name='Shirt', price=2, image='products/a.jpg')
+        self.user = CustomUser.objects.create_user(username='u', password='p', email='u@example.com')
+
+    def make_cart(self, cart_code, quantity=1):
+        cart = Cart.objects.for_code(cart_code).create(cart_code=cart_code, user=self.user)
+        cart.items.create(product=self.product, quantity=quantity, unit_price=self.product.price)
+        return cart
+
+    def cart(self, cart_code):
+        return Cart.objects.for_code(cart_code).get(cart_code=cart_code)
+
+    def fake_gateway(self, **kwargs):
+        """A running FakeGateway that FLUTTERWAVE_BASE_URL points at for the rest of the test"""
+        fake = FakeGateway(**kwargs).start()
+        self.addCleanup(fake.stop)
+        overrides = override_settings(FLUTTERWAVE_BASE_URL=fake.url, GATEWAY_BACKOFF=0.01)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        return fake
+
+
+class EventStreamTests(TransactionTestCase):
+    def test_cart_updates_are_pushed(self):
+        async def run():
+            product = await sync_to_async(Product.objects.create)(name='Shirt', price=2, image='products/a.jpg')
+            client = AsyncClient()
+            response = await client.get('/api/events/?cart_code=abc')
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            stream = response.streaming_content.__aiter__()
+            self.assertIn(b'retry', await stream.__anext__())
+            await client.post('/api/add_item/', {'cart_code': 'abc', 'product_id': product.id})
+            self.assertIn(b'cart.updated', await asyncio.wait_for(stream.__anext__(), 2))
+            await stream.aclose()
+
+        cache.clear()
+        asyncio.run(run())
+
+    def test_wsgi_is_refused(self):
+        self.assertEqual(self.client.get('/api/events/?cart_code=abc').status_code, 501)
+
+    def test_tokens_of_missing_or_inactive_users_are_refused(self):
+        inactive = CustomUser.objects.create_user(username='gone', password='pw', is_active=False)
+        missing = AccessToken.for_user(inactive)
+        missing['user_id'] = str(inactive.pk + 1000)
+        tokens = [AccessToken.for_user(inactive), missing]
+        cache.clear()
+        authentication._local.clear()
+
+        async def run(token):
+            return await AsyncClient().get(f'/api/events/?token={token}')
+
+        for token in tokens:
+            self.assertEqual(asyncio.run(run(token)).status_code, 401)
+
+
+class StreamDisconnectTests(SimpleTestCase):
+    def test_disconnect_ends_the_stream(self):
+        async def run():
+            messages = asyncio.Queue()
+            await messages.put({'type': 'http.request', 'body': b'', 'more_body': False})
+            sent = []
+
+            async def send(message):
+                sent.append(message)
+                if message.get('body', b'').startswith(b'retry'):
+                    await messages.put({'type': 'http.disconnect'})
+
+            scope = {
+                'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+                'scheme': 'http', 'path': '/api/events/', 'raw_path': b'/api/events/',
+                'query_string': b'cart_code=gone', 'root_path': '', 'headers': [(b'host', b'testserver')],
+                'client': ('127.0.0.1', 1234), 'server': ('testserver', 80),
+            }
+            await asyncio.wait_for(application(scope, messages.get, send), 5)
+            return sent
+
+        sent = asyncio.run(run())
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertNotIn('cart:gone', events.get_broker()._subscribers)
+
+
+def closed_port_url():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return f'http://127.0.0.1:{sock.getsockname()[1]}'
+
+
+class GatewayClientTests(SimpleTestCase):
+    def setUp(self):
+        self.gateway = FakeGateway().start()
+        self.addCleanup(self.gateway.stop)
+
+    def client_for(self, url, **kwargs):
+        return gateway.GatewayClient('test', url, backoff=0.01, **kwargs)
+
+    def test_idempotent_calls_are_retried(self):
+        self.gateway.fail_next = 1
+        client = self.client_for(self.gateway.url)
+        self.assertEqual(client.get('/transactions/1/verify').status_code, 404)
+        stats = client.metrics()['endpoints']['/transactions/1/verify']
+        self.assertEqual((stats['calls'], stats['errors'], stats['retries']), (2, 1, 1))
+
+    def test_post_is_not_repeated_once_sent(self):
+        self.gateway.fail_next = 1
+        client = self.client_for(self.gateway.url)
+        self.assertEqual(client.post('/payments', json={}).status_code, 503)
+        self.assertEqual(len(self.gateway.requests), 1)
+
+    def test_post_is_retried_when_never_connected(self):
+        client = self.client_for(closed_port_url(), retries=2)
+        with self.assertRaises(gateway.GatewayError):
+            client.post('/payments', json={})
+        self.assertEqual(client.metrics()['endpoints']['/payments']['retries'], 2)
+
+    def test_dropped_connections_count_as_sent(self):
+        dropped = requests.ConnectionError(urllib3.exceptions.ProtocolError('Connection aborted.'))
+        refused = requests.ConnectionError(urllib3.exceptions.MaxRetryError(
+            None, '/', urllib3.exceptions.NewConnectionError(None, 'refused')))
+        self.assertFalse(gateway._never_connected(dropped))
+        self.assertTrue(gateway._never_connected(refused))
+        self.assertFalse(gateway._never_connected(requests.ReadTimeout()))
+
+    def test_breaker_opens_and_fails_fast(self):
+        client = self.client_for(closed_port_url(), retries=0, breaker=gateway.CircuitBreaker(2, 60))
+        for _ in range(2):
+            with self.assertRaises(gateway.GatewayError):
+                client.get('/x')
+        with self.assertRaises(gateway.CircuitOpen):
+            client.get('/x')
+        self.assertEqual(client.metrics()['circuit'], 'open')
+        self.assertEqual(client.metrics()['endpoints']['/x']['short_circuited'], 1)
+
+    def test_breaker_half_open_allows_one_trial(self):
+        breaker = gateway.CircuitBreaker(1, 0.05)
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_replaced_async_clients_are_closed(self):
+        async def run():
+            old = gateway.flutterwave_async()
+            with override_settings(GATEWAY_RETRIES=0):
+                new = gateway.flutterwave_async()
+            self.assertIsNot(new, old)
+            await asyncio.sleep(0)
+            self.assertTrue(old.http.is_closed)
+            await new.aclose()
+
+        asyncio.run(run())
+
+
+@override_settings(ASYNC_VERIFY_CONCURRENCY=5)
+class AsyncVerifyTests(PaymentTestCase):
+    def get(self, url):
+        async def fetch():
+            return await AsyncClient().get(url)
+
+        return async_to_sync(fetch)()
+
+    def test_concurrent_callbacks(self):
+        fake = self.fake_gateway(delay=0.1)
+        codes = [f'async{i}' for i in range(5)]
+        for i, code in enumerate(codes):
+            self.make_cart(code)
+            fake.payments[str(i)] = {'tx_ref': f'{code}-1', 'amount': 2, 'currency': 'USD'}
+        client = AsyncClient()
+
+        async def run():
+            return await asyncio.gather(*[
+                client.post('/api/async/payments/flutterwave/callback/',
+                            {'status': 'successful', 'tx_ref': f'{code}-1', 'transaction_id': str(i)},
+                            content_type='application/json')
+                for i, code in enumerate(codes)
+            ])
+
+        for response in async_to_sync(run)():
+            self.assertTrue(response.json()['success'], response.content)
+        self.assertEqual(Order.objects.count(), 5)
+        self.assertEqual({self.cart(code).paid for code in codes}, {True})
+
+        calls = len(fake.requests)
+        r = self.get('/api/async/payments/flutterwave/verify/?status=successful&tx_ref=async0-1&transaction_id=0')
+        self.assertIn('/payment/success', r['Location'])
+        self.assertEqual(len(fake.requests), calls)
+        self.assertEqual(Order.objects.count(), 5)
+
+    def test_amount_mismatch_fails(self):
+        fake = self.fake_gateway()
+        cart = self.make_cart('async9')
+        Transaction.objects.create(user=self.user, cart=cart, transaction_id='async9-1', amount=2,
+                                   payment_method='flutterwave')
+        fake.payments['9'] = {'tx_ref': 'async9-1', 'amount': 1, 'currency': 'USD'}
+        r = self.get('/api/async/payments/flutterwave/verify/?status=successful&tx_ref=async9-1&transaction_id=9')
+        self.assertIn('/payment/failed', r['Location'])
+        self.assertEqual(Transaction.objects.get().status, 'failed')
+        self.assertFalse(Order.objects.exists())
+
+
+@jobs.job('tests.noop')
+def noop(**payload):
+    pass
+
+
+class JobQueueTests(TestCase):
+    def test_claims_never_overlap(self):
+        for i in range(5):
+            jobs.enqueue('tests.noop', {'i': i})
+        first, second = jobs.claim(3, 'a'), jobs.claim(3, 'b')
+        self.assertEqual((len(first), len(second)), (3, 2))
+        self.assertFalse({job.pk for job in first} & {job.pk for job in second})
+        self.assertEqual(jobs.claim(3, 'c'), [])
+
+    def test_dedupe_key(self):
+        job = jobs.enqueue('tests.noop', dedupe_key='once')
+        self.assertEqual(jobs.enqueue('tests.noop', dedupe_key='once').pk, job.pk)
+        Job.objects.filter(pk=job.pk).update(status='failed')
+        self.assertEqual(jobs.enqueue('tests.noop', dedupe_key='once').status, 'queued')
+
+    def test_heartbeat_keeps_long_jobs(self):
+        job = jobs.enqueue('tests.noop')
+        jobs.claim(1, 'a')
+        long_ago = timezone.now() - timedelta(hours=1)
+        Job.objects.update(locked_at=long_ago)
+        self.assertEqual(jobs.heartbeat([job.pk], 'b'), 0)
+        self.assertEqual(jobs.heartbeat([job.pk], 'a'), 1)
+        self.assertEqual(jobs.requeue_stale(60), 0)
+        Job.objects.update(locked_at=long_ago)
+        self.assertEqual(jobs.requeue_stale(60), 1)
+        self.assertEqual(Job.objects.get().status, 'queued')
+
+    def test_taken_over_job_keeps_its_new_owner(self):
+        jobs.enqueue('tests.noop')
+        [abandoned] = jobs.claim(1, 'a')
+        Job.objects.update(locked_at=timezone.now() - timedelta(hours=1))
+        jobs.requeue_stale(60)
+        jobs.claim(1, 'b')
+        self.assertTrue(jobs.run(abandoned))
+        self.assertEqual(Job.objects.values_list('status', 'locked_by').get(), ('running', 'b'))
+
+    def test_failures_are_retried_then_failed(self):
+        job = jobs.enqueue('tests.missing', max_attempts=2)
+        [claimed] = jobs.claim(1, 'a')
+        self.assertFalse(jobs.run(claimed))
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        self.assertIn('No handler registered', job.last_error)
+
+
+@override_settings(GATEWAY_RETRIES=0, FLUTTERWAVE_WEBHOOK_HASH='s3cret')
+class WebhookJobTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        cache.clear()
+        idempotency._local.clear()
+        product = Product.objects.create(name='Shirt', price=2, image='products/a.jpg')
+        user = CustomUser.objects.create_user(username='u', password='p', email='u@example.com')
+        cart = Cart.objects.for_code('hook').create(cart_code='hook', user=user)
+        cart.items.create(product=product, quantity=2, unit_price=2)
+        self.gateway = FakeGateway().start()
+        self.addCleanup(self.gateway.stop)
+        self.gateway.payments['77'] = {'tx_ref': 'hook-1', 'amount': 4, 'currency': 'USD'}
+        self.body = {'event': 'charge.completed', 'data': {'id': 77, 'tx_ref': 'hook-1', 'status': 'successful'}}
+
+    def post(self, verif_hash):
+        with override_settings(FLUTTERWAVE_BASE_URL=self.gateway.url):
+            return self.client.post('/api/payments/flutterwave/callback/', self.body, content_type='application/json',
+                                    HTTP_VERIF_HASH=verif_hash)
+
+    def run_jobs(self):
+        with override_settings(FLUTTERWAVE_BASE_URL=self.gateway.url):
+            call_command('run_jobs', once=True, no_schedule=True, concurrency=1, stdout=StringIO())
+
+    def test_webhook_is_verified_in_a_job(self):
+        self.assertEqual(self.post('wrong').status_code, 401)
+        for _ in range(2):
+            self.assertEqual(self.post('s3cret').json(), {'success': True, 'queued': True})
+        job = Job.objects.get(name='flutterwave.verify_payment')
+
+        self.gateway.fail_next = 1
+        self.run_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'queued')
+        self.assertIn('503', job.last_error)
+
+        Job.objects.update(run_at=job.created_at)
+        self.run_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(Order.objects.get().total, 4)
+
+    @override_settings(FLUTTERWAVE_WEBHOOK_HASH='')
+    def test_refused_without_a_configured_hash(self):
+        self.assertEqual(self.post('').status_code, 401)
+        self.assertFalse(Job.objects.exists())
+
+
+class FulfilmentTests(PaymentTestCase):
+    def paid_transaction(self, cart_code, lines):
+        cart = Cart.objects.for_code(cart_code).create(cart_code=cart_code, user=self.user)
+        for i in range(lines):
+            product = Product.objects.create(name=f'{cart_code}-{i}', price=2, image='products/a.jpg')
+            cart.items.create(product=product, quantity=1, unit_price=2)
+        return Transaction.objects.create(user=self.user, cart=cart, transaction_id=f'{cart_code}-1',
+                                          amount=2 * lines, payment_method='paypal')
+
+    def test_queries_do_not_grow_with_the_cart(self):
+        counts = []
+        for lines in (1, 10):
+            transaction = Transaction.objects.get(pk=self.paid_transaction(f'lines{lines}', lines).pk)
+            with CaptureQueriesContext(connection) as queries:
+                order = fulfil_transaction(transaction, {'id': 'PAY-1'})
+            counts.append(len(queries))
+            self.assertEqual(order.items.count(), lines)
+            self.assertTrue(Transaction.objects.get(pk=transaction.pk).cart.paid)
+        self.assertEqual(counts[0], counts[1])
+
+    def test_repeats_return_the_first_order(self):
+        transaction = self.paid_transaction('again', 2)
+        order = fulfil_transaction(transaction)
+        self.assertEqual(fulfil_transaction(Transaction.objects.get(pk=transaction.pk)).pk, order.pk)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_losing_claim_returns_the_winners_order(self):
+        # Both callers loaded the transaction while it was pending; the second loses the claim.
+        # (Real threads cannot share the in-memory SQLite test database.)
+        transaction = self.paid_transaction('race', 1)
+        loser = Transaction.objects.get(pk=transaction.pk)
+        order = fulfil_transaction(transaction)
+        self.assertEqual(loser.status, 'pending')
+        self.assertEqual(fulfil_transaction(loser).pk, order.pk)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_claimed_without_an_order_is_pending(self):
+        transaction = self.paid_transaction('orphan', 1)
+        Transaction.objects.filter(pk=transaction.pk).update(status='successful')
+        with self.assertRaises(FulfilmentPending):
+            fulfil_transaction(transaction)
+        self.assertFalse(Order.objects.exists())
+
+
+class IdempotencyTests(PaymentTestCase):
+    def setUp(self):
+        super().setUp()
+        self.make_cart('idem')
+        self.gateway = self.fake_gateway()
+        self.gateway.payments['55'] = {'tx_ref': 'idem-1', 'amount': 2, 'currency': 'USD'}
+        self.body = {'status': 'successful', 'tx_ref': 'idem-1', 'transaction_id': '55'}
+
+    def callback(self, **headers):
+        return self.client.post('/api/payments/flutterwave/callback/', self.body, content_type='application/json',
+                                **headers)
+
+    def test_repeated_deliveries_are_answered_from_the_ledger(self):
+        first = self.callback()
+        self.assertTrue(first.json()['success'], first.content)
+        calls = len(self.gateway.requests)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.callback().json(), first.json())
+
+        idempotency._local.clear()
+        cache.clear()
+        with self.assertNumQueries(1):
+            r = self.client.get('/api/payments/flutterwave/verify/?status=successful&tx_ref=idem-1&transaction_id=55')
+        self.assertIn(f"order_id={first.json()['order']['id']}", r['Location'])
+        with override_settings(FLUTTERWAVE_WEBHOOK_HASH='s3cret'):
+            self.assertEqual(self.callback(HTTP_VERIF_HASH='s3cret').json(), {'success': True, 'queued': False})
+        self.assertEqual(len(self.gateway.requests), calls)
+        self.assertEqual((PaymentLedger.objects.count(), Order.objects.count()), (1, 1))
+
+    def test_result_is_tied_to_its_tx_ref(self):
+        self.callback()
+        self.assertIsNotNone(idempotency.finalised('flutterwave', '55', 'idem-1'))
+        self.assertIsNone(idempotency.finalised('flutterwave', '55', 'other-1'))
+
+    def test_payment_cannot_be_replayed_for_another_tx_ref(self):
+        self.assertTrue(self.callback().json()['success'])
+        self.make_cart('other')
+        Transaction.objects.create(user=self.user, cart=self.cart('other'), transaction_id='other-2', amount=2,
+                                   payment_method='flutterwave')
+        self.body['tx_ref'] = 'other-1'
+        r = self.callback()
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json(), {'success': False, 'message': 'Payment verification failed'})
+        r = self.client.get('/api/payments/flutterwave/verify/?status=successful&tx_ref=other-2&transaction_id=55')
+        self.assertIn('error=verification_failed', r['Location'])
+
+        async def replay():
+            return await AsyncClient().post('/api/async/payments/flutterwave/callback/', self.body,
+                                            content_type='application/json')
+        self.assertFalse(async_to_sync(replay)().json()['success'])
+        tasks.verify_flutterwave_payment('other-1', '55')
+
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(set(Transaction.objects.filter(transaction_id__startswith='other')
+                             .values_list('status', flat=True)), {'pending'})
+        self.assertFalse(self.cart('other').paid)
+
+    def test_first_outcome_wins(self):
+        self.gateway.payment_status = 'failed'
+        Transaction.objects.create(user=self.user, cart=self.cart('idem'), transaction_id='idem-1', amount=2,
+                                   payment_method='flutterwave')
+        for _ in range(2):
+            r = self.client.get('/api/payments/flutterwave/verify/?status=failed&tx_ref=idem-1&transaction_id=55')
+            self.assertIn('/payment/failed', r['Location'])
+        self.assertEqual(len(self.gateway.requests), 1)
+        self.assertEqual(idempotency.record('flutterwave', '55', 'successful')['outcome'], 'failed')
+
+
+@override_settings(PAYPAL_API='core.fake_paypal.StubPayPalApi', PAYPAL_CLIENT_ID='id', PAYPAL_CLIENT_SECRET='secret')
+class PayPalTests(PaymentTestCase):
+    def setUp(self):
+        super().setUp()
+        self.make_cart('paypal')
+        self.auth = f'Bearer {AccessToken.for_user(self.user)}'
+        r = self.client.post('/api/payments/paypal/initiate/', {'cart_code': 'paypal'}, HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(r.status_code, 200, r.content)
+        self.payment_id = r.json()['approval_url'].split('token=')[1]
+        paypal().calls.clear()
+
+    def execute(self):
+        return self.client.post('/api/payments/paypal/execute/', {'paymentId': self.payment_id, 'PayerID': 'P1'})
+
+    def test_execution_is_replayed(self):
+        for _ in range(2):
+            self.assertEqual(self.execute().json(), {'success': True, 'message': 'Payment completed successfully'})
+        self.assertEqual(len([call for call in paypal().calls if call[1].endswith('/execute')]), 1)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_failed_outcome_is_replayed_as_a_failure(self):
+        idempotency.record('paypal', self.payment_id, 'failed', Transaction.objects.get())
+        self.assertEqual(self.execute().json(), {'success': False, 'message': 'Payment execution failed'})
+        self.assertFalse([call for call in paypal().calls if call[1].endswith('/execute')])
+        self.assertFalse(Order.objects.exists())
+
+    def test_client_and_token_are_reused(self):
+        api = paypal()
+        requested = api.token_requests
+        self.execute()
+        self.assertIs(paypal(), api)
+        self.assertEqual(api.token_requests, requested)
+
+    def test_expired_token_is_refreshed_once(self):
+        api = paypal()
+        api.token_hash = None
+        requested = api.token_requests
+        threads = [threading.Thread(target=api.get_access_token) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(api.token_requests, requested + 1)
+        api.token_expires_at = 0
+        api.get_access_token()
+        self.assertEqual(api.token_requests, requested + 2)
+
+
+class LoggingContextTests(PaymentTestCase):
+    def test_bound_fields_are_reset(self):
+        with log.bound(tx_ref='abc-1'):
+            token = log.bind(step='verify')
+            self.assertEqual((log.current('tx_ref'), log.current('step')), ('abc-1', 'verify'))
+            log.unbind(token)
+            self.assertIsNone(log.current('step'))
+        self.assertIsNone(log.current('tx_ref'))
+
+    def test_gateway_timings_stay_on_their_record(self):
+        fake = self.fake_gateway()
+        with self.assertLogs('core.gateway', 'INFO') as logs:
+            gateway.flutterwave().get('/transactions/1/verify')
+        self.assertEqual(logs.records[0].gateway_call['status'], 404)
+        self.assertIsNone(log.current('gateway_call'))
+        self.assertEqual(len(fake.requests), 1)
+
+    def test_error_responses_carry_the_request_id(self):
+        with self.assertLogs('django.request', 'WARNING') as logs:
+            r = self.client.get('/api/cart/?cart_code=missing', HTTP_X_REQUEST_ID='req-42')
+        self.assertEqual(r['X-Request-ID'], 'req-42')
+        record = logs.records[0]
+        log.ContextFilter().filter(record)
+        self.assertEqual(record.request_id, 'req-42')
+
+    def test_malformed_request_ids_are_replaced(self):
+        for header in ['req 42\nlevel=ERROR', 'x' * 65, '']:
+            r = self.client.get('/api/products/', HTTP_X_REQUEST_ID=header)
+            self.assertRegex(r['X-Request-ID'], r'^[0-9a-f]{32}$')
+
+
+@override_settings(PAYPAL_API='core.fake_paypal.StubPayPalApi', PAYPAL_CLIENT_ID='id', PAYPAL_CLIENT_SECRET='secret')
+class ReconcileTests(PaymentTestCase):
+    def pending(self, cart_code, method='flutterwave', **fields):
+        return Transaction.objects.create(user=self.user, cart=self.make_cart(cart_code),
+                                          transaction_id=f'{cart_code}-1', amount=2, payment_method=method, **fields)
+
+    def reconcile(self, **options):
+        out = StringIO()
+        call_command('reconcile_payments', rate=100, stdout=out, **options)
+        return out.getvalue()
+
+    def test_pending_payments_are_settled(self):
+        fake = self.fake_gateway(delay=0.05)
+        for i in range(12):
+            self.pending(f'rec{i}')
+            if i < 8:
+                fake.payments[str(500 + i)] = {'tx_ref': f'rec{i}-1', 'amount': 2, 'currency': 'USD',
+                                               'status': 'successful' if i < 6 else 'failed'}
+        api = paypal()
+        payment = api.post('v1/payments/payment', {'intent': 'sale'})
+        api.payments[payment['id']]['state'] = 'approved'
+        self.pending('recpp', method='paypal', provider_reference=payment['id'])
+        Transaction.objects.update(created_at=timezone.now() - timedelta(hours=2))
+        Transaction.objects.filter(transaction_id='rec10-1').update(created_at=timezone.now() - timedelta(days=2))
+
+        out = self.reconcile(workers=4, batch_size=5)
+        self.assertIn('7 fulfilled, 2 failed, 1 abandoned, 3 still pending', out)
+        self.assertEqual(Order.objects.count(), 7)
+        self.assertEqual(Transaction.objects.filter(status='failed').count(), 3)
+        self.assertEqual(idempotency.finalised('flutterwave', '500')['outcome'], 'successful')
+        self.assertIn('Checked 3', self.reconcile())
+
+    def test_recent_payments_are_left_alone(self):
+        self.pending('fresh')
+        self.assertIn('Checked 0', self.reconcile())
+
+    def test_token_bucket_limits_the_rate(self):
+        bucket = TokenBucket(20, 1)
+        started = time.monotonic()
+        for _ in range(11):
+            bucket.acquire()
+        self.assertGreater(time.monotonic() - started, 0.45)
+
+
+class ProviderReferenceTests(PaymentTestCase):
+    def test_fulfilment_stores_the_flutterwave_id(self):
+        fake = self.fake_gateway()
+        self.make_cart('ref')
+        fake.payments['901'] = {'tx_ref': 'ref-1', 'amount': 2, 'currency': 'USD'}
+        self.client.post('/api/payments/flutterwave/callback/',
+                         {'status': 'successful', 'tx_ref': 'ref-1', 'transaction_id': '901'},
+                         content_type='application/json')
+        self.assertEqual(Transaction.objects.get(payment_method='flutterwave', provider_reference='901').status,
+                         'successful')
+
+    def test_reference_is_unique_per_gateway(self):
+        cart = self.make_cart('dupe')
+        fields = {'user': self.user, 'cart': cart, 'amount': 2, 'provider_reference': 'PAY-1'}
+        Transaction.objects.create(transaction_id='dupe-1', payment_method='paypal', **fields)
+        Transaction.objects.create(transaction_id='dupe-2', payment_method='flutterwave', **fields)
+        with self.assertRaises(IntegrityError):
+            Transaction.objects.create(transaction_id='dupe-3', payment_method='paypal', **fields)
+
+    def test_backfill_reads_the_stored_responses(self):
+        migration = importlib.import_module('core.migrations.0009_backfill_provider_reference')
+        self.assertEqual(migration.provider_reference('paypal', {'paypal_payment_id': 'PAY-1'}), 'PAY-1')
+        self.assertEqual(migration.provider_reference('flutterwave', {'data': {'id': 77}}), '77')
+        self.assertIsNone(migration.provider_reference('flutterwave', None))
+        self.assertIsNone(migration.provider_reference('mtn', {'data': {'id': 77}}))
+
+
+def next_link(response):
+    links = [link for link in response.get('Link', '').split(', ') if 'rel="next"' in link]
+    return links[0][1:links[0].index('>')].replace('http://testserver', '') if links else None
+
+
+@override_settings(ORDER_HISTORY_PAGE_SIZE=10)
+class OrderHistoryTests(PaymentTestCase):
+    def setUp(self):
+        super().setUp()
+        self.auth = {'HTTP_AUTHORIZATION': f'Bearer {AccessToken.for_user(self.user)}'}
+        for i in range(25):
+            order = Order.objects.create(user=self.user, total=i, status='completed')
+            OrderItem.objects.bulk_create([OrderItem(order=order, product_name='Shirt', quantity=1, unit_price=1)
+                                           for _ in range(3)])
+
+    def get(self, url='/api/orders/history/'):
+        return self.client.get(url, **self.auth)
+
+    def test_pages_cover_every_order_once(self):
+        seen = []
+        url = '/api/orders/history/'
+        while url:
+            r = self.get(url)
+            seen += [order['id'] for order in r.json()]
+            url = next_link(r)
+        self.assertEqual(len(seen), 25)
+        self.assertEqual(len(set(seen)), 25)
+
+    def test_first_page_is_prefetched_then_cached(self):
+        self.get()  # resolves and caches the user
+        history.invalidate(self.user.pk)
+        with self.assertNumQueries(2):
+            r = self.get()
+        self.assertEqual(len(r.json()), 10)
+        self.assertEqual(len(r.json()[0]['items']), 3)
+        self.assertIn('rel="next"', r['Link'])
+        with self.assertNumQueries(0):
+            cached = self.get()
+        self.assertEqual((cached.json(), cached['Link']), (r.json(), r['Link']))
+
+    def test_order_changes_invalidate_the_cached_page(self):
+        self.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            order = Order.objects.create(user=self.user, total=99, status='completed')
+        self.assertEqual(self.get().json()[0]['id'], order.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            order.status = 'cancelled'
+            order.save()
+        self.assertEqual(self.get().json()[0]['status'], 'cancelled')
+
+
+class MobileMoneyTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = CustomUser.objects.create_superuser(username='admin', password='p', email='admin@example.com')
+        self.user = CustomUser.objects.create_user(username='u', password='p', email='u@example.com')
+
+    def make_payments(self, count, prefix='MTN', amount=100):
+        orders = Order.objects.bulk_create([Order(user=self.user, total=amount, status='pending')
+                                            for _ in range(count)])
+        return MobileMoneyPayment.objects.bulk_create([
+            MobileMoneyPayment(user=self.user, order=order, cart_code='c', provider='mtn',
+                               phone_number=f'0803{i:07d}', transaction_id=f'{prefix}{i}', amount=amount)
+            for i, order in enumerate(orders)
+        ])
+
+
+class MobileMoneyBulkTests(MobileMoneyTestCase):
+    def admin_request(self):
+        request = RequestFactory().post('/')
+        request.user, request.session = self.admin, {}
+        request._messages = FallbackStorage(request)
+        return request
+
+    def test_queries_do_not_grow_with_the_selection(self):
+        counts = []
+        for prefix, count in (('A', 5), ('B', 40)):
+            ids = [payment.pk for payment in self.make_payments(count, prefix)]
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(mobile_money.verify_payments(ids, self.admin), count)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(MobileMoneyPayment.objects.filter(status='verified', verified_by=self.admin).count(), 45)
+        self.assertEqual(Order.objects.filter(status='completed').count(), 45)
+        self.assertEqual(PaymentAudit.objects.filter(action='verified').count(), 45)
+        self.assertEqual(mobile_money.verify_payments(ids, self.admin), 0)
+
+    @override_settings(MOBILE_MONEY_BULK_JOB_THRESHOLD=5)
+    def test_large_selections_run_as_a_job(self):
+        self.make_payments(10)
+        site._registry[MobileMoneyPayment].reject_payments(self.admin_request(), MobileMoneyPayment.objects.all())
+        self.assertFalse(MobileMoneyPayment.objects.filter(status='rejected').exists())
+        autodiscover_modules('tasks')
+        [job] = jobs.claim(1)
+        self.assertEqual(job.name, 'mobile_money.settle')
+        self.assertTrue(jobs.run(job))
+        self.assertEqual(MobileMoneyPayment.objects.filter(status='rejected').count(), 10)
+        self.assertEqual(Order.objects.filter(status='cancelled').count(), 10)
+
+    def test_single_payment_is_audited(self):
+        [payment] = self.make_payments(1)
+        payment.verify(self.admin)
+        self.assertEqual(payment.status, 'verified')
+        self.assertEqual(payment.audits.get().actor, self.admin)
+
+
+class StatementTests(MobileMoneyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.make_payments(20)
+        lines = ['Transaction ID,From,Amount,Status']
+        lines += [f'mtn{i},+234 803 {i:07d},"100.00",Successful' for i in range(15)]
+        lines += [
+            'MTN15,08030000000,100,Successful',  # phone differs
+            'MTN16,08030000016,90,Successful',  # amount differs
+            'MTN17,08030000017,100,Failed',  # not paid
+            'MTN5,08030000005,100,Successful',  # transaction id seen twice
+            'MTNX,0803,100,Successful',  # no such payment
+        ]
+        self.text = '\ufeff' + '\n'.join(lines) + '\n'
+
+    def test_exact_matches_are_verified(self):
+        result = match_statement(self.text.splitlines(True), 'mtn', self.admin, dry_run=True)
+        counts = [result[key] for key in ('rows', 'matched', 'ambiguous', 'unmatched', 'skipped', 'verified')]
+        self.assertEqual(counts, [20, 14, 3, 1, 1, 0])
+        self.assertFalse(MobileMoneyPayment.objects.filter(status='verified').exists())
+
+        result = match_statement(self.text.splitlines(True), 'mtn', self.admin)
+        self.assertEqual(result['verified'], 14)
+        self.assertEqual(MobileMoneyPayment.objects.get(transaction_id='MTN5').status, 'pending')
+        self.assertEqual(PaymentAudit.objects.count(), 14)
+
+    def test_admin_upload(self):
+        self.client.force_login(self.admin)
+        url = '/admin/core/mobilemoneypayment/upload-statement/'
+        self.assertContains(self.client.get('/admin/core/mobilemoneypayment/'), 'upload-statement')
+        self.assertEqual(self.client.get(url).status_code, 200)
+        r = self.client.post(url, {'provider': 'mtn', 'statement': SimpleUploadedFile('s.csv', self.text.encode())},
+                             follow=True)
+        self.assertIn('14 payment(s) verified', str(list(r.context['messages'])[0]))
+        r = self.client.post(url, {'provider': 'mtn', 'statement': SimpleUploadedFile('s.csv', b'a,b\n1,2\n')})
+        self.assertContains(r, 'Statement has no')
+
+    def test_command(self):
+        path = os.path.join(tempfile.mkdtemp(), 'statement.csv')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.text)
+        out = StringIO()
+        call_command('match_statements', path, '--provider', 'mtn', stdout=out)
+        self.assertIn('verified 14', out.getvalue())
+
+
+class RollupTests(PaymentTestCase):
+    def order(self, status, when, items):
+        total = sum(quantity * price for _, _, quantity, price in items)
+        t = Transaction.objects.create(user=self.user, transaction_id=f't{Transaction.objects.count()}', amount=total,
+                                       payment_method='paypal',
+                                       status='successful' if status == 'completed' else 'failed')
+        order = Order.objects.create(user=self.user, total=total, status=status)
+        Transaction.objects.filter(pk=t.pk).update(created_at=when)
+        Order.objects.filter(pk=order.pk).update(created_at=when)
+        for name, category, quantity, price in items:
+            OrderItem.objects.create(order=order, product_name=name, product_category=category, quantity=quantity,
+                                     unit_price=price)
+        return order
+
+    def test_refresh_is_incremental(self):
+        earlier = timezone.now() - timedelta(days=5)
+        self.order('completed', earlier, [('A', 'Electronics', 1, 10), ('B', None, 2, 10)])
+        self.order('completed', earlier, [('A', 'Electronics', 1, 10)])
+        self.order('cancelled', earlier, [('A', 'Electronics', 9, 11)])
+        self.assertIsNone(rollups.last_refreshed())
+        rollups.refresh()
+        self.assertIsNotNone(rollups.last_refreshed())
+        self.assertEqual(SalesRollup.objects.get(period='day').orders, 2)
+        self.assertEqual(ProductSalesRollup.objects.get(period='day', product_name='A').units, 2)
+        gateway_row = GatewayRollup.objects.get(period='day')
+        self.assertEqual((gateway_row.attempts, gateway_row.successful, gateway_row.failed), (3, 2, 1))
+
+        # a later order completed after it was placed lands in the next refresh; older buckets are left alone
+        order = self.order('pending', timezone.now(), [('C', 'Clothing', 1, 5)])
+        result = rollups.refresh()
+        self.assertGreater(result['since'], earlier)
+        Order.objects.filter(pk=order.pk).update(status='completed')
+        rollups.refresh()
+        self.assertEqual(SalesRollup.objects.filter(period='day').count(), 2)
+
+        figures = rollups.dashboard(30)
+        self.assertEqual(figures['totals']['orders'], 3)
+        self.assertEqual(figures['top_products'][0]['product_name'], 'A')
+        self.assertEqual({row['category'] for row in figures['categories']}, {'Electronics', '', 'Clothing'})
+
+        out = StringIO()
+        call_command('refresh_rollups', '--full', stdout=out)
+        self.assertIn('Rebuilt rollups', out.getvalue())
+        self.assertEqual(SalesRollup.objects.filter(period='day').count(), 2)
+
+    def test_dashboard_reads_only_the_rollups(self):
+        self.order('completed', timezone.now(), [('A', None, 1, 10)])
+        rollups.refresh()
+        self.client.force_login(CustomUser.objects.create_superuser(username='a', password='p', email='a@example.com'))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/admin/core/salesrollup/?days=7')
+        self.assertContains(response, 'Sales dashboard')
+        self.assertContains(response, 'Uncategorised')
+        self.assertFalse([q['sql'] for q in queries if 'core_order' in q['sql'] or 'core_transaction' in q['sql']])
+
+    def test_dashboard_needs_view_permission(self):
+        staff = CustomUser.objects.create_user(username='s', password='p', email='s@example.com', is_staff=True)
+        self.client.force_login(staff)
+        self.assertEqual(self.client.get('/admin/core/salesrollup/').status_code, 403)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'query plans are SQLite specific')
+class IndexTests(TestCase):
+    def assertUses(self, queryset, index):
+        plan = queryset.explain()
+        self.assertIn(f'USING INDEX {index}', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_hot_queries_use_their_indexes(self):
+        self.assertUses(Order.objects.filter(user_id=1).order_by('-created_at', '-id'), 'order_user_created_idx')
+        self.assertUses(Order.objects.order_by('-created_at', '-id')[:100], 'order_created_idx')
+        self.assertUses(Transaction.objects.filter(status='failed').order_by('-created_at', '-id'),
+                        'transaction_status_created_idx')
+        self.assertUses(MobileMoneyPayment.objects.filter(status='pending', provider='mtn').order_by('created_at'),
+                        'momo_pending_idx')
+
+
+class PayloadTests(PaymentTestCase):
+    def setUp(self):
+        super().setUp()
+        self.transaction = Transaction.objects.create(user=self.user, transaction_id='pl-1', amount=2,
+                                                      payment_method='flutterwave')
+
+    def test_latest_payload_is_kept_compressed(self):
+        self.assertIsNone(payloads.latest(self.transaction))
+        payloads.store(self.transaction, {'status': 'pending'})
+        data = {'status': 'successful', 'meta': 'x' * 5000}
+        stored = payloads.store(self.transaction, data)
+        self.assertEqual(payloads.latest(self.transaction), data)
+        self.assertLess(len(stored.data), stored.size)
+        with CaptureQueriesContext(connection) as queries:
+            list(Transaction.objects.all())
+        self.assertNotIn('gatewaypayload', queries[0]['sql'])
+
+    def test_admin_shows_the_payload(self):
+        payloads.store(self.transaction, {'id': 'flw-42'})
+        self.client.force_login(CustomUser.objects.create_superuser(username='a', password='p', email='a@example.com'))
+        self.assertContains(self.client.get(f'/admin/core/transaction/{self.transaction.pk}/change/'), 'flw-42')
+
+    def test_old_payloads_are_pruned(self):
+        for i in range(7):
+            payloads.store(self.transaction, {'n': i})
+        GatewayPayload.objects.filter(pk__in=GatewayPayload.objects.values('pk')[:5]).update(
+            created_at=timezone.now() - timedelta(days=400))
+        out = StringIO()
+        call_command('prune_payloads', batch_size=2, stdout=out)
+        self.assertIn('Deleted 5 payload(s)', out.getvalue())
+        self.assertEqual(GatewayPayload.objects.count(), 2)
+        self.assertTrue(Transaction.objects.filter(pk=self.transaction.pk).exists())
+
+
+class OutboxTests(MobileMoneyTestCase):
+    def test_changes_write_their_events(self):
+        [payment] = self.make_payments(1)
+        payment.verify(self.admin)
+        t = Transaction.objects.create(user=self.user, transaction_id='f1', amount=2, payment_method='flutterwave')
+        mark_failed(t.pk)
+        mark_failed(t.pk)
+        self.assertEqual(list(OutboxEvent.objects.order_by('id').values_list('topic', 'key')), [
+            ('payment.status', 'mobile_money:MTN0'),
+            ('order.status', f'order:{payment.order_id}'),
+            ('payment.status', 'transaction:f1'),
+        ])
+
+    def test_relay_delivers_in_order_to_every_sink(self):
+        for i in range(3):
+            outbox.emit(outbox.order_status(i, self.user.pk, 'completed'))
+        path = os.path.join(tempfile.mkdtemp(), 'outbox.jsonl')
+        sinks = [{'class': 'core.outbox.FileSink', 'options': {'path': path}},
+                 {'class': 'core.outbox.QueueSink', 'options': {'name': 'tests', 'maxsize': 10}}]
+        out = StringIO()
+        with override_settings(OUTBOX_SINKS=sinks):
+            call_command('relay_outbox', once=True, batch_size=2, stdout=out)
+        self.assertIn('Delivered 3 event(s)', out.getvalue())
+        with open(path, encoding='utf-8') as f:
+            self.assertEqual([json.loads(line)['id'] for line in f],
+                             list(OutboxEvent.objects.order_by('id').values_list('id', flat=True)))
+        self.assertEqual(outbox.get_queue('tests').qsize(), 3)
+        self.assertFalse(OutboxEvent.objects.filter(delivered_at__isnull=True).exists())
+
+    def test_failed_batch_stays_undelivered(self):
+        class Busy:
+            def send(self, messages):
+                raise outbox.Backpressure('busy', 0.01)
+
+        outbox.emit(outbox.order_status(1, self.user.pk, 'completed'))
+        with self.assertRaises(outbox.Backpressure):
+            outbox.relay_batch([Busy()])
+        event = OutboxEvent.objects.get()
+        self.assertIsNone(event.delivered_at)
+        self.assertEqual((event.attempts, event.last_error), (1, 'busy'))
+
+    def test_delivered_events_are_pruned(self):
+        outbox.emit(outbox.order_status(1, self.user.pk, 'completed'),
+                    outbox.order_status(2, self.user.pk, 'completed'))
+        OutboxEvent.objects.filter(pk=OutboxEvent.objects.order_by('id')[0].pk).update(
+            delivered_at=timezone.now() - timedelta(days=30))
+        self.assertEqual(outbox.prune(timedelta(days=7)), 1)
+        self.assertEqual(OutboxEvent.objects.count(), 1)
+
+
+class ArchiveTests(PaymentTestCase):
+    def setUp(self):
+        super().setUp()
+        self.auth = {'HTTP_AUTHORIZATION': f'Bearer {AccessToken.for_user(self.user)}'}
+        self.old = timezone.now() - timedelta(days=400)
+        for i in range(23):
+            t = Transaction.objects.create(user=self.user, transaction_id=f'a{i}', amount=i, payment_method='paypal',
+                                           status='successful', provider_reference=f'PAY-{i}')
+            order = Order.objects.create(user=self.user, total=i, status='completed', transaction=t)
+            OrderItem.objects.bulk_create([OrderItem(order=order, product_name='Shirt', quantity=1, unit_price=1)
+                                           for _ in range(2)])
+            PaymentLedger.objects.create(gateway='paypal', reference=f'PAY-{i}', transaction=t, order=order,
+                                         outcome='successful')
+            payloads.store(t, {'id': f'PAY-{i}', 'state': 'created'})
+            payloads.store(t, {'id': f'PAY-{i}', 'state': 'approved'})
+            if i < 17:
+                Order.objects.filter(pk=order.pk).update(created_at=self.old + timedelta(minutes=i))
+                Transaction.objects.filter(pk=t.pk).update(created_at=self.old)
+        orphan = Transaction.objects.create(user=self.user, transaction_id='orphan', amount=1, payment_method='paypal',
+                                            status='failed')
+        Transaction.objects.filter(pk=orphan.pk).update(created_at=self.old)
+
+    def history(self):
+        cache.clear()
+        seen = []
+        url = '/api/orders/history/'
+        while url:
+            r = self.client.get(url, **self.auth)
+            seen += r.json()
+            url = next_link(r)
+        return seen
+
+    def archive(self, **options):
+        out = StringIO()
+        call_command('archive_orders', stdout=out, **options)
+        return out.getvalue()
+
+    def test_history_reads_through_into_the_archive(self):
+        before = self.history()
+        self.assertIn('Archived 17 order(s) and 18 transaction(s)', self.archive(batch_size=5))
+        self.assertEqual((Order.objects.count(), ArchivedOrder.objects.count()), (6, 17))
+        self.assertEqual(OrderItem.objects.count(), 12)
+        after = self.history()
+        self.assertEqual(after, before)
+        self.assertEqual([o['id'] for o in after], sorted((o['id'] for o in after), reverse=True))
+        for page_size in (3, 6):
+            # a full live page with nothing after it links straight into the archive
+            with override_settings(ORDER_HISTORY_PAGE_SIZE=page_size):
+                self.assertEqual(self.history(), after)
+        self.assertIn('Archived 0 order(s)', self.archive())
+
+    def test_references_and_payloads_are_kept(self):
+        self.archive()
+        order = ArchivedOrder.objects.get(total=3)
+        self.assertEqual(order.payments, [{'gateway': 'paypal', 'reference': 'PAY-3'}])
+        self.assertIsNone(PaymentLedger.objects.get(reference='PAY-3').order_id)
+        transaction = ArchivedTransaction.objects.get(transaction_id='a3')
+        self.assertEqual(order.transaction_ref, transaction.id)
+        self.assertEqual(payloads.decode(transaction.payload)['state'], 'approved')
+        self.assertIsNone(ArchivedTransaction.objects.get(transaction_id='orphan').payload)
+        self.assertEqual(GatewayPayload.objects.count(), 12)
+        self.client.force_login(CustomUser.objects.create_superuser(username='a', password='p', email='a@example.com'))
+        self.assertContains(self.client.get(f'/admin/core/archivedtransaction/{transaction.pk}/change/'), 'approved')
+        self.assertContains(self.client.get(f'/admin/core/archivedorder/{order.pk}/change/'), 'PAY-3')
+
+    def test_mobile_money_references_are_kept(self):
+        order = Order.objects.create(user=self.user, total=5, status='completed')
+        MobileMoneyPayment.objects.create(user=self.user, order=order, cart_code='c', provider='mtn',
+                                          phone_number='08030000000', transaction_id='MTN1', amount=5)
+        Order.objects.filter(pk=order.pk).update(created_at=self.old)
+        self.archive()
+        self.assertEqual(ArchivedOrder.objects.get(pk=order.pk).payments,
+                         [{'provider': 'mtn', 'transaction_id': 'MTN1'}])
+
+    def test_export(self):
+        directory = tempfile.mkdtemp()
+        self.archive(export=directory)
+        self.assertEqual(sorted(os.listdir(directory)),
+                         [f'orders-{self.old:%Y-%m}.jsonl.gz', f'transactions-{self.old:%Y-%m}.jsonl.gz'])
+        with gzip.open(os.path.join(directory, f'transactions-{self.old:%Y-%m}.jsonl.gz'), 'rt') as f:
+            rows = {row['transaction_id']: row for row in map(json.loads, f)}
+        self.assertEqual(rows['a0']['payload']['state'], 'approved')
+        self.assertIsNone(rows['orphan']['payload'])
+
+    def test_dry_run(self):
+        self.assertIn('17 order(s) and 1 transaction(s)', self.archive(dry_run=True))
+        self.assertFalse(ArchivedOrder.objects.exists())
+
+
+class AuthTests(PaymentTestCase):
+    def setUp(self):
+        super().setUp()
+        authentication._local.clear()
+        self.addCleanup(authentication._local.clear)
+        self.auth = {'HTTP_AUTHORIZATION': f'Bearer {AccessToken.for_user(self.user)}'}
+
+    def user_selects(self, url='/api/user/profile/'):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url, **self.auth).status_code, 200)
+        return sum('core_customuser' in q['sql'] for q in queries)
+
+    def test_user_is_cached_in_process(self):
+        first = self.user_selects()
+        self.assertEqual(self.user_selects(), first - 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.first_name = 'Zed'
+            self.user.save()
+        self.assertEqual(authentication.cached_user(self.user.pk).first_name, 'Zed')
+
+    def test_local_cache_is_not_trusted_across_processes(self):
+        authentication.cached_user(self.user.pk)
+        self.assertIsNone(cache.get(f'auth-user-version:{self.user.pk}'))
+        authentication._local.clear()
+        with self.assertNumQueries(1):
+            authentication.cached_user(self.user.pk)
+
+    def test_shared_cache_is_used_and_versioned(self):
+        caches = {
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'users': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': tempfile.mkdtemp()},
+        }
+        with override_settings(CACHES=caches, AUTH_USER_CACHE='users'):
+            authentication.cached_user(self.user.pk)
+            authentication._local.clear()
+            with self.assertNumQueries(0):
+                authentication.cached_user(self.user.pk)
+            with self.captureOnCommitCallbacks(execute=True):
+                self.user.first_name = 'Zed'
+                self.user.save()
+            with self.assertNumQueries(1):
+                self.assertEqual(authentication.cached_user(self.user.pk).first_name, 'Zed')
+
+    def test_inactive_and_deleted_users_are_refused(self):
+        for url in ('/api/user/profile/', '/api/orders/history/'):
+            self.assertEqual(self.client.get(url, **self.auth).status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save()
+        for url in ('/api/user/profile/', '/api/orders/history/'):
+            self.assertEqual(self.client.get(url, **self.auth).status_code, 401)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = True
+            self.user.save()
+        self.assertEqual(self.client.get('/api/orders/history/', **self.auth).status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.delete()
+        for url in ('/api/user/profile/', '/api/orders/history/'):
+            self.assertEqual(self.client.get(url, **self.auth).status_code, 401)
+
+    @override_settings(AUTH_USER_LOCAL_TTL=0)
+    def test_deactivation_outside_save_is_seen_once_the_local_entry_expires(self):
+        self.assertEqual(self.client.get('/api/orders/history/', **self.auth).status_code, 200)
+        CustomUser.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertEqual(self.client.get('/api/orders/history/', **self.auth).status_code, 401)
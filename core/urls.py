@@ -1,7 +1,8 @@
 from django.urls import path
-from . import views
+from . import async_views, views
 from .registration_views import register_user
 from .mobile_money_views import verify_mobile_money_payment
+from .stream_views import event_stream
 
 urlpatterns = [
     path('api/register/', register_user, name='register'),
@@ -12,5 +13,10 @@ urlpatterns = [
     path('api/payments/flutterwave/callback/', views.flutterwave_callback, name='flutterwave_callback'),
     path('api/payments/paypal/initiate/', views.initiate_paypal_payment, name='paypal_initiate'),
     path('api/payments/paypal/execute/', views.execute_paypal_payment, name='paypal_execute'),
+    # Async twins of the Flutterwave verify/callback views, for the ASGI app
+    path('api/async/payments/flutterwave/verify/', async_views.flutterwave_verify, name='flutterwave_verify_async'),
+    path('api/async/payments/flutterwave/callback/', async_views.flutterwave_callback, name='flutterwave_callback_async'),
+    path('api/payments/gateway-metrics/', views.gateway_metrics, name='gateway_metrics'),
     path('api/payments/mobile-money/verify/', verify_mobile_money_payment, name='mobile_money_verify'),
+    path('api/events/', event_stream, name='event_stream'),
 ]
@@ -1,18 +1,30 @@
 from django.shortcuts import render, redirect
 from django.conf import settings
-from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.decorators import api_view, authentication_classes, permission_classes
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
 from decimal import Decimal
+import hmac
+import logging
 import uuid
-import requests
 import paypalrestsdk
 
 from cart_app.models import Cart, CartItem
-from .models import CustomUser, Transaction, Order, OrderItem
+from cart_app.pricing import price_cart
+from cart_app.store import get_cart_store
+from shopp_it import log
+from . import gateway, history, idempotency, jobs
+from .authentication import TokenUserAuthentication
+from .fulfilment import fulfil_transaction
+from .gateway import GatewayError, flutterwave
+from .models import ArchivedOrder, CustomUser, Transaction, Order
+from .payments import foreign_payment, mark_failed
+from .paypal_client import paypal
 from .Serializers import UserProfileSerializer, OrderSerializer, TransactionSerializer
 
+logger = logging.getLogger(__name__)
+
 
 # User Profile Endpoint
 @api_view(['GET', 'PUT'])
@@ -32,13 +44,27 @@ def user_profile(request):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-# Order History Endpoint
+# Order History Endpoint (newest first, ORDER_HISTORY_PAGE_SIZE per page; see core.history)
+# Only needs the user id, so request.user comes from the token claims alone
 @api_view(['GET'])
+@authentication_classes([TokenUserAuthentication])
 @permission_classes([IsAuthenticated])
 def order_history(request):
-    orders = Order.objects.filter(user=request.user)
-    serializer = OrderSerializer(orders, many=True)
-    return Response(serializer.data)
+    first_page = history.is_first_page(request)
+    if first_page:
+        version, cached = history.cached_first_page(request.user.id)
+        if cached is not None:
+            results, headers = cached
+            return Response(results, headers=headers)
+    
+    orders = Order.objects.filter(user_id=request.user.id).prefetch_related('items')
+    # Orders moved out by archive_orders are read through from the archive
+    archived = ArchivedOrder.objects.filter(user_id=request.user.id)
+    page, headers = history.paginate(request, orders, archived)
+    serializer = OrderSerializer(page, many=True)
+    if first_page:
+        history.cache_first_page(request.user.id, version, list(serializer.data), headers)
+    return Response(serializer.data, headers=headers)
 
 
 # Flutterwave Payment Initiation
@@ -50,9 +76,12 @@ def initiate_flutterwave_payment(request):
         if not cart_code:
             return Response({'error': 'Cart code is required'}, status=status.HTTP_400_BAD_REQUEST)
         
+        # Persist any cart changes still held in the cart store before pricing
+        get_cart_store().flush(cart_code)
+
         # Get cart
         try:
-            cart = Cart.objects.get(cart_code=cart_code)
+            cart = Cart.objects.for_code(cart_code).get(cart_code=cart_code)
         except Cart.DoesNotExist:
             return Response({'error': 'Cart not found'}, status=status.HTTP_404_NOT_FOUND)
         
@@ -61,10 +90,11 @@ def initiate_flutterwave_payment(request):
         if not cart_items.exists():
             return Response({'error': 'Cart is empty'}, status=status.HTTP_400_BAD_REQUEST)
         
-        total = sum(Decimal(item.product.price) * item.quantity for item in cart_items)
-        shipping = Decimal('5.00')
-        tax = total * Decimal('0.1')
-        grand_total = total + shipping + tax
+        coupon = request.data.get('coupon')
+        pricing = price_cart(cart, coupon)
+        if coupon and not pricing['coupon']:
+            return Response({'error': 'Invalid or expired coupon'}, status=status.HTTP_400_BAD_REQUEST)
+        grand_total = pricing['total']
         
         # Generate unique transaction ID
         tx_ref = str(uuid.uuid4())
@@ -99,43 +129,32 @@ def initiate_flutterwave_payment(request):
             }
         }
         
-        # Debug logging
-        print(f"🔍 Flutterwave Payment Initiation:")
-        print(f"   - Cart Code: {cart_code}")
-        print(f"   - Amount: ${grand_total}")
-        print(f"   - Redirect URL: {redirect_url}")
-        print(f"   - Transaction ID: {tx_ref}")
-        
-        headers = {
-            'Authorization': f'Bearer {settings.FLUTTERWAVE_SECRET_KEY}',
-            'Content-Type': 'application/json'
-        }
-        
-        # Make request to Flutterwave
-        response = requests.post(
-            'https://api.flutterwave.com/v3/payments',
-            json=payload,
-            headers=headers
-        )
+        log.bind(tx_ref=tx_ref)
+        logger.info('Flutterwave payment initiated', extra={
+            'cart_code': cart_code, 'amount': str(grand_total), 'redirect_url': redirect_url})
         
-        print(f"   - Flutterwave Response Status: {response.status_code}")
+        # Make request to Flutterwave (tx_ref is unique, so a retried POST cannot charge twice)
+        try:
+            response = flutterwave().post('/payments', endpoint='payments', json=payload, retry=True)
+        except GatewayError as e:
+            logger.warning('Flutterwave unreachable: %s', e)
+            return Response({'error': 'Payment gateway unavailable, please try again shortly'},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
         
         if response.status_code == 200:
             data = response.json()
-            print(f"   - Flutterwave Response Data: {data}")
             if data.get('status') == 'success':
                 payment_link = data.get('data', {}).get('link')
-                print(f"   - Payment Link: {payment_link}")
+                logger.info('Flutterwave payment link created', extra={'payment_link': payment_link})
                 return Response({'payment_link': payment_link})
             else:
                 error_msg = data.get('message', 'Payment initiation failed')
-                print(f"   ❌ Flutterwave Error: {error_msg}")
+                logger.warning('Flutterwave rejected the payment: %s', error_msg)
                 return Response({'error': error_msg}, status=status.HTTP_400_BAD_REQUEST)
         else:
             error_data = response.json() if response.text else {}
             error_msg = error_data.get('message', f'HTTP {response.status_code} error')
-            print(f"   ❌ Flutterwave HTTP Error: {error_msg}")
-            print(f"   ❌ Response: {error_data}")
+            logger.warning('Flutterwave HTTP error: %s', error_msg, extra={'response': error_data})
             return Response({'error': error_msg}, status=status.HTTP_400_BAD_REQUEST)
         
     except Exception as e:
@@ -157,6 +176,12 @@ def flutterwave_verify(request):
         if not all([status_param, tx_ref, transaction_id]):
             # Redirect to frontend with error
             return redirect(f"{settings.FRONTEND_BASE_URL}/payment/failed?error=missing_parameters")
+        log.bind(tx_ref=tx_ref)
+        
+        # A payment already finalised is answered from the ledger, without calling Flutterwave again
+        result = idempotency.finalised('flutterwave', transaction_id, tx_ref)
+        if result is not None:
+            return _flutterwave_redirect(result)
         
         # Get transaction
         try:
@@ -164,18 +189,17 @@ def flutterwave_verify(request):
         except Transaction.DoesNotExist:
             return redirect(f"{settings.FRONTEND_BASE_URL}/payment/failed?error=transaction_not_found")
         
-        # Verify payment with Flutterwave
-        headers = {
-            'Authorization': f'Bearer {settings.FLUTTERWAVE_SECRET_KEY}',
-        }
-        
-        verify_response = requests.get(
-            f'https://api.flutterwave.com/v3/transactions/{transaction_id}/verify',
-            headers=headers
-        )
+        # Verify payment with Flutterwave (a gateway outage leaves the transaction pending)
+        try:
+            verify_response = flutterwave().get(f'/transactions/{transaction_id}/verify', endpoint='transactions.verify')
+        except GatewayError as e:
+            logger.warning('Flutterwave unreachable: %s', e)
+            return redirect(f"{settings.FRONTEND_BASE_URL}/payment/failed?error=gateway_unavailable")
         
         if verify_response.status_code == 200:
             verify_data = verify_response.json()
+            if foreign_payment(verify_data, tx_ref):
+                return redirect(f"{settings.FRONTEND_BASE_URL}/payment/failed?error=verification_failed")
             
             if verify_data.get('status') == 'success':
                 data = verify_data.get('data', {})
@@ -185,72 +209,105 @@ def flutterwave_verify(request):
                     Decimal(str(data.get('amount'))) == transaction.amount and
                     data.get('currency') == transaction.currency):
                     
-                    # Update transaction
-                    transaction.status = 'successful'
-                    transaction.response_data = verify_data
-                    transaction.save()
-                    
-                    # Create order
-                    cart = transaction.cart
-                    order = Order.objects.create(
-                        user=transaction.user,
-                        transaction=transaction,
-                        total=transaction.amount,
-                        status='completed'
-                    )
-                    
-                    # Create order items
-                    for item in cart.items.all():
-                        OrderItem.objects.create(
-                            order=order,
-                            product_name=item.product.name,
-                            product_image=item.product.image.url if item.product.image else '',
-                            quantity=item.quantity,
-                            unit_price=item.product.price
-                        )
-                    
-                    # Mark cart as paid
-                    cart.paid = True
-                    cart.save()
+                    # Mark the transaction paid, create the order and mark the cart paid in one go
+                    order = fulfil_transaction(transaction, verify_data)
+                    result = idempotency.record('flutterwave', transaction_id, 'successful', transaction, order)
+                    logger.info('Payment verified', extra={'order_id': order.id})
                     
                     # Redirect to frontend success page
-                    return redirect(f"{settings.FRONTEND_BASE_URL}/payment/success?order_id={order.id}")
+                    return _flutterwave_redirect(result)
+                
+                if data.get('status') == 'failed':
+                    mark_failed(transaction.pk)
+                    return _flutterwave_redirect(idempotency.record('flutterwave', transaction_id, 'failed', transaction))
         
-        transaction.status = 'failed'
-        transaction.save()
+        logger.warning('Payment verification failed')
+        mark_failed(transaction.pk)
         return redirect(f"{settings.FRONTEND_BASE_URL}/payment/failed?error=verification_failed")
         
-    except Exception as e:
-        return redirect(f"{settings.FRONTEND_BASE_URL}/payment/failed?error={str(e)}")
+    except Exception:
+        logger.exception('Flutterwave verification error')
+        return redirect(f"{settings.FRONTEND_BASE_URL}/payment/failed?error=server_error")
+
+
+def _flutterwave_redirect(result):
+    """Send the customer to the frontend page for a finalised payment"""
+    if result['outcome'] == 'successful':
+        return redirect(f"{settings.FRONTEND_BASE_URL}/payment/success?order_id={result['order_id']}")
+    return redirect(f"{settings.FRONTEND_BASE_URL}/payment/failed?error=verification_failed")
+
+
+def _flutterwave_result_response(result, transaction_id):
+    """The callback's answer for a finalised payment"""
+    if result['outcome'] != 'successful':
+        return Response({'success': False, 'message': 'Payment verification failed'})
+    return Response({
+        'success': True,
+        'message': 'Payment verified successfully',
+        'order': {
+            'id': result['order_id'],
+            'total': result['total'],
+            'transaction_id': transaction_id,
+            'created_at': result['created_at']
+        }
+    })
+
+
+def _queue_flutterwave_webhook(request, verif_hash):
+    """Acknowledge a signed Flutterwave webhook at once and verify it in a background job"""
+    expected = settings.FLUTTERWAVE_WEBHOOK_HASH
+    # With no secret configured no webhook can be authenticated, so none is accepted
+    if not expected or not hmac.compare_digest(verif_hash, expected):
+        return Response({'success': False, 'message': 'Invalid signature'}, status=status.HTTP_401_UNAUTHORIZED)
+
+    data = request.data.get('data') or request.data
+    tx_ref = data.get('tx_ref')
+    transaction_id = data.get('id') or data.get('transaction_id')
+    if not tx_ref or not transaction_id:
+        return Response({'success': False, 'message': 'Missing parameters'}, status=status.HTTP_400_BAD_REQUEST)
+    if idempotency.finalised('flutterwave', transaction_id, tx_ref) is not None:
+        return Response({'success': True, 'queued': False})
+
+    jobs.enqueue('flutterwave.verify_payment', {'tx_ref': tx_ref, 'transaction_id': str(transaction_id)},
+                 dedupe_key=f'flutterwave:{tx_ref}:{transaction_id}')
+    return Response({'success': True, 'queued': True})
 
 
 # Flutterwave Payment Callback (webhook - for backend notifications)
 @api_view(['POST'])
 def flutterwave_callback(request):
+    # Webhooks from Flutterwave itself carry verif-hash; the frontend's call waits for the order
+    verif_hash = request.headers.get('verif-hash')
+    if verif_hash is not None:
+        return _queue_flutterwave_webhook(request, verif_hash)
+
     try:
         status_param = request.data.get('status')
         tx_ref = request.data.get('tx_ref')
         transaction_id = request.data.get('transaction_id')
         
-        # Debug logging
-        print(f"🔍 Flutterwave Callback Received:")
-        print(f"   - Status: {status_param}")
-        print(f"   - TX Ref: {tx_ref}")
-        print(f"   - Transaction ID: {transaction_id}")
+        log.bind(tx_ref=tx_ref)
+        logger.info('Flutterwave callback received', extra={
+            'status': status_param, 'gateway_transaction_id': transaction_id})
         
         if not all([status_param, tx_ref, transaction_id]):
-            print(f"   ❌ Missing parameters!")
+            logger.warning('Flutterwave callback is missing parameters')
             return Response({'success': False, 'message': 'Missing parameters'}, 
                           status=status.HTTP_400_BAD_REQUEST)
         
+        # A payment already finalised is answered from the ledger, without calling Flutterwave again
+        result = idempotency.finalised('flutterwave', transaction_id, tx_ref)
+        if result is not None:
+            return _flutterwave_result_response(result, transaction_id)
+        
         # Extract cart_code from tx_ref (format: cartcode-timestamp)
         cart_code = tx_ref.split('-')[0] if '-' in tx_ref else tx_ref
         
         # Get cart
         try:
-            cart = Cart.objects.get(cart_code=cart_code)
+            cart = Cart.objects.for_code(cart_code).get(cart_code=cart_code)
         except Cart.DoesNotExist:
-            print(f"   ❌ Cart not found: {cart_code}")
+            logger.warning('Cart not found: %s', cart_code)
             return Response({'success': False, 'message': 'Cart not found'}, 
                           status=status.HTTP_404_NOT_FOUND)
         
@@ -267,20 +324,19 @@ def flutterwave_callback(request):
             }
         )
         
-        # Verify payment with Flutterwave
-        headers = {
-            'Authorization': f'Bearer {settings.FLUTTERWAVE_SECRET_KEY}',
-        }
-        
-        verify_response = requests.get(
-            f'https://api.flutterwave.com/v3/transactions/{transaction_id}/verify',
-            headers=headers
-        )
-        
-        print(f"   - Flutterwave Verify Status: {verify_response.status_code}")
+        # Verify payment with Flutterwave; a 503 makes Flutterwave retry the webhook later
+        try:
+            verify_response = flutterwave().get(f'/transactions/{transaction_id}/verify', endpoint='transactions.verify')
+        except GatewayError as e:
+            logger.warning('Flutterwave unreachable: %s', e)
+            return Response({'success': False, 'message': 'Payment gateway unavailable'},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
         
         if verify_response.status_code == 200:
             verify_data = verify_response.json()
+            if foreign_payment(verify_data, tx_ref):
+                # Answered with 200 so Flutterwave does not keep retrying it
+                return Response({'success': False, 'message': 'Payment verification failed'})
             
             if verify_data.get('status') == 'success':
                 data = verify_data.get('data', {})
@@ -290,63 +346,40 @@ def flutterwave_callback(request):
                 if transaction.amount == Decimal('0'):
                     transaction.amount = flutterwave_amount
                     transaction.currency = data.get('currency', 'USD')
-                    print(f"   - Updated transaction amount: {transaction.amount} {transaction.currency}")
+                    logger.info('Transaction amount set from Flutterwave: %s %s', transaction.amount, transaction.currency)
                 
                 # Check if payment was successful (removed amount check for SDK payments)
                 if data.get('status') == 'successful':
                     
-                    # Update transaction
-                    transaction.status = 'successful'
-                    transaction.response_data = verify_data
-                    transaction.save()
+                    # Mark the transaction paid, create the order and mark the cart paid in one go
+                    order = fulfil_transaction(transaction, verify_data)
+                    result = idempotency.record('flutterwave', transaction_id, 'successful', transaction, order)
                     
-                    # Create order
-                    cart = transaction.cart
-                    order = Order.objects.create(
-                        user=transaction.user,
-                        transaction=transaction,
-                        total=transaction.amount,
-                        status='completed'
-                    )
+                    logger.info('Payment verified', extra={'order_id': order.id})
                     
-                    # Create order items
-                    for item in cart.items.all():
-                        OrderItem.objects.create(
-                            order=order,
-                            product_name=item.product.name,
-                            product_image=item.product.image.url if item.product.image else '',
-                            quantity=item.quantity,
-                            unit_price=item.product.price
-                        )
-                    
-                    # Mark cart as paid
-                    cart.paid = True
-                    cart.save()
-                    
-                    print(f"   ✅ Payment verified successfully! Order ID: {order.id}")
-                    
-                    return Response({
-                        'success': True,
-                        'message': 'Payment verified successfully',
-                        'order': {
-                            'id': order.id,
-                            'total': str(transaction.amount),
-                            'transaction_id': transaction_id,
-                            'created_at': order.created_at.isoformat()
-                        }
-                    })
+                    return _flutterwave_result_response(result, transaction_id)
                 else:
-                    print(f"   ❌ Payment status not successful: {data.get('status')}")
-        
-        print(f"   ❌ Payment verification failed")
-        transaction.status = 'failed'
-        transaction.save()
+                    logger.info('Payment status not successful: %s', data.get('status'))
+                    if data.get('status') == 'failed':
+                        mark_failed(transaction.pk)
+                        result = idempotency.record('flutterwave', transaction_id, 'failed', transaction)
+                        return _flutterwave_result_response(result, transaction_id)
+        
+        logger.warning('Payment verification failed')
+        mark_failed(transaction.pk)
         return Response({'success': False, 'message': 'Payment verification failed'})
         
-    except Exception as e:
-        print(f"   ❌ Callback error: {str(e)}")
-        return Response({'success': False, 'message': str(e)}, 
-                      status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    except Exception:
+        logger.exception('Flutterwave callback error')
+        return Response({'success': False, 'message': 'Payment verification error'},
+                        status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+# Gateway client metrics (latency/errors per endpoint, for this process)
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def gateway_metrics(request):
+    return Response(gateway.metrics())
 
 
 # PayPal Payment Initiation
@@ -354,20 +387,16 @@ def flutterwave_callback(request):
 @permission_classes([IsAuthenticated])
 def initiate_paypal_payment(request):
     try:
-        # Configure PayPal SDK
-        paypalrestsdk.configure({
-            'mode': settings.PAYPAL_MODE,
-            'client_id': settings.PAYPAL_CLIENT_ID,
-            'client_secret': settings.PAYPAL_CLIENT_SECRET
-        })
-        
         cart_code = request.data.get('cart_code')
         if not cart_code:
             return Response({'error': 'Cart code is required'}, status=status.HTTP_400_BAD_REQUEST)
         
+        # Persist any cart changes still held in the cart store before pricing
+        get_cart_store().flush(cart_code)
+
         # Get cart
         try:
-            cart = Cart.objects.get(cart_code=cart_code)
+            cart = Cart.objects.for_code(cart_code).get(cart_code=cart_code)
         except Cart.DoesNotExist:
             return Response({'error': 'Cart not found'}, status=status.HTTP_404_NOT_FOUND)
         
@@ -376,10 +405,11 @@ def initiate_paypal_payment(request):
         if not cart_items.exists():
             return Response({'error': 'Cart is empty'}, status=status.HTTP_400_BAD_REQUEST)
         
-        total = sum(Decimal(item.product.price) * item.quantity for item in cart_items)
-        shipping = Decimal('5.00')
-        tax = total * Decimal('0.1')
-        grand_total = total + shipping + tax
+        coupon = request.data.get('coupon')
+        pricing = price_cart(cart, coupon)
+        if coupon and not pricing['coupon']:
+            return Response({'error': 'Invalid or expired coupon'}, status=status.HTTP_400_BAD_REQUEST)
+        grand_total = pricing['total']
         
         # Generate unique transaction ID
         tx_ref = str(uuid.uuid4())
@@ -421,11 +451,11 @@ def initiate_paypal_payment(request):
                 },
                 'description': f'Payment for cart {cart_code}'
             }]
-        })
+        }, api=paypal())
         
         if payment.create():
             # Store payment ID in transaction
-            transaction.response_data = {'paypal_payment_id': payment.id}
+            transaction.provider_reference = payment.id
             transaction.save()
             
             # Get approval URL
@@ -440,17 +470,20 @@ def initiate_paypal_payment(request):
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+def _paypal_result_response(result):
+    """The answer for an executed (or refused) PayPal payment"""
+    if result['outcome'] != 'successful':
+        return Response({'success': False, 'message': 'Payment execution failed'})
+    return Response({
+        'success': True,
+        'message': 'Payment completed successfully'
+    })
+
+
 # PayPal Payment Execution
 @api_view(['POST'])
 def execute_paypal_payment(request):
     try:
-        # Configure PayPal SDK
-        paypalrestsdk.configure({
-            'mode': settings.PAYPAL_MODE,
-            'client_id': settings.PAYPAL_CLIENT_ID,
-            'client_secret': settings.PAYPAL_CLIENT_SECRET
-        })
-        
         payment_id = request.data.get('paymentId')
         payer_id = request.data.get('PayerID')
         
@@ -458,55 +491,27 @@ def execute_paypal_payment(request):
             return Response({'success': False, 'message': 'Missing parameters'}, 
                           status=status.HTTP_400_BAD_REQUEST)
         
+        # A payment already finalised is answered from the ledger, without calling PayPal again
+        result = idempotency.finalised('paypal', payment_id)
+        if result is not None:
+            return _paypal_result_response(result)
+        
         # Find transaction
         try:
-            transaction = Transaction.objects.get(
-                response_data__paypal_payment_id=payment_id,
-                payment_method='paypal'
-            )
+            transaction = Transaction.objects.get(payment_method='paypal', provider_reference=payment_id)
         except Transaction.DoesNotExist:
             return Response({'success': False, 'message': 'Transaction not found'}, 
                           status=status.HTTP_404_NOT_FOUND)
         
         # Execute payment
-        payment = paypalrestsdk.Payment.find(payment_id)
+        payment = paypalrestsdk.Payment.find(payment_id, api=paypal())
         
         if payment.execute({'payer_id': payer_id}):
-            # Update transaction
-            transaction.status = 'successful'
-            transaction.response_data['execution'] = payment.to_dict()
-            transaction.save()
-            
-            # Create order
-            cart = transaction.cart
-            order = Order.objects.create(
-                user=transaction.user,
-                transaction=transaction,
-                total=transaction.amount,
-                status='completed'
-            )
-            
-            # Create order items
-            for item in cart.items.all():
-                OrderItem.objects.create(
-                    order=order,
-                    product_name=item.product.name,
-                    product_image=item.product.image.url if item.product.image else '',
-                    quantity=item.quantity,
-                    unit_price=item.product.price
-                )
-            
-            # Mark cart as paid
-            cart.paid = True
-            cart.save()
-            
-            return Response({
-                'success': True,
-                'message': 'Payment completed successfully'
-            })
+            # Keep the executed payment, create the order and mark the cart paid in one go
+            order = fulfil_transaction(transaction, payment.to_dict())
+            return _paypal_result_response(idempotency.record('paypal', payment_id, 'successful', transaction, order))
         else:
-            transaction.status = 'failed'
-            transaction.save()
+            mark_failed(transaction.pk)
             return Response({'success': False, 'message': 'Payment execution failed'})
         
     except Exception as e:
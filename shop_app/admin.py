@@ -1,5 +1,13 @@
 from django.contrib import admin
-from .models import Product
+from .models import Product, Promotion
 # Register your models here.
 
 admin.site.register(Product)
+
+
+@admin.register(Promotion)
+class PromotionAdmin(admin.ModelAdmin):
+    list_display = ['name', 'code', 'kind', 'value', 'product', 'category', 'active', 'starts_at', 'ends_at']
+    list_filter = ['active', 'kind', 'category']
+    search_fields = ['name', 'code']
+    list_select_related = ['product']
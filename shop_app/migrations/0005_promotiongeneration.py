@@ -0,0 +1,20 @@
+# Generated by Django 4.2 on 2026-10-19 16:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_app', '0004_promotion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PromotionGeneration',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+    ]
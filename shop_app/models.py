@@ -29,3 +29,45 @@ class Product(models.Model):
         self.slug = unique_slug
 
         super().save(*args, **kwargs)
+
+
+class Promotion(models.Model):
+    """
+    A discount rule. Scope it to a product, a category, or neither (whole cart).
+    Rules with a code are coupons and only apply when the code is supplied.
+    """
+    KIND = (
+        ('percent', 'Percentage off'),
+        ('fixed', 'Fixed amount off'),
+    )
+    name = models.CharField(max_length=100)
+    code = models.CharField(max_length=30, unique=True, blank=True, null=True,
+                            help_text='Coupon code; leave empty for an automatic sale')
+    kind = models.CharField(max_length=10, choices=KIND, default='percent')
+    value = models.DecimalField(max_digits=10, decimal_places=2)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, blank=True, null=True, related_name='promotions')
+    category = models.CharField(max_length=15, choices=Product.CATEGORY, blank=True, null=True)
+    active = models.BooleanField(default=True)
+    starts_at = models.DateTimeField(blank=True, null=True)
+    ends_at = models.DateTimeField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.name
+
+    def save(self, *args, **kwargs):
+        # Coupon codes are matched case-insensitively
+        self.code = self.code.strip().upper() if self.code else None
+        super().save(*args, **kwargs)
+
+
+class PromotionGeneration(models.Model):
+    """
+    A counter bumped in the same transaction as every promotion change, so
+    each process can tell its promotions index is out of date (see
+    shop_app.promotions). Holds a single row.
+    """
+    value = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"generation {self.value}"
@@ -0,0 +1,186 @@
+"""
+In-memory index of live promotions.
+
+Active rules are compiled once into dictionaries keyed by product id and
+category (plus a small cart-wide map and a coupon map), so pricing a cart
+costs a couple of dict lookups per item however many promotions are live.
+
+Saving or deleting a Promotion bumps PromotionGeneration in the same
+transaction. Once it commits, this process patches a copy of its index and
+swaps it in, so requests iterating the old one are never disturbed. Other
+processes compare the stored generation with their own at most every
+PROMOTIONS_CHECK_INTERVAL seconds and rebuild when it moved.
+"""
+import threading
+import time
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Promotion, PromotionGeneration
+
+
+class Rule:
+    """A compiled promotion"""
+    __slots__ = ('id', 'kind', 'value', 'product_id', 'category', 'code', 'starts_at', 'ends_at')
+
+    def __init__(self, promotion):
+        self.id = promotion.id
+        self.kind = promotion.kind
+        self.value = promotion.value
+        self.product_id = promotion.product_id
+        self.category = promotion.category
+        self.code = promotion.code
+        self.starts_at = promotion.starts_at
+        self.ends_at = promotion.ends_at
+
+    def is_live(self, now):
+        return (self.starts_at is None or self.starts_at <= now) and (self.ends_at is None or now < self.ends_at)
+
+    def applies_to(self, product_id, category):
+        if self.product_id is not None:
+            return self.product_id == product_id
+        if self.category:
+            return self.category == category
+        return True
+
+    def discount(self, amount):
+        if self.kind == 'percent':
+            off = amount * self.value / Decimal('100')
+        else:
+            off = self.value
+        return min(max(off, Decimal('0')), amount)
+
+
+class PromotionIndex:
+    def __init__(self):
+        self.by_product = {}
+        self.by_category = {}
+        self.cart_wide = {}
+        self.coupons = {}
+        self.rules = {}
+
+    def copy(self):
+        """A copy that can be patched while readers keep using this one"""
+        index = PromotionIndex()
+        index.by_product = {key: dict(rules) for key, rules in self.by_product.items()}
+        index.by_category = {key: dict(rules) for key, rules in self.by_category.items()}
+        index.cart_wide = dict(self.cart_wide)
+        index.coupons = dict(self.coupons)
+        index.rules = dict(self.rules)
+        return index
+
+    @classmethod
+    def build(cls):
+        index = cls()
+        now = timezone.now()
+        for promotion in Promotion.objects.filter(Q(ends_at__isnull=True) | Q(ends_at__gt=now), active=True):
+            index.add(promotion)
+        return index
+
+    def _bucket(self, rule):
+        if rule.product_id is not None:
+            return self.by_product.setdefault(rule.product_id, {})
+        if rule.category:
+            return self.by_category.setdefault(rule.category, {})
+        return self.cart_wide
+
+    def add(self, promotion):
+        self.remove(promotion.id)
+        if not promotion.active:
+            return
+        rule = Rule(promotion)
+        self.rules[rule.id] = rule
+        if rule.code:
+            self.coupons[rule.code] = rule
+        else:
+            self._bucket(rule)[rule.id] = rule
+
+    def remove(self, promotion_id):
+        rule = self.rules.pop(promotion_id, None)
+        if rule is None:
+            return
+        if rule.code:
+            self.coupons.pop(rule.code, None)
+        else:
+            self._bucket(rule).pop(rule.id, None)
+
+    def coupon(self, code, now=None):
+        """The live coupon rule for code, or None"""
+        rule = self.coupons.get(code.strip().upper()) if code else None
+        if rule is not None and rule.is_live(now or timezone.now()):
+            return rule
+        return None
+
+    def line_rules(self, product_id, category):
+        """Automatic rules that target a product or its category"""
+        rules = list(self.by_product.get(product_id, {}).values())
+        if category:
+            rules.extend(self.by_category.get(category, {}).values())
+        return rules
+
+
+_index = None
+_generation = None
+_checked_at = None
+_lock = threading.Lock()
+
+
+def _current_generation():
+    return PromotionGeneration.objects.filter(pk=1).values_list('value', flat=True).first() or 0
+
+
+def get_index():
+    """The process-wide index, rebuilt when another process changed the rules"""
+    global _index, _generation, _checked_at
+    now = time.monotonic()
+    if _index is not None and now - _checked_at < settings.PROMOTIONS_CHECK_INTERVAL:
+        return _index
+    generation = _current_generation()
+    with _lock:
+        if _index is None or generation != _generation:
+            _index = PromotionIndex.build()
+            _generation = generation
+        _checked_at = now
+    return _index
+
+
+def _bump_generation():
+    """Bump the stored generation inside the current transaction and return the new value"""
+    generations = PromotionGeneration.objects.filter(pk=1)
+    if not generations.update(value=F('value') + 1):
+        PromotionGeneration.objects.get_or_create(pk=1)
+        generations.update(value=F('value') + 1)
+    return generations.values_list('value', flat=True).get()
+
+
+def _patch_index(generation, promotion=None, removed_id=None):
+    global _index, _generation
+    with _lock:
+        # Only when nobody else changed the rules meanwhile; otherwise the next check rebuilds
+        if _index is not None and _generation == generation - 1:
+            index = _index.copy()
+            if promotion is not None:
+                index.add(promotion)
+            else:
+                index.remove(removed_id)
+            _index = index
+            _generation = generation
+
+
+@receiver(post_save, sender=Promotion)
+def update_index(sender, instance, **kwargs):
+    generation = _bump_generation()
+    transaction.on_commit(lambda: _patch_index(generation, promotion=instance))
+
+
+@receiver(post_delete, sender=Promotion)
+def remove_from_index(sender, instance, **kwargs):
+    removed_id = instance.id
+    generation = _bump_generation()
+    transaction.on_commit(lambda: _patch_index(generation, removed_id=removed_id))
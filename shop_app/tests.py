@@ -1,3 +1,52 @@
-from django.test import TestCase
+from decimal import Decimal
 
-# Create your tests here.
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from . import promotions
+from .models import Product, Promotion, PromotionGeneration
+
+
+@override_settings(PROMOTIONS_CHECK_INTERVAL=0)
+class PromotionTests(TestCase):
+    databases = '__all__'  # the carts priced here may live on any shard
+
+    def setUp(self):
+        cache.clear()
+        promotions._index = None
+        self.shirt = Product.objects.create(name='Shirt', price=10, image='products/a.jpg', category='Clothing')
+        self.rice = Product.objects.create(name='Rice', price=20, image='products/b.jpg', category='Groceries')
+        self.client.post('/api/add_item/', {'cart_code': 'abc', 'product_id': self.shirt.id, 'quantity': 2})
+        self.client.post('/api/add_item/', {'cart_code': 'abc', 'product_id': self.rice.id})
+
+    def test_cart_pricing(self):
+        self.assertEqual(Decimal(self.client.get('/api/cart/?cart_code=abc').json()['grand_total']), Decimal('49.00'))
+        with self.captureOnCommitCallbacks(execute=True):
+            Promotion.objects.create(name='sale', kind='percent', value=10, category='Clothing')
+            Promotion.objects.create(name='rice', kind='fixed', value=5, product=self.rice)
+            Promotion.objects.create(name='half', kind='percent', value=50, code='half')
+        self.assertEqual(Decimal(self.client.get('/api/cart/?cart_code=abc').json()['discount']), Decimal('7.00'))
+        r = self.client.get('/api/cart/?cart_code=abc&coupon=HALF')
+        self.assertEqual(Decimal(r.json()['discount']), Decimal('23.50'))
+
+    def test_changes_bump_the_stored_generation(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            promotion = Promotion.objects.create(name='sale', kind='percent', value=10, category='Clothing')
+        with self.captureOnCommitCallbacks(execute=True):
+            promotion.delete()
+        self.assertEqual(PromotionGeneration.objects.get().value, 2)
+
+    def test_other_processes_rebuild(self):
+        promotions.get_index()
+        # Written by another process: its on_commit patch never reaches this one
+        with self.captureOnCommitCallbacks(execute=False):
+            Promotion.objects.create(name='sale', kind='percent', value=10, category='Clothing')
+        self.assertEqual(len(promotions.get_index().rules), 1)
+
+    def test_patches_swap_in_a_copy(self):
+        index = promotions.get_index()
+        with self.captureOnCommitCallbacks(execute=True):
+            Promotion.objects.create(name='sale', kind='percent', value=10, category='Clothing')
+        self.assertEqual(index.rules, {})
+        self.assertIsNot(promotions.get_index(), index)
+        self.assertEqual(len(promotions.get_index().rules), 1)
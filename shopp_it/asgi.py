@@ -3,14 +3,72 @@ ASGI config for shopp_it project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Run it with an ASGI worker to serve the long-lived event streams
+(``/api/events/``) alongside the regular API, e.g.::
+
+    gunicorn shopp_it.asgi:application -k uvicorn.workers.UvicornWorker
+
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
 
+import asyncio
 import os
 
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'shopp_it.settings')
 
-application = get_asgi_application()
+STREAM_PATHS = ('/api/events/',)
+
+
+class CancelOnDisconnect:
+    """
+    End long-lived event streams when the client goes away.
+
+    Django 4.2 never reads ``http.disconnect`` once the request body is in,
+    so a stream whose client closed the tab would loop on its heartbeat
+    forever, keeping its broker subscription. For STREAM_PATHS this waits
+    for the disconnect alongside the handler and cancels it; the stream's
+    ``finally`` then unsubscribes.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].startswith(STREAM_PATHS):
+            return await self.app(scope, receive, send)
+
+        body_read = asyncio.Event()
+
+        async def app_receive():
+            message = await receive()
+            if message['type'] != 'http.request' or not message.get('more_body', False):
+                body_read.set()
+            return message
+
+        async def wait_for_disconnect():
+            # Only read once the handler has the whole body, so no request message is stolen from it
+            await body_read.wait()
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        handler = asyncio.ensure_future(self.app(scope, app_receive, send))
+        disconnect = asyncio.ensure_future(wait_for_disconnect())
+        try:
+            await asyncio.wait([handler, disconnect], return_when=asyncio.FIRST_COMPLETED)
+            if not handler.done():
+                handler.cancel()
+                try:
+                    await handler
+                except asyncio.CancelledError:
+                    pass
+            else:
+                handler.result()
+        finally:
+            disconnect.cancel()
+            handler.cancel()
+
+
+application = CancelOnDisconnect(get_asgi_application())
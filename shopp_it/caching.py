@@ -0,0 +1,19 @@
+"""
+Telling process-local caches from shared ones.
+
+State that every worker must agree on (cart snapshots, cached users) only
+works in a cache all processes share, such as Redis or Memcached. The
+local-memory and dummy backends give each process its own copy, so code
+that depends on sharing checks ``is_shared()`` first.
+"""
+from django.conf import settings
+
+LOCAL_BACKENDS = frozenset({
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+})
+
+
+def is_shared(alias):
+    """Whether the cache called alias is seen by every process"""
+    return settings.CACHES[alias]['BACKEND'] not in LOCAL_BACKENDS
@@ -0,0 +1,108 @@
+"""
+Lightweight pub/sub used to push cart and payment updates to clients.
+
+Publishers (cart store, payment signals) call ``publish(channel, event)``
+from any thread; the server-sent events view subscribes from the ASGI event
+loop. Channels are plain strings such as ``cart:<cart_code>`` or
+``user:<id>``.
+
+The default ``InProcessBroker`` fans events out inside one process, which is
+enough when the ASGI worker also serves the cart and payment endpoints.
+Events published anywhere else never reach a stream: not from other web
+workers, and not from ``run_jobs``, ``reconcile_payments`` or other
+management commands, so payment statuses settled by a background job are
+not pushed. Clients must therefore still poll (``/api/cart/?version_only=1``
+is cheap) when a stream goes quiet or reconnects. To fan out across
+processes, point ``EVENT_BROKER`` at a broker class with the same
+``publish``/``subscribe`` interface (for example one backed by Redis
+pub/sub).
+"""
+import asyncio
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class Subscription:
+    """An async iterator of events for one client connection"""
+
+    def __init__(self, broker, channels, maxsize):
+        self.broker = broker
+        self.channels = tuple(channels)
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=maxsize)
+
+    def deliver(self, event):
+        # May be called from any thread
+        self.loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event):
+        if self.queue.full():
+            # Slow consumer: drop the oldest event rather than block publishers
+            self.queue.get_nowait()
+        self.queue.put_nowait(event)
+
+    async def get(self, timeout=None):
+        """Next event, or None if nothing arrived within timeout seconds"""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class InProcessBroker:
+    """Fan events out to subscribers living in this process"""
+
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, channels):
+        """Must be called from a running event loop"""
+        subscription = Subscription(self, channels, self.queue_size)
+        with self._lock:
+            for channel in subscription.channels:
+                self._subscribers[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                subscribers = self._subscribers.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[channel]
+
+    def publish(self, channel, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscription in subscribers:
+            try:
+                subscription.deliver(event)
+            except RuntimeError:
+                # The subscriber's event loop has shut down
+                self.unsubscribe(subscription)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = import_string(settings.EVENT_BROKER)()
+    return _broker
+
+
+def publish(channel, event):
+    get_broker().publish(channel, event)
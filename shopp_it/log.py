@@ -0,0 +1,153 @@
+"""
+Structured, non-blocking logging.
+
+Log calls on the request path only copy the record onto a queue; a
+``QueueListener`` thread formats it (JSON by default) and writes it out, so
+a slow stdout or log shipper never holds up a request.
+
+Every record carries the fields bound to the current context: the request
+ID set by ``RequestIdMiddleware``, plus anything bound with ``bind()`` (the
+payment views bind ``tx_ref``). Context lives in a ``ContextVar``, so it
+follows a request through threads and ``sync_to_async`` hops, and is reset
+when the request (or job) ends. Code running outside a request resets what
+it bound with ``unbind()``, or uses ``bound()``.
+
+Configured from settings.LOGGING; set per-module levels with LOG_LEVELS,
+e.g. ``LOG_LEVELS="core.gateway=DEBUG,django.db.backends=WARNING"``.
+"""
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import uuid
+import weakref
+from contextlib import contextmanager
+
+_context = contextvars.ContextVar('log_context', default={})
+_handlers = weakref.WeakSet()  # live QueueHandlers, restarted in a forked child
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s'
+
+# Attributes every LogRecord has; anything else on a record is an extra field
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+def new_request(request_id=None):
+    """Start a fresh logging context for a request; returns a token for end_request()"""
+    return _context.set({'request_id': request_id or uuid.uuid4().hex})
+
+
+def end_request(token):
+    _context.reset(token)
+
+
+def bind(**fields):
+    """Attach fields to every record logged from the current context; returns a token for unbind()"""
+    return _context.set({**_context.get(), **fields})
+
+
+def unbind(token):
+    """Drop the fields bound by the bind() call that returned token"""
+    _context.reset(token)
+
+
+@contextmanager
+def bound(**fields):
+    """Attach fields to the records logged inside the with block"""
+    token = bind(**fields)
+    try:
+        yield
+    finally:
+        unbind(token)
+
+
+def current(name, default=None):
+    return _context.get().get(name, default)
+
+
+class ContextFilter(logging.Filter):
+    """Copies the bound context onto each record (runs in the thread that logs, before queueing)"""
+
+    def filter(self, record):
+        for name, value in _context.get().items():
+            if not hasattr(record, name):
+                setattr(record, name, value)
+        if not hasattr(record, 'request_id'):
+            # django.request logs error responses after the middleware has ended the request's context
+            record.request_id = getattr(getattr(record, 'request', None), 'request_id', '-')
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and every extra field"""
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        data.update((name, value) for name, value in vars(record).items() if name not in _RECORD_ATTRS)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        if record.stack_info:
+            data['stack'] = record.stack_info
+        return json.dumps(data, default=str)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues records for a background listener that formats and writes them
+    to stderr. Use as the only root handler (see settings.LOGGING), built
+    with the ``'()'`` key: under ``'class'`` Python 3.12+ dictConfig builds
+    the queue and listener itself and passes different arguments.
+    """
+
+    def __init__(self, json=True):
+        super().__init__(queue.SimpleQueue())
+        self.target = logging.StreamHandler()
+        self.target.setFormatter(JsonFormatter() if json else logging.Formatter(TEXT_FORMAT))
+        self.listener = None
+        self.start()
+        _handlers.add(self)
+
+    def start(self):
+        self.listener = logging.handlers.QueueListener(self.queue, self.target)
+        self.listener.start()
+
+    def stop(self):
+        """Flush queued records and stop the listener"""
+        if self.listener is not None and self.listener._thread is not None:
+            self.listener.stop()
+
+    def prepare(self, record):
+        # Resolve only what may change after this call; formatting happens on the listener thread
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = self.target.formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _restart_handlers():
+    for handler in list(_handlers):
+        handler.start()
+
+
+def _stop_handlers():
+    for handler in list(_handlers):
+        handler.stop()
+
+
+atexit.register(_stop_handlers)
+# A listener thread does not survive fork (e.g. gunicorn --preload), so start one in the child
+os.register_at_fork(after_in_child=_restart_handlers)
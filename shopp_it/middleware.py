@@ -1,11 +1,24 @@
 """
-Custom middleware for serving media files in production
+Custom middleware for serving media files in production, and for tagging
+each request's log records with a request ID
 """
 import os
+import re
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 from django.conf import settings
 from django.http import FileResponse, Http404
 from django.utils.deprecation import MiddlewareMixin
 
+from . import log
+
+# A client-supplied X-Request-ID ends up in every log record, so only plain IDs are kept
+REQUEST_ID = re.compile(r'[A-Za-z0-9-]{1,64}')
+
+
+def _request_id(request):
+    request_id = request.headers.get('X-Request-ID', '')
+    return request_id if REQUEST_ID.fullmatch(request_id) else None
+
 
 class MediaFileMiddleware(MiddlewareMixin):
     """
@@ -50,3 +63,42 @@ class MediaFileMiddleware(MiddlewareMixin):
             '.ico': 'image/x-icon',
         }
         return content_types.get(extension, 'application/octet-stream')
+
+
+class RequestIdMiddleware:
+    """
+    Gives each request a logging context with a request ID, taken from the
+    X-Request-ID header when a proxy already set a well-formed one, and
+    echoes it back on the response. The ID is also kept on
+    request.request_id for records logged after the context ends (Django's
+    error-response logging).
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = log.new_request(_request_id(request))
+        request.request_id = log.current('request_id')
+        try:
+            response = self.get_response(request)
+            response['X-Request-ID'] = log.current('request_id')
+            return response
+        finally:
+            log.end_request(token)
+
+    async def __acall__(self, request):
+        token = log.new_request(_request_id(request))
+        request.request_id = log.current('request_id')
+        try:
+            response = await self.get_response(request)
+            response['X-Request-ID'] = log.current('request_id')
+            return response
+        finally:
+            log.end_request(token)
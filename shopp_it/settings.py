@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 from pathlib import Path
 
 from datetime import timedelta
+from decimal import Decimal
 
 import os
 from dotenv import load_dotenv
@@ -65,6 +66,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'shopp_it.middleware.RequestIdMiddleware',  # Request ID on every log record (see shopp_it.log)
     'django.middleware.security.SecurityMiddleware',
     "whitenoise.middleware.WhiteNoiseMiddleware",
     'shopp_it.middleware.MediaFileMiddleware',  # Custom middleware for media files
@@ -212,7 +214,7 @@ WHITENOISE_MIMETYPES = {
 # REST Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'core.authentication.CachedJWTAuthentication',
     ),
 }
 
@@ -236,5 +238,157 @@ FRONTEND_URL = os.getenv('FRONTEND_URL', 'http://localhost:5173')
 PAYPAL_MODE = os.getenv('PAYPAL_MODE', 'sandbox')  # 'sandbox' or 'live'
 PAYPAL_CLIENT_ID = os.getenv('PAYPAL_CLIENT_ID', '')
 PAYPAL_CLIENT_SECRET = os.getenv('PAYPAL_CLIENT_SECRET', '')
+PAYPAL_API = os.getenv('PAYPAL_API', 'core.paypal_client.PayPalApi')  # core.fake_paypal.StubPayPalApi works offline
+PAYPAL_TOKEN_REFRESH_MARGIN = int(os.getenv('PAYPAL_TOKEN_REFRESH_MARGIN', '60'))  # seconds before expiry to fetch a new token
 
 REACT_BASE_URL = os.getenv("REACT_BASE_URL", "http://localhost:5173")
+
+# Cart housekeeping
+CART_GUEST_TTL_DAYS = int(os.getenv('CART_GUEST_TTL_DAYS', '30'))  # Unpaid guest carts idle longer than this are purged
+CART_PURGE_CHUNK_SIZE = int(os.getenv('CART_PURGE_CHUNK_SIZE', '500'))
+
+# Cache (local-memory by default; set CACHE_BACKEND=django.core.cache.backends.redis.RedisCache
+# and CACHE_LOCATION=redis://127.0.0.1:6379 to share it between workers)
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', ''),
+    }
+}
+
+# Cart storage: 'database' or 'cache' (hot carts kept in the cache and persisted write-behind)
+CART_STORE = os.getenv('CART_STORE', 'database')
+CART_STORE_CACHE = os.getenv('CART_STORE_CACHE', 'default')
+CART_STORE_TIMEOUT = int(os.getenv('CART_STORE_TIMEOUT', str(60 * 60 * 24)))
+CART_STORE_FLUSH_INTERVAL = float(os.getenv('CART_STORE_FLUSH_INTERVAL', '2'))  # seconds; 0 writes through
+CART_STORE_FLUSH_BATCH = int(os.getenv('CART_STORE_FLUSH_BATCH', '100'))
+# The cache store needs a cache shared by every process; allow a local-memory one only for single-process setups
+CART_STORE_ALLOW_LOCAL_CACHE = os.getenv('CART_STORE_ALLOW_LOCAL_CACHE', 'false').lower() == 'true'
+
+# Server-sent events (served by the ASGI app, e.g. gunicorn shopp_it.asgi:application -k uvicorn.workers.UvicornWorker)
+EVENT_BROKER = os.getenv('EVENT_BROKER', 'shopp_it.events.InProcessBroker')  # one process only; see shopp_it.events
+EVENT_STREAM_HEARTBEAT = int(os.getenv('EVENT_STREAM_HEARTBEAT', '15'))  # seconds between keep-alive comments
+
+# Checkout pricing (see cart_app.pricing)
+CART_SHIPPING_FEE = Decimal(os.getenv('CART_SHIPPING_FEE', '5.00'))
+CART_TAX_RATE = Decimal(os.getenv('CART_TAX_RATE', '0.1'))
+PROMOTIONS_CHECK_INTERVAL = float(os.getenv('PROMOTIONS_CHECK_INTERVAL', '2'))  # seconds between checks for promotion changes
+
+# Cart sharding: with CART_SHARD_COUNT > 1, carts and their items are spread over that many
+# SQLite files (cart_shard_0.sqlite3, ...) by a hash of cart_code; see cart_app.sharding.
+# Create the shards with ``python manage.py migrate --database cart_shard_<i>``, then move existing
+# carts over with ``python manage.py shard_carts``. Do not change the count afterwards: the hash would send
+# lookups to the wrong shards (the cart_app.E001 check refuses it).
+CART_SHARD_COUNT = int(os.getenv('CART_SHARD_COUNT', '0'))
+CART_SHARDS = [f'cart_shard_{i}' for i in range(CART_SHARD_COUNT)] if CART_SHARD_COUNT > 1 else []
+for _alias in CART_SHARDS:
+    DATABASES[_alias] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / f'{_alias}.sqlite3',
+    }
+if CART_SHARDS:
+    DATABASE_ROUTERS = ['cart_app.routers.CartShardRouter']
+
+# Payment gateway HTTP client (see core.gateway)
+FLUTTERWAVE_BASE_URL = os.getenv('FLUTTERWAVE_BASE_URL', 'https://api.flutterwave.com/v3')
+GATEWAY_CONNECT_TIMEOUT = float(os.getenv('GATEWAY_CONNECT_TIMEOUT', '3.05'))
+GATEWAY_READ_TIMEOUT = float(os.getenv('GATEWAY_READ_TIMEOUT', '15'))
+GATEWAY_RETRIES = int(os.getenv('GATEWAY_RETRIES', '2'))
+GATEWAY_BACKOFF = float(os.getenv('GATEWAY_BACKOFF', '0.3'))  # seconds; doubled per retry, with jitter
+GATEWAY_BREAKER_THRESHOLD = int(os.getenv('GATEWAY_BREAKER_THRESHOLD', '5'))  # consecutive failures that open the circuit
+GATEWAY_BREAKER_RESET = float(os.getenv('GATEWAY_BREAKER_RESET', '30'))  # seconds before a trial call
+GATEWAY_POOL_SIZE = int(os.getenv('GATEWAY_POOL_SIZE', '10'))
+ASYNC_VERIFY_CONCURRENCY = int(os.getenv('ASYNC_VERIFY_CONCURRENCY', '20'))  # in-flight async verifications per process
+
+# Admin selections of more mobile money payments than this are verified/rejected by a background job
+MOBILE_MONEY_BULK_JOB_THRESHOLD = int(os.getenv('MOBILE_MONEY_BULK_JOB_THRESHOLD', '200'))
+MOBILE_MONEY_COUNTRY_CODE = os.getenv('MOBILE_MONEY_COUNTRY_CODE', '234')  # stripped from phone numbers when matching statements
+
+# Order history (see core.history)
+ORDER_HISTORY_PAGE_SIZE = int(os.getenv('ORDER_HISTORY_PAGE_SIZE', '20'))
+ORDER_HISTORY_CACHE_TIMEOUT = int(os.getenv('ORDER_HISTORY_CACHE_TIMEOUT', '300'))  # seconds the first page is cached
+
+# Authenticated users (see core.authentication): cached so a request with a valid token costs no user SELECT
+# Only a shared cache (Redis, Memcached) is used across processes; with local memory users come from the database
+AUTH_USER_CACHE = os.getenv('AUTH_USER_CACHE', 'default')
+AUTH_USER_CACHE_TIMEOUT = int(os.getenv('AUTH_USER_CACHE_TIMEOUT', '300'))  # seconds a user is kept in the shared cache
+AUTH_USER_LOCAL_TTL = float(os.getenv('AUTH_USER_LOCAL_TTL', '5'))  # seconds a user is kept in process memory
+AUTH_USER_LOCAL_SIZE = int(os.getenv('AUTH_USER_LOCAL_SIZE', '1024'))  # users kept in process memory
+
+# Payment finalisation ledger (see core.idempotency): repeat deliveries are answered from here
+PAYMENT_LEDGER_CACHE = os.getenv('PAYMENT_LEDGER_CACHE', 'default')
+PAYMENT_LEDGER_CACHE_TIMEOUT = int(os.getenv('PAYMENT_LEDGER_CACHE_TIMEOUT', str(60 * 60 * 24)))
+PAYMENT_LEDGER_LOCAL_SIZE = int(os.getenv('PAYMENT_LEDGER_LOCAL_SIZE', '1024'))  # outcomes kept in process memory
+
+# Background jobs (python manage.py run_jobs; see core.jobs)
+JOB_CONCURRENCY = int(os.getenv('JOB_CONCURRENCY', '4'))
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '1'))  # seconds
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '5'))
+JOB_RETRY_BACKOFF = int(os.getenv('JOB_RETRY_BACKOFF', '30'))  # seconds before the first retry; doubles per attempt
+JOB_HEARTBEAT = int(os.getenv('JOB_HEARTBEAT', '30'))  # seconds between a worker's "still running" updates
+JOB_STALE_AFTER = int(os.getenv('JOB_STALE_AFTER', '120'))  # running jobs without a heartbeat this long are re-queued
+JOB_SCHEDULE = [
+    {'job': 'call_command', 'every': 60 * 60 * 24, 'name': 'purge_carts', 'payload': {'command': 'purge_carts'}},
+    {'job': 'jobs.prune', 'every': 60 * 60 * 24},
+    {'job': 'call_command', 'every': 60 * 15, 'name': 'reconcile_payments', 'payload': {'command': 'reconcile_payments'}},
+    {'job': 'call_command', 'every': 60 * 15, 'name': 'refresh_rollups', 'payload': {'command': 'refresh_rollups'}},
+    {'job': 'call_command', 'every': 60 * 60 * 24, 'name': 'prune_payloads', 'payload': {'command': 'prune_payloads'}},
+    {'job': 'outbox.prune', 'every': 60 * 60 * 24},
+    {'job': 'call_command', 'every': 60 * 60 * 24 * 7, 'name': 'archive_orders', 'payload': {'command': 'archive_orders'}},
+]
+
+# Payment reconciliation (python manage.py reconcile_payments; see core.reconciliation)
+RECONCILE_AFTER_MINUTES = int(os.getenv('RECONCILE_AFTER_MINUTES', '30'))  # pending transactions older than this are checked
+RECONCILE_ABANDON_AFTER_HOURS = int(os.getenv('RECONCILE_ABANDON_AFTER_HOURS', '24'))  # unpaid after this long -> failed
+RECONCILE_WORKERS = int(os.getenv('RECONCILE_WORKERS', '8'))  # gateway lookups in flight
+RECONCILE_RATE = float(os.getenv('RECONCILE_RATE', '10'))  # gateway lookups per second
+RECONCILE_BATCH_SIZE = int(os.getenv('RECONCILE_BATCH_SIZE', '200'))
+
+# Sales rollups for the admin dashboard (python manage.py refresh_rollups; see core.rollups)
+ROLLUP_LOOKBACK_HOURS = int(os.getenv('ROLLUP_LOOKBACK_HOURS', '48'))  # status changes older than this need --full
+ROLLUP_DASHBOARD_DAYS = int(os.getenv('ROLLUP_DASHBOARD_DAYS', '30'))  # default range of the dashboard
+
+# Raw gateway responses kept beside transactions (see core.payloads)
+GATEWAY_PAYLOAD_RETENTION_DAYS = int(os.getenv('GATEWAY_PAYLOAD_RETENTION_DAYS', '180'))  # pruned daily by prune_payloads
+
+# Order and payment events for downstream consumers (python manage.py relay_outbox; see core.outbox)
+OUTBOX_SINKS = [
+    {'class': 'core.outbox.FileSink', 'options': {'path': os.getenv('OUTBOX_FILE', str(BASE_DIR / 'outbox.jsonl'))}},
+]
+if os.getenv('OUTBOX_WEBHOOK_URL'):
+    OUTBOX_SINKS.append({'class': 'core.outbox.HttpSink', 'options': {'url': os.getenv('OUTBOX_WEBHOOK_URL')}})
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '100'))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '1'))  # seconds
+OUTBOX_MAX_BACKOFF = float(os.getenv('OUTBOX_MAX_BACKOFF', '60'))  # seconds between retries of a failing batch
+OUTBOX_RETENTION_DAYS = int(os.getenv('OUTBOX_RETENTION_DAYS', '7'))  # delivered events are then deleted
+
+# Archiving old orders and transactions (python manage.py archive_orders; see core.archive)
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '365'))
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', '500'))  # rows moved per transaction
+
+# Flutterwave webhooks carrying this secret in the verif-hash header are acknowledged at once
+# and verified by a background job; while it is unset every webhook is refused
+FLUTTERWAVE_WEBHOOK_HASH = os.getenv('FLUTTERWAVE_WEBHOOK_HASH', '')
+
+# Logging: records are queued and written as JSON lines by a background thread (see shopp_it.log).
+# LOG_FORMAT=text gives plain lines; LOG_LEVELS sets per-module levels, e.g. "core.gateway=DEBUG,core.jobs=WARNING"
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_LEVELS = {name.strip(): level.strip().upper() for name, _, level in
+              (item.partition('=') for item in os.getenv('LOG_LEVELS', '').split(',') if '=' in item)}
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'context': {'()': 'shopp_it.log.ContextFilter'},
+    },
+    'handlers': {
+        'queue': {
+            '()': 'shopp_it.log.QueueHandler',  # not 'class': dictConfig would wire its own queue and listener
+            'json': LOG_FORMAT == 'json',
+            'filters': ['context'],
+        },
+    },
+    'root': {'handlers': ['queue'], 'level': LOG_LEVEL},
+    'loggers': {name: {'level': level} for name, level in LOG_LEVELS.items()},
+}